@@ -5,15 +5,43 @@ receives an upload of a zip file with at least one tex file. We start a docker i
 in a separate task to compile the output.
 """
 
-from flask import json, Flask, request, render_template, current_app
+from flask import json, Flask, request, render_template, current_app, Response
 import config
+import gzip
 import os
 import sys
-from search.search_lib import search
+from search.search_lib import search, lookup, configure_result_cache, FILTER_FIELDS, SCORE_FIELDS
+from search.search_lib import configure_metrics, configure_ranking, new_timer, metrics_text, METRICS_PREFIX
+from search.search_lib import configure_executor, submit_search, search_batch
+from search.coalesce import Cancelled, Overloaded, client_disconnected
+from search.suggest import suggest
+from search.hierarchy import get_hierarchy
+from search.model import Funder
+from search.warmup import Warmer
 
 # Make sure we aren't running on an old python.
 assert sys.version_info >= (3, 6)
 
+# Maximum number of IDs in one call to /resolve.
+MAX_RESOLVE_IDS = 1000
+# Maximum number of queries and results per query in one call to /search_batch.
+MAX_BATCH_QUERIES = 5000
+MAX_BATCH_LIMIT = 100
+# Number of levels of the subtree shown on /view.
+VIEW_SUBTREE_DEPTH = 3
+# Fields of each result of /search unless fields= is given. These are
+# read from value slots, and the full funder is on /view.
+SEARCH_FIELDS = ['id', 'name', 'country', 'funder_type']
+# Fields that may be given in fields=, which may also be all.
+RESULT_FIELDS = set(Funder.__fields__) | {'id'} | set(SCORE_FIELDS)
+# Default and maximum number of results of /search.
+SEARCH_LIMIT = 20
+MAX_SEARCH_LIMIT = 100
+# JSON responses at least this long are gzipped if the client accepts it.
+GZIP_MIN_SIZE = 1024
+# Most of the gain of gzip for far less CPU than level 9.
+GZIP_LEVEL = 5
+
 def validate_config():
     if 'DB_PATH' not in app.config:
         raise ValueError(str(app.config))
@@ -25,6 +53,43 @@ if 'DEBUG' in app.config:
 else:
     app.config.from_object(config.ProductionConfig)
 validate_config()
+configure_result_cache(app.config['RESULT_CACHE_SIZE'], app.config['RESULT_CACHE_TTL'])
+configure_metrics(app.config['METRICS_ENABLED'], app.config['SLOW_QUERY_SECONDS'])
+configure_ranking(app.config['RANKING'])
+if app.config['SEARCH_THREADS']:
+    configure_executor(app.config['SEARCH_THREADS'], app.config['SEARCH_MAX_PENDING'])
+# Each worker warms up when it imports this module. See /ready.
+warmer = Warmer(app.config['DB_PATH'], app.config['WARMUP_FILE'],
+                app.config['WARMUP_FUNDERS'], app.config['WARMUP_HANDLES'])
+if app.config['WARMUP']:
+    warmer.start()
+else:
+    warmer.skip()
+
+@app.after_request
+def compress_response(response):
+    """Gzip JSON responses for clients that accept it."""
+    if (response.mimetype != 'application/json' or response.direct_passthrough or
+        'Content-Encoding' in response.headers or
+        'gzip' not in request.headers.get('Accept-Encoding', '')):
+        return response
+    data = response.get_data()
+    if len(data) < GZIP_MIN_SIZE:
+        return response
+    response.set_data(gzip.compress(data, GZIP_LEVEL))
+    response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
+    return response
+
+def timed_response(timer, result):
+    """Return result as JSON, with the stages of timer in a Server-Timing header."""
+    response = json.jsonify(result)
+    timer.mark('jsonify')
+    timer.finish()
+    server_timing = timer.server_timing()
+    if server_timing:
+        response.headers['Server-Timing'] = server_timing
+    return response
 
 @app.route('/')
 def home():
@@ -32,26 +97,235 @@ def home():
 
 @app.route('/view/<id>')
 def view_funder(id):
-    result = search(app.config['DB_PATH'],
-                    offset=0,
-                    textq='id:' + id,
-                    locationq=None)
-    if len(result.get('results')) > 0:
-        result = {'item': result.get('results')[0]}
+    result = lookup(app.config['DB_PATH'], [id])
+    if result.get('results', {}).get(id):
+        result = {'item': result['results'][id]}
+        try:
+            result['family'] = get_hierarchy(app.config['DB_PATH']).family(result['item']['id'], VIEW_SUBTREE_DEPTH)
+        except Exception as e:
+            # Indexes built before hierarchy.json existed.
+            app.logger.warning('No hierarchy: {}'.format(str(e)))
     else:
         result = {'error': 'no such item'}
     print(result)
     return render_template('index.html', **result)
 
+def search_filters(args):
+    """Return the filters of a /search request. Each of FILTER_FIELDS may
+       be given as a comma-separated list, such as country=deu,fra."""
+    filters = {}
+    for field in FILTER_FIELDS:
+        if args.get(field):
+            filters[field] = [v.strip() for v in args[field].split(',') if v.strip()]
+    return filters
+
+def check_fields(fields):
+    """Raise ValueError naming the fields that are not in RESULT_FIELDS."""
+    unknown = [f for f in fields if f not in RESULT_FIELDS]
+    if unknown:
+        raise ValueError('unknown fields {}'.format(','.join(unknown)))
+
+def search_fields(args):
+    """Return the fields of each result of a /search request, given as a
+       comma-separated list such as fields=id,name,altnames. fields=all
+       returns None, which means every field.
+       raises:
+          ValueError if a field is unknown
+    """
+    if not args.get('fields'):
+        return SEARCH_FIELDS
+    if args['fields'] == 'all':
+        return None
+    fields = [f.strip() for f in args['fields'].split(',') if f.strip()]
+    check_fields(fields)
+    return fields
+
+def search_page(args):
+    """Return the offset and limit of a /search request. The limit is at
+       most MAX_SEARCH_LIMIT, so a client pages through larger results.
+       raises:
+          ValueError if they are not numbers
+    """
+    offset = max(0, int(args.get('offset', 0)))
+    limit = max(1, min(int(args.get('limit', SEARCH_LIMIT)), MAX_SEARCH_LIMIT))
+    return offset, limit
+
 @app.route('/search', methods=['GET'])
 def get_results():
+    """Search for funders. Each result has the SEARCH_FIELDS unless
+       fields= is given, and there are at most limit results."""
     args = request.args.to_dict()
-    if 'textq' not in args and 'locationq' not in args:
+    filters = search_filters(args)
+    if 'textq' not in args and 'locationq' not in args and not filters:
         return json.jsonify({'error': 'missing queries'})
-    return json.jsonify(search(app.config['DB_PATH'],
-                               offset=args.get('offset', 0),
+    try:
+        fields = search_fields(args)
+    except ValueError as e:
+        return json.jsonify({'error': str(e)})
+    try:
+        offset, limit = search_page(args)
+    except ValueError:
+        return json.jsonify({'error': 'invalid offset or limit'})
+    facets = args.get('facets') in ('1', 'true')
+    if app.config['SEARCH_THREADS']:
+        return pooled_search(args, offset, limit, fields, filters, facets)
+    timer = new_timer('search')
+    return timed_response(timer, search(app.config['DB_PATH'],
+                                        offset=offset,
+                                        limit=limit,
+                                        textq=args.get('textq'),
+                                        locationq=args.get('locationq'),
+                                        fields=fields,
+                                        timer=timer,
+                                        filters=filters,
+                                        facets=facets))
+
+def pooled_search(args, offset, limit, fields, filters, facets):
+    """Run the search in the thread pool, sharing the result with identical
+       queries that are in flight, and give up if the client goes away."""
+    timer = new_timer('pooled_search')
+    try:
+        ticket = submit_search(app.config['DB_PATH'],
+                               offset=offset,
+                               limit=limit,
                                textq=args.get('textq'),
-                               locationq=args.get('locationq')))
-    
+                               locationq=args.get('locationq'),
+                               fields=fields,
+                               filters=filters,
+                               facets=facets)
+    except Overloaded:
+        return json.jsonify({'error': 'Server is busy'}), 503
+    timer.mark('submit')
+    timer.note(coalesced=ticket.coalesced)
+    try:
+        result = ticket.wait(lambda: client_disconnected(request.environ))
+    except Cancelled:
+        # Nobody will read this, 499 is what nginx logs for it.
+        return '', 499
+    timer.mark('wait')
+    return timed_response(timer, result)
+
+def batch_query_error(query):
+    """Return what is wrong with a query of /search_batch, or None."""
+    if not isinstance(query, dict):
+        return 'must be an object'
+    for field in ['textq', 'locationq', 'source']:
+        if query.get(field) is not None and not isinstance(query[field], str):
+            return '{} must be a string'.format(field)
+    filters = query.get('filters')
+    if filters is None:
+        return None
+    if not isinstance(filters, dict):
+        return 'filters must be an object'
+    for field, values in filters.items():
+        if field not in FILTER_FIELDS:
+            return 'cannot filter on {}'.format(field)
+        if not (isinstance(values, list) and all(isinstance(v, str) for v in values)):
+            return 'filters.{} must be a list of strings'.format(field)
+    return None
+
+@app.route('/search_batch', methods=['POST'])
+def get_batch_results():
+    """Run many searches in one call. The JSON body is
+       {"queries": [{"textq": ..., "locationq": ..., "source": ...}, ...], "limit": k}
+       and the response has the top k results of each query, in order.
+    """
+    body = request.get_json(silent=True)
+    queries = body.get('queries') if isinstance(body, dict) else None
+    if not isinstance(queries, list) or not queries:
+        return json.jsonify({'error': 'missing queries'}), 400
+    if len(queries) > MAX_BATCH_QUERIES:
+        return json.jsonify({'error': 'at most {} queries are allowed'.format(MAX_BATCH_QUERIES)}), 400
+    for i, query in enumerate(queries):
+        error = batch_query_error(query)
+        if error:
+            return json.jsonify({'error': 'query {}: {}'.format(i, error)}), 400
+    try:
+        limit = int(body.get('limit', 10))
+    except (TypeError, ValueError):
+        return json.jsonify({'error': 'invalid limit'}), 400
+    limit = max(1, min(limit, MAX_BATCH_LIMIT))
+    fields = body.get('fields')
+    if fields is not None and not (isinstance(fields, list) and all(isinstance(f, str) for f in fields)):
+        return json.jsonify({'error': 'fields must be a list of strings'}), 400
+    if fields is not None:
+        try:
+            check_fields(fields)
+        except ValueError as e:
+            return json.jsonify({'error': str(e)}), 400
+    timer = new_timer('search_batch')
+    return timed_response(timer, search_batch(app.config['DB_PATH'], queries, limit,
+                                              fields=fields,
+                                              jobs=app.config['BATCH_SEARCH_THREADS'],
+                                              timer=timer))
+
+@app.route('/resolve', methods=['GET', 'POST'])
+def resolve_ids():
+    """Look up many funder IDs in one call. IDs are given either as a
+       comma-separated ids argument or as a JSON body {"ids": [...]}.
+    """
+    if request.method == 'POST':
+        body = request.get_json(silent=True)
+        ids = body.get('ids') if isinstance(body, dict) else None
+    else:
+        ids = request.args.get('ids')
+        if ids is not None:
+            ids = [i.strip() for i in ids.split(',')]
+    if not isinstance(ids, list) or not ids:
+        return json.jsonify({'error': 'missing ids'})
+    if len(ids) > MAX_RESOLVE_IDS:
+        return json.jsonify({'error': 'at most {} ids are allowed'.format(MAX_RESOLVE_IDS)})
+    if not all(isinstance(i, str) for i in ids):
+        return json.jsonify({'error': 'ids must be strings'})
+    timer = new_timer('resolve')
+    return timed_response(timer, lookup(app.config['DB_PATH'], ids, timer=timer))
+
+@app.route('/hierarchy/<id>', methods=['GET'])
+def get_family(id):
+    """Return the ancestors, siblings, related funders, and subtree of a funder.
+       The depth of the subtree may be limited with depth=N."""
+    try:
+        depth = request.args.get('depth')
+        depth = int(depth) if depth else None
+    except ValueError:
+        return json.jsonify({'error': 'invalid depth'})
+    try:
+        family = get_hierarchy(app.config['DB_PATH']).family(id, depth)
+    except Exception as e:
+        app.logger.critical('Error in hierarchy: {}'.format(str(e)))
+        return json.jsonify({'error': 'Error in server'})
+    if family is None:
+        return json.jsonify({'error': 'no such item'})
+    return json.jsonify(family)
+
+@app.route('/suggest', methods=['GET'])
+def get_suggestions():
+    """Prefix completion of funder names that does not use xapian."""
+    prefix = request.args.get('q')
+    if not prefix:
+        return json.jsonify({'error': 'missing q'})
+    try:
+        n = int(request.args.get('n', 10))
+    except ValueError:
+        return json.jsonify({'error': 'invalid n'})
+    try:
+        return json.jsonify({'results': suggest(app.config['DB_PATH'], prefix, n)})
+    except Exception as e:
+        app.logger.critical('Error in suggest: {}'.format(str(e)))
+        return json.jsonify({'error': 'Error in server'})
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Metrics of this worker in the Prometheus text format."""
+    text = metrics_text() + '\n'.join(warmer.lines(METRICS_PREFIX)) + '\n'
+    return Response(text, mimetype='text/plain; version=0.0.4')
+
+@app.route('/ready', methods=['GET'])
+def get_ready():
+    """Readiness probe. This returns 503 until the worker has warmed up,
+       and the status includes how long the last warmup took."""
+    status = warmer.check()
+    return json.jsonify(status), 200 if status['ready'] else 503
+
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0')
@@ -3,6 +3,35 @@ class Config(object):
     DEVELOPMENT = True
     SCRIPT_NAME = '/funding'
     DB_PATH='/home/mccurley/git/fundreg/search/xapian.db'
+    # Number of search results cached in each worker, and for how many seconds.
+    RESULT_CACHE_SIZE = 2048
+    RESULT_CACHE_TTL = 300
+    # Record per-stage timings of queries for /metrics and Server-Timing.
+    METRICS_ENABLED = True
+    # Log queries that take longer than this many seconds, or None for no log.
+    SLOW_QUERY_SECONDS = 0.5
+    # If this is more than 0, /search runs queries in a pool of this many
+    # threads, and identical queries that are in flight are run only once.
+    SEARCH_THREADS = 0
+    # Maximum number of distinct queries waiting for the pool before /search returns 503.
+    SEARCH_MAX_PENDING = 256
+    # Number of threads that run the queries of one call to /search_batch.
+    BATCH_SEARCH_THREADS = 4
+    # 'static' folds the source and static score of funders into the
+    # relevance, so only the top results are examined. 'source' sorts
+    # FundReg first and then by relevance, as before.
+    RANKING = 'static'
+    # Warm up the index in the background when a worker starts and after
+    # a new generation is published. /ready returns 503 until the first
+    # warmup is done. With gunicorn, do not use --preload, since the
+    # warmup thread would only run in the master process.
+    WARMUP = True
+    # Queries from benchmarks/bench_query.py --save_workload, or None to
+    # use the names of the WARMUP_FUNDERS most important funders.
+    WARMUP_FILE = None
+    WARMUP_FUNDERS = 200
+    # Number of database handles that are opened ahead of queries.
+    WARMUP_HANDLES = 4
 
 class ProductionConfig(Config):
     DEBUG = False
@@ -0,0 +1,8 @@
+"""Benchmarks for the index build and search. These are run from the
+search directory, for example python -m benchmarks.bench_ror
+
+   bench_build: throughput and peak memory of each build stage
+   bench_query: latency percentiles of a replayed query workload
+   bench_rdf, bench_ror: the parsers against the ones they replaced
+   synthetic: generates registry.rdf and ROR inputs of any size
+"""
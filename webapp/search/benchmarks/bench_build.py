@@ -0,0 +1,101 @@
+"""Measure the throughput and peak memory of each stage of the index
+build on synthetic data. Run from the search directory:
+
+    python -m benchmarks.bench_build --fundreg_count 30000 --ror_count 110000 --jobs 4
+
+Each stage runs in its own process, so peak_rss_mb is the peak memory of
+that stage alone. Parsed records are passed between stages in snapshot
+files, as with create_index.py --use_cache. Results are printed as JSON
+and can be saved with --output to compare commits.
+"""
+
+import argparse
+import itertools
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from benchmarks.measure import run_isolated, write_results
+from benchmarks.synthetic import write_registry_rdf, write_ror_dump
+
+def stage_parse_rdf(filename, snapshot_file):
+    from model import VALIDATE_EVERY
+    from rdf_parser import parse_rdf
+    from snapshot import write_snapshot
+    country_map = json.loads(open('data/country_map.json', 'r').read())
+    start = time.perf_counter()
+    funderlist = parse_rdf(country_map, VALIDATE_EVERY, filename)
+    elapsed = time.perf_counter() - start
+    write_snapshot(funderlist, snapshot_file)
+    return len(funderlist.funders), elapsed
+
+def stage_parse_ror(filename, snapshot_file):
+    from model import VALIDATE_EVERY
+    from ror_parser import parse_ror
+    from snapshot import write_snapshot
+    start = time.perf_counter()
+    funderlist = parse_ror(filename, VALIDATE_EVERY)
+    elapsed = time.perf_counter() - start
+    write_snapshot(funderlist, snapshot_file)
+    return len(funderlist.funders), elapsed
+
+def stage_create_index(snapshot_files, dbpath, jobs):
+    from create_index import create_index
+    from snapshot import Snapshot
+    snapshots = [Snapshot(path) for path in snapshot_files]
+    count = sum(snapshot.nrecords for snapshot in snapshots)
+    start = time.perf_counter()
+    create_index(dbpath, itertools.chain.from_iterable(s.iter_records() for s in snapshots), jobs=jobs)
+    elapsed = time.perf_counter() - start
+    for snapshot in snapshots:
+        snapshot.close()
+    return count, elapsed
+
+def measure(name, func, *args):
+    run = run_isolated(func, *args)
+    count, elapsed = run['result']
+    return {'stage': name,
+            'records': count,
+            'seconds': round(elapsed, 3),
+            'records_per_second': round(count / elapsed, 1) if elapsed else None,
+            'peak_rss_mb': run['peak_rss_mb'],
+            'workers_peak_rss_mb': run['workers_peak_rss_mb']}
+
+if __name__ == '__main__':
+    arguments = argparse.ArgumentParser()
+    arguments.add_argument('--fundreg_count',
+                           type=int,
+                           default=10000,
+                           help='Number of synthetic FundReg concepts')
+    arguments.add_argument('--ror_count',
+                           type=int,
+                           default=35000,
+                           help='Number of synthetic ROR organizations')
+    arguments.add_argument('--jobs',
+                           type=int,
+                           default=1,
+                           help='Number of processes for create_index')
+    arguments.add_argument('--workdir',
+                           help='Keep the generated data and index in this directory')
+    arguments.add_argument('--output',
+                           help='Also write the results to this file')
+    args = arguments.parse_args()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        workdir = args.workdir or tmpdir
+        os.makedirs(workdir, exist_ok=True)
+        rdf_file = os.path.join(workdir, 'registry.rdf')
+        ror_file = os.path.join(workdir, 'raw_ror.json')
+        write_registry_rdf(rdf_file, args.fundreg_count)
+        write_ror_dump(ror_file, args.ror_count)
+        rdf_snapshot = os.path.join(workdir, 'registry.snap')
+        ror_snapshot = os.path.join(workdir, 'ror.snap')
+        dbpath = os.path.join(workdir, 'xapian.db')
+        if os.path.exists(dbpath):
+            shutil.rmtree(dbpath)
+        results = [measure('parse_rdf', stage_parse_rdf, rdf_file, rdf_snapshot),
+                   measure('parse_ror', stage_parse_ror, ror_file, ror_snapshot),
+                   measure('create_index', stage_create_index,
+                           [rdf_snapshot, ror_snapshot], dbpath, args.jobs)]
+    write_results('build', vars(args), results, args.output)
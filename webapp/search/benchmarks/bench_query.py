@@ -0,0 +1,168 @@
+"""Replay a query workload through search_lib and report latency
+percentiles for each kind of query. Run from the search directory:
+
+    python -m benchmarks.bench_query --dbpath xapian.db --queries 5000
+
+Without --dbpath an index is built from synthetic data first. The
+workload is generated from the names in the suggest.json file of the
+index, or replayed from a file written by --save_workload, so the same
+queries can be run against different commits. Each line of a workload
+file is a JSON object with a kind and the arguments of the call, and
+the global ID of the funder being looked for as target:
+
+   typeahead: search(textq) for each prefix of a name as it is typed
+   location:  search(textq, locationq) with a name prefix and a country
+   id_search: search(textq='id:...') as /view used to do
+   lookup:    lookup(ids) with a batch of IDs
+
+The result cache is disabled unless --cache is given, so that repeated
+queries measure the index rather than the cache.
+"""
+
+import argparse
+import itertools
+import json
+import os
+import random
+import tempfile
+import time
+
+from benchmarks.measure import summarize, write_results
+
+COUNTRIES = ['United States', 'Germany', 'France', 'Japan', 'China', 'Brazil',
+             'India', 'Denmark', 'Spain', 'United Kingdom']
+# Users rarely type more than this before picking a result.
+MAX_TYPED = 24
+LOOKUP_BATCH = 20
+
+def build_synthetic_index(dbpath, count, edge_ngram_length=0):
+    """Build an index of count synthetic funders, a quarter of them from FundReg."""
+    from create_index import create_index
+    from model import VALIDATE_EVERY
+    from rdf_parser import parse_rdf
+    from ror_parser import parse_ror
+    from benchmarks.synthetic import write_registry_rdf, write_ror_dump
+    country_map = json.loads(open('data/country_map.json', 'r').read())
+    workdir = os.path.dirname(dbpath)
+    rdf_file = os.path.join(workdir, 'registry.rdf')
+    ror_file = os.path.join(workdir, 'raw_ror.json')
+    write_registry_rdf(rdf_file, count // 4)
+    write_ror_dump(ror_file, count - count // 4)
+    fundreg = parse_rdf(country_map, VALIDATE_EVERY, rdf_file)
+    ror = parse_ror(ror_file, VALIDATE_EVERY)
+    create_index(dbpath, itertools.chain(fundreg.funders.values(), ror.funders.values()),
+                 edge_ngram_length=edge_ngram_length)
+
+def load_funders(dbpath):
+    """Return [global_id, name] for every funder, most important first."""
+    from suggest import SUGGEST_FILE
+    with open(os.path.join(dbpath, SUGGEST_FILE), 'r', encoding='UTF-8') as fp:
+        return json.load(fp)['funders']
+
+def pick(rng, funders):
+    """Pick a funder, favouring the highly ranked ones like real traffic does."""
+    return funders[min(len(funders) - 1, int(rng.paretovariate(1.2)) - 1)]
+
+def generate_workload(funders, queries, seed=1):
+    """Return a list of queries. Of the funders that are picked, 70% are
+       typed one keystroke at a time, and the rest are split between
+       location, id_search, and lookup, so most queries are typeahead."""
+    rng = random.Random(seed)
+    workload = []
+    while len(workload) < queries:
+        choice = rng.random()
+        global_id, name = pick(rng, funders)
+        if choice < 0.70:
+            # The front end sends the text box on every keystroke.
+            for end in range(1, min(len(name), MAX_TYPED) + 1):
+                workload.append({'kind': 'typeahead', 'textq': name[:end], 'target': global_id})
+        elif choice < 0.85:
+            workload.append({'kind': 'location',
+                             'textq': name[:rng.randint(3, MAX_TYPED)],
+                             'locationq': rng.choice(COUNTRIES),
+                             'target': global_id})
+        elif choice < 0.95:
+            workload.append({'kind': 'id_search', 'textq': 'id:' + global_id})
+        else:
+            ids = [rng.choice(funders)[0] for _ in range(LOOKUP_BATCH)]
+            workload.append({'kind': 'lookup', 'ids': ids})
+    return workload[:queries]
+
+def replay(dbpath, workload):
+    """Run every query and return a dict from kind to a list of latencies in seconds."""
+    from search_lib import search, lookup
+    latencies = {}
+    for query in workload:
+        start = time.perf_counter()
+        if query['kind'] == 'lookup':
+            res = lookup(dbpath, query['ids'])
+        else:
+            res = search(dbpath, 0, query.get('limit', 1000),
+                         textq=query.get('textq'), locationq=query.get('locationq'))
+        elapsed = time.perf_counter() - start
+        if 'error' in res:
+            raise RuntimeError('query {} failed: {}'.format(query, res['error']))
+        latencies.setdefault(query['kind'], []).append(elapsed)
+    return latencies
+
+def run(dbpath, args):
+    from search_lib import configure_result_cache
+    if not args.cache:
+        configure_result_cache(0, 0)
+    if args.workload:
+        with open(args.workload, 'r', encoding='UTF-8') as fp:
+            workload = [json.loads(line) for line in fp if line.strip()]
+    else:
+        workload = generate_workload(load_funders(dbpath), args.queries, args.seed)
+    if args.save_workload:
+        with open(args.save_workload, 'w', encoding='UTF-8') as fp:
+            for query in workload:
+                fp.write(json.dumps(query, ensure_ascii=False) + '\n')
+    # The first queries open the database and warm the page cache.
+    replay(dbpath, workload[:args.warmup])
+    latencies = replay(dbpath, workload)
+    results = [dict(kind=kind, **summarize(values)) for kind, values in sorted(latencies.items())]
+    results.append(dict(kind='all', **summarize(list(itertools.chain(*latencies.values())))))
+    return results
+
+if __name__ == '__main__':
+    arguments = argparse.ArgumentParser()
+    arguments.add_argument('--dbpath',
+                           help='Index to query. By default a synthetic index is built.')
+    arguments.add_argument('--count',
+                           type=int,
+                           default=20000,
+                           help='Number of funders in the synthetic index')
+    arguments.add_argument('--edge_ngrams',
+                           action='store_true',
+                           help='Build the synthetic index with edge n-gram terms')
+    arguments.add_argument('--queries',
+                           type=int,
+                           default=5000,
+                           help='Number of queries to generate')
+    arguments.add_argument('--seed',
+                           type=int,
+                           default=1,
+                           help='Random seed for the generated workload')
+    arguments.add_argument('--workload',
+                           help='Replay the queries in this file instead of generating them')
+    arguments.add_argument('--save_workload',
+                           help='Write the queries to this file')
+    arguments.add_argument('--warmup',
+                           type=int,
+                           default=200,
+                           help='Number of queries to run before measuring')
+    arguments.add_argument('--cache',
+                           action='store_true',
+                           help='Leave the result cache of search() enabled')
+    arguments.add_argument('--output',
+                           help='Also write the results to this file')
+    args = arguments.parse_args()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        dbpath = args.dbpath
+        if not dbpath:
+            dbpath = os.path.join(tmpdir, 'xapian.db')
+            from search_lib import EDGE_NGRAM_LENGTH
+            build_synthetic_index(dbpath, args.count, EDGE_NGRAM_LENGTH if args.edge_ngrams else 0)
+        results = run(dbpath, args)
+    write_results('query', vars(args), results, args.output)
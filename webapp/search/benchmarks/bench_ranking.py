@@ -0,0 +1,109 @@
+"""Compare the rankings of search_lib on the same workload. Run from the
+search directory:
+
+    python -m benchmarks.bench_ranking --count 140000 --limit 10
+
+For each of search_lib.RANKINGS, every typeahead and location query of
+a workload from bench_query is run with a page of --limit results, and
+the latency is reported together with two measures of quality: the
+mean reciprocal rank of the funder that the query was generated from,
+and the fraction of queries that have it on the page. The overlap of
+the pages of each ranking with those of the source ranking is also
+reported, so a faster ranking can be checked to return the same
+funders. The result cache is disabled.
+"""
+
+import argparse
+import json
+import os
+import tempfile
+import time
+
+from benchmarks.bench_query import build_synthetic_index, generate_workload, load_funders
+from benchmarks.measure import summarize, write_results
+
+def run_ranking(dbpath, ranking, workload, limit, warmup):
+    """Return the latencies, the rank of the target of each query or None
+       if it was not on the page, and the IDs on each page."""
+    from search_lib import configure_ranking, search
+    configure_ranking(ranking)
+    for query in workload[:warmup]:
+        search(dbpath, 0, limit, textq=query['textq'], locationq=query.get('locationq'), fields=['id'])
+    latencies = []
+    ranks = []
+    pages = []
+    for query in workload:
+        start = time.perf_counter()
+        res = search(dbpath, 0, limit, textq=query['textq'], locationq=query.get('locationq'),
+                     fields=['id'])
+        latencies.append(time.perf_counter() - start)
+        if 'error' in res:
+            raise RuntimeError('query {} failed: {}'.format(query, res['error']))
+        ids = [item['id'] for item in res['results']]
+        ranks.append(ids.index(query['target']) + 1 if query.get('target') in ids else None)
+        pages.append(ids)
+    return latencies, ranks, pages
+
+def overlap(pages, baseline):
+    """Return the mean fraction of the IDs on the baseline pages that are also on pages."""
+    fractions = [len(set(page) & set(base)) / len(base) for page, base in zip(pages, baseline) if base]
+    return round(sum(fractions) / len(fractions), 4) if fractions else None
+
+def run(dbpath, args):
+    from search_lib import configure_result_cache, RANKINGS
+    configure_result_cache(0, 0)
+    if args.workload:
+        with open(args.workload, 'r', encoding='UTF-8') as fp:
+            workload = [json.loads(line) for line in fp if line.strip()]
+    else:
+        workload = generate_workload(load_funders(dbpath), args.queries, args.seed)
+    workload = [query for query in workload if query['kind'] in ('typeahead', 'location')]
+    runs = {ranking: run_ranking(dbpath, ranking, workload, args.limit, args.warmup)
+            for ranking in RANKINGS}
+    baseline = runs['source'][2]
+    results = []
+    for ranking, (latencies, ranks, pages) in runs.items():
+        found = [rank for rank in ranks if rank is not None]
+        results.append(dict(ranking=ranking,
+                            mrr=round(sum(1 / rank for rank in found) / len(ranks), 4),
+                            found_on_page=round(len(found) / len(ranks), 4),
+                            overlap_with_source=overlap(pages, baseline),
+                            **summarize(latencies)))
+    return results
+
+if __name__ == '__main__':
+    arguments = argparse.ArgumentParser()
+    arguments.add_argument('--dbpath',
+                           help='Index to query. By default a synthetic index is built.')
+    arguments.add_argument('--count',
+                           type=int,
+                           default=20000,
+                           help='Number of funders in the synthetic index')
+    arguments.add_argument('--queries',
+                           type=int,
+                           default=5000,
+                           help='Number of queries to generate')
+    arguments.add_argument('--seed',
+                           type=int,
+                           default=1,
+                           help='Random seed for the generated workload')
+    arguments.add_argument('--workload',
+                           help='Replay the queries in this file from bench_query --save_workload')
+    arguments.add_argument('--limit',
+                           type=int,
+                           default=10,
+                           help='Number of results on a page')
+    arguments.add_argument('--warmup',
+                           type=int,
+                           default=200,
+                           help='Number of queries to run with each ranking before measuring')
+    arguments.add_argument('--output',
+                           help='Also write the results to this file')
+    args = arguments.parse_args()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        dbpath = args.dbpath
+        if not dbpath:
+            dbpath = os.path.join(tmpdir, 'xapian.db')
+            build_synthetic_index(dbpath, args.count)
+        results = run(dbpath, args)
+    write_results('ranking', vars(args), results, args.output)
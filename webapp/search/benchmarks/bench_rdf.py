@@ -0,0 +1,52 @@
+"""Compare the throughput of the expat parser in rdf_parser.py with the
+SAX handler that it replaced. Run from the search directory:
+
+    python -m benchmarks.bench_rdf --count 30000
+
+Results are printed as JSON. Both parsers must produce the same records.
+"""
+
+import argparse
+import json
+import os
+import tempfile
+import time
+
+from rdf_parser import parse_rdf, parse_rdf_sax
+from benchmarks.synthetic import write_registry_rdf
+
+def measure(name, filename, parser, country_map):
+    start = time.perf_counter()
+    funderlist = parser(country_map, 0, filename)
+    elapsed = time.perf_counter() - start
+    count = len(funderlist.funders)
+    return funderlist, {'parser': name,
+                        'concepts': count,
+                        'seconds': round(elapsed, 3),
+                        'concepts_per_second': round(count / elapsed, 1)}
+
+def same_records(first, second):
+    if first.funders.keys() != second.funders.keys():
+        return False
+    return all(first.funders[key].dict() == second.funders[key].dict() for key in first.funders)
+
+if __name__ == '__main__':
+    arguments = argparse.ArgumentParser()
+    arguments.add_argument('--input',
+                           help='RDF file to parse. By default a synthetic file is generated.')
+    arguments.add_argument('--count',
+                           type=int,
+                           default=30000,
+                           help='Number of synthetic concepts')
+    args = arguments.parse_args()
+    country_map = json.loads(open('data/country_map.json', 'r').read())
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename = args.input
+        if not filename:
+            filename = os.path.join(tmpdir, 'registry.rdf')
+            write_registry_rdf(filename, args.count)
+        sax_funders, sax_result = measure('sax', filename, parse_rdf_sax, country_map)
+        expat_funders, expat_result = measure('expat', filename, parse_rdf, country_map)
+    print(json.dumps({'benchmark': 'rdf_parse',
+                      'same_records': same_records(sax_funders, expat_funders),
+                      'results': [sax_result, expat_result]}, indent=2))
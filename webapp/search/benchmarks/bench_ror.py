@@ -0,0 +1,63 @@
+"""Compare the throughput of the ROR parser in ror_parser.py with the
+naya streaming parser that it replaced. Run from the search directory:
+
+    python -m benchmarks.bench_ror --count 20000
+
+Both parsers convert the organizations with ror_items_to_records() and
+validate the same sample of them, so the difference is in the parsing.
+Results are printed as JSON.
+"""
+
+import argparse
+import json
+import os
+import tempfile
+import time
+
+from model import VALIDATE_EVERY
+from ror_parser import iter_ror_funders, ror_items_to_records
+from benchmarks.synthetic import write_ror_dump
+
+def naya_funders(fp, validate_every):
+    """The original parser, which tokenizes the dump in python."""
+    from naya import tokenize, stream_array
+    return ror_items_to_records(stream_array(tokenize(fp)), validate_every)
+
+def measure(name, filename, parser):
+    with open(filename, 'r', encoding='UTF-8') as fp:
+        start = time.perf_counter()
+        count = sum(1 for _ in parser(fp))
+        elapsed = time.perf_counter() - start
+    return {'parser': name,
+            'records': count,
+            'seconds': round(elapsed, 3),
+            'records_per_second': round(count / elapsed, 1)}
+
+if __name__ == '__main__':
+    arguments = argparse.ArgumentParser()
+    arguments.add_argument('--input',
+                           help='ROR dump to parse. By default a synthetic dump is generated.')
+    arguments.add_argument('--count',
+                           type=int,
+                           default=20000,
+                           help='Number of synthetic organizations')
+    arguments.add_argument('--validate_every',
+                           type=int,
+                           default=VALIDATE_EVERY,
+                           help='Validate one record in this many as a Funder (0 for none)')
+    arguments.add_argument('--skip_naya',
+                           action='store_true',
+                           help='Do not run the naya parser, which is slow')
+    args = arguments.parse_args()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename = args.input
+        if not filename:
+            filename = os.path.join(tmpdir, 'ror.json')
+            write_ror_dump(filename, args.count)
+        results = []
+        if not args.skip_naya:
+            results.append(measure('naya', filename,
+                                   lambda fp: naya_funders(fp, args.validate_every)))
+        results.append(measure('chunked', filename,
+                               lambda fp: iter_ror_funders(fp, args.validate_every)))
+    print(json.dumps({'benchmark': 'ror_parse', 'results': results}, indent=2))
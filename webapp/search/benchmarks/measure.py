@@ -0,0 +1,96 @@
+"""Helpers shared by the benchmarks. Build stages are run in a fresh
+process so that their peak memory can be measured, latencies are
+summarized as percentiles, and results are written as JSON together
+with the commit they were measured on, so that runs on different
+commits can be compared.
+"""
+
+from datetime import datetime, timezone
+import json
+import math
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import traceback
+
+def _peak_rss_mb(who):
+    rss = resource.getrusage(who).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in KB elsewhere.
+    if sys.platform == 'darwin':
+        return round(rss / (1 << 20), 1)
+    return round(rss / 1024, 1)
+
+def _run_child(queue, func, args):
+    try:
+        result = func(*args)
+        queue.put(('ok', result,
+                   _peak_rss_mb(resource.RUSAGE_SELF),
+                   _peak_rss_mb(resource.RUSAGE_CHILDREN)))
+    except BaseException:
+        queue.put(('error', traceback.format_exc(), 0, 0))
+
+def run_isolated(func, *args):
+    """Run func(*args) in a new process and return a dict with its result
+       and the peak RSS in MB of the process and of its own worker
+       processes. func must be defined at module level and return
+       something that can be pickled.
+    """
+    ctx = multiprocessing.get_context('spawn')
+    queue = ctx.Queue()
+    proc = ctx.Process(target=_run_child, args=(queue, func, args))
+    proc.start()
+    status, result, peak_rss, children_rss = queue.get()
+    proc.join()
+    if status != 'ok':
+        raise RuntimeError('benchmark stage failed:\n' + result)
+    return {'result': result,
+            'peak_rss_mb': peak_rss,
+            'workers_peak_rss_mb': children_rss}
+
+def percentile(ordered, q):
+    """Return the q-th percentile of a sorted list by the nearest-rank method."""
+    if not ordered:
+        return None
+    return ordered[max(0, math.ceil(q / 100 * len(ordered)) - 1)]
+
+def summarize(seconds):
+    """Summarize a list of latencies in seconds, reported in milliseconds."""
+    ordered = sorted(seconds)
+    def ms(value):
+        return round(1000 * value, 3) if value is not None else None
+    return {'count': len(ordered),
+            'mean_ms': ms(sum(ordered) / len(ordered)) if ordered else None,
+            'p50_ms': ms(percentile(ordered, 50)),
+            'p95_ms': ms(percentile(ordered, 95)),
+            'p99_ms': ms(percentile(ordered, 99)),
+            'max_ms': ms(ordered[-1]) if ordered else None}
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def environment():
+    """Describe where a benchmark was run."""
+    return {'commit': git_commit(),
+            'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count()}
+
+def write_results(benchmark, params, results, output=None):
+    """Print the results as JSON, and also write them to output if it is given."""
+    data = {'benchmark': benchmark,
+            'environment': environment(),
+            'params': params,
+            'results': results}
+    text = json.dumps(data, indent=2)
+    print(text)
+    if output:
+        with open(output, 'w', encoding='UTF-8') as fp:
+            fp.write(text + '\n')
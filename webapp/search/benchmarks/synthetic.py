@@ -0,0 +1,132 @@
+"""Generate synthetic input data with the same shape as the real dumps.
+The output is deterministic for a given seed and size.
+"""
+
+import json
+import random
+from xml.sax.saxutils import escape, quoteattr
+
+WORDS = ['National', 'Science', 'Foundation', 'Research', 'Council', 'Institute',
+         'University', 'Medical', 'Health', 'Energy', 'Agency', 'Society',
+         'Technology', 'Fund', 'Academy', 'Centre', 'Environmental', 'Trust',
+         'Ministry', 'Education', 'Forschungsgemeinschaft', 'Université',
+         'Nacional', 'Investigación', 'Stiftung', 'Fondation', 'Mathematics',
+         'Physics', 'Biology', 'Chemistry', 'Engineering', 'Ocean', 'Space']
+COUNTRIES = [('US', 'United States'), ('DE', 'Germany'), ('FR', 'France'),
+             ('GB', 'United Kingdom'), ('JP', 'Japan'), ('CN', 'China'),
+             ('BR', 'Brazil'), ('IN', 'India'), ('DK', 'Denmark'), ('ES', 'Spain')]
+ROR_TYPES = ['Education', 'Healthcare', 'Company', 'Archive', 'Nonprofit',
+             'Government', 'Facility', 'Other']
+
+RDF_COUNTRIES = ['usa', 'deu', 'fra', 'gbr', 'jpn', 'chn', 'bra', 'ind', 'dnk', 'esp']
+RDF_SUBTYPES = ['National government', 'Local government', 'Universities (academic only)',
+                'Research institutes and centers', 'For-profit companies (industry)',
+                'Trusts, charities, foundations (both public and private)',
+                'Associations and societies (private and public)']
+RDF_HEADER = """<?xml version="1.0" encoding="UTF-8"?>
+<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#"
+         xmlns:skos="http://www.w3.org/2004/02/skos/core#"
+         xmlns:skosxl="http://www.w3.org/2008/05/skos-xl#"
+         xmlns:svf="http://data.crossref.org/fundingdata/xml/schema/grant/grant-1.2/"
+         xmlns:schema="http://schema.org/"
+         xmlns:dct="http://purl.org/dc/terms/">
+"""
+FUNDREF_URI = 'http://dx.doi.org/10.13039/'
+
+def random_name(rng):
+    return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(2, 5)))
+
+def ror_id(num):
+    return '0{:08x}'.format(num)
+
+def ror_items(count, seed=1):
+    """Yield count organizations shaped like those in the ROR dump."""
+    rng = random.Random(seed)
+    for num in range(count):
+        name = random_name(rng)
+        country_code, country_name = rng.choice(COUNTRIES)
+        relationships = []
+        for _ in range(rng.choice([0, 0, 0, 1, 2, 5])):
+            other = rng.randrange(count)
+            relationships.append({'type': rng.choice(['Parent', 'Child', 'Related']),
+                                  'label': random_name(rng),
+                                  'id': 'https://ror.org/' + ror_id(other)})
+        external_ids = {'GRID': {'preferred': 'grid.{}.1'.format(num), 'all': 'grid.{}.1'.format(num)}}
+        if rng.random() < 0.1:
+            fundref = str(501100000000 + num)
+            external_ids['FundRef'] = {'preferred': fundref, 'all': [fundref]}
+        yield {'id': 'https://ror.org/' + ror_id(num),
+               'name': name,
+               'email_address': None,
+               'ip_addresses': [],
+               'established': rng.randint(1800, 2020),
+               'types': [rng.choice(ROR_TYPES)] if rng.random() < 0.95 else [],
+               'relationships': relationships,
+               'addresses': [{'lat': rng.uniform(-90, 90), 'lng': rng.uniform(-180, 180),
+                              'city': rng.choice(WORDS), 'geonames_city': None}],
+               'links': ['https://example.org/{}'.format(num)],
+               'aliases': [random_name(rng) for _ in range(rng.choice([0, 0, 1, 2]))],
+               'acronyms': [''.join(w[0] for w in name.split())] if rng.random() < 0.5 else [],
+               'status': 'active',
+               'wikipedia_url': '',
+               'labels': [{'label': random_name(rng), 'iso639': 'de'}] if rng.random() < 0.3 else [],
+               'country': {'country_name': country_name, 'country_code': country_code},
+               'external_ids': external_ids}
+
+def write_ror_dump(path, count, seed=1):
+    """Write a JSON array of count organizations to path, one per line like the real dump."""
+    with open(path, 'w', encoding='UTF-8') as fp:
+        fp.write('[')
+        for num, item in enumerate(ror_items(count, seed)):
+            if num:
+                fp.write(',\n')
+            json.dump(item, fp, ensure_ascii=False)
+        fp.write(']\n')
+
+def fundreg_id(num):
+    return str(501100000000 + num)
+
+def _rdf_label(tag, num, label_num, name):
+    return ('  <skosxl:{tag}>\n'
+            '    <skosxl:Label rdf:about="{uri}">\n'
+            '      <skosxl:literalForm xml:lang="en">{name}</skosxl:literalForm>\n'
+            '    </skosxl:Label>\n'
+            '  </skosxl:{tag}>\n').format(tag=tag,
+                                           uri='{}{}-label-{}'.format(FUNDREF_URI, fundreg_id(num), label_num),
+                                           name=escape(name))
+
+def rdf_concepts(count, seed=1):
+    """Yield count skos:Concept elements shaped like those in registry.rdf."""
+    rng = random.Random(seed)
+    for num in range(count):
+        name = random_name(rng)
+        if rng.random() < 0.05:
+            name += ' & ' + rng.choice(WORDS)
+        parts = ['<skos:Concept rdf:about={}>\n'.format(quoteattr(FUNDREF_URI + fundreg_id(num))),
+                 _rdf_label('prefLabel', num, 0, name)]
+        for label_num in range(rng.choice([0, 0, 1, 2, 3])):
+            parts.append(_rdf_label('altLabel', num, label_num + 1, random_name(rng)))
+        for _ in range(rng.choice([0, 0, 0, 1, 2])):
+            parts.append('  <skos:broader rdf:resource="{}{}"/>\n'.format(FUNDREF_URI, fundreg_id(rng.randrange(count))))
+        for _ in range(rng.choice([0, 0, 0, 1, 4])):
+            parts.append('  <skos:narrower rdf:resource="{}{}"/>\n'.format(FUNDREF_URI, fundreg_id(rng.randrange(count))))
+        parts.append('  <dct:created>2009-07-01T00:00:00.000000</dct:created>\n')
+        parts.append('  <svf:fundingBodyType>{}</svf:fundingBodyType>\n'.format(rng.choice(['gov', 'pri'])))
+        if rng.random() < 0.9:
+            parts.append('  <svf:fundingBodySubType>{}</svf:fundingBodySubType>\n'.format(escape(rng.choice(RDF_SUBTYPES))))
+        parts.append('  <svf:region>{}</svf:region>\n'.format(rng.choice(['Americas', 'Europe', 'Asia'])))
+        parts.append('  <schema:address>\n'
+                     '    <schema:postalAddress>\n'
+                     '      <schema:addressCountry>{}</schema:addressCountry>\n'
+                     '    </schema:postalAddress>\n'
+                     '  </schema:address>\n'.format(rng.choice(RDF_COUNTRIES)))
+        parts.append('</skos:Concept>\n')
+        yield ''.join(parts)
+
+def write_registry_rdf(path, count, seed=1):
+    """Write an RDF file with count concepts to path."""
+    with open(path, 'w', encoding='UTF-8') as fp:
+        fp.write(RDF_HEADER)
+        for concept in rdf_concepts(count, seed):
+            fp.write(concept)
+        fp.write('</rdf:RDF>\n')
@@ -0,0 +1,178 @@
+"""A bounded thread pool that runs identical concurrent calls only once.
+
+During bursts many requests arrive for the same query at the same
+time. CoalescingExecutor.submit() takes a key for the call, and if a
+call with the same key is already queued or running, the caller waits
+for that one instead of starting another. Each caller gets a Ticket.
+When every caller of a call that has not started yet gives up, the
+call is cancelled, so the pool does not work on queries that nobody
+is waiting for.
+
+The front end aborts stale fetches while the user types. A WSGI app is
+not told when that happens, so Ticket.wait() polls client_disconnected()
+while it waits. That needs the socket of the request, which gunicorn
+and the werkzeug development server put in the WSGI environ. Under
+other servers, requests simply run to completion.
+"""
+
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+import socket
+import threading
+
+# Default number of threads that run calls.
+MAX_WORKERS = 4
+# Default maximum number of distinct calls that are queued or running.
+MAX_PENDING = 256
+# Seconds between checks for a disconnected client while waiting.
+POLL_INTERVAL = 0.05
+
+class Overloaded(Exception):
+    """Raised by submit() when too many calls are pending."""
+
+class Cancelled(Exception):
+    """Raised by Ticket.wait() when the caller is no longer waiting."""
+
+class _Call:
+    __slots__ = ('future', 'waiters')
+
+class Ticket:
+    """A caller's claim on a call. Use wait() for the result, or cancel()
+       if the result is no longer wanted."""
+    def __init__(self, executor, key, call, coalesced):
+        self.executor = executor
+        self.key = key
+        self.call = call
+        self.coalesced = coalesced
+        self.done = False
+
+    def wait(self, is_cancelled=None, timeout=None, poll_interval=POLL_INTERVAL):
+        """Return the result of the call, or raise its exception.
+           args:
+              is_cancelled: function that returns True when the caller has
+                 gone away, such as client_disconnected(). It is called every
+                 poll_interval seconds.
+              timeout: give up after this many seconds
+           raises:
+              Cancelled if is_cancelled() returns True or the call was cancelled
+              concurrent.futures.TimeoutError if timeout expires
+        """
+        future = self.call.future
+        waited = 0.0
+        try:
+            while True:
+                interval = poll_interval if is_cancelled else timeout
+                if timeout is not None:
+                    interval = min(interval, timeout - waited)
+                try:
+                    result = future.result(interval)
+                    self._release(cancel=False)
+                    return result
+                except TimeoutError:
+                    waited += interval
+                    if timeout is not None and waited >= timeout:
+                        raise
+                    if is_cancelled():
+                        raise Cancelled()
+        except BaseException:
+            self.cancel()
+            if future.cancelled():
+                raise Cancelled()
+            raise
+
+    def cancel(self):
+        """Stop waiting. The call is cancelled if nobody else waits for it."""
+        self._release(cancel=True)
+
+    def _release(self, cancel):
+        if not self.done:
+            self.done = True
+            self.executor._release(self.key, self.call, cancel)
+
+class CoalescingExecutor:
+    """Runs calls in a bounded pool of threads, coalescing calls that have
+       the same key while they are queued or running.
+       args:
+          max_workers: number of threads
+          max_pending: maximum number of distinct calls queued or running
+    """
+    def __init__(self, max_workers=MAX_WORKERS, max_pending=MAX_PENDING):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self._pool = ThreadPoolExecutor(max_workers, thread_name_prefix='search')
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.submitted = 0
+        self.coalesced = 0
+        self.cancelled = 0
+        self.rejected = 0
+
+    def submit(self, key, func, *args, **kwargs):
+        """Return a Ticket for func(*args, **kwargs), which is only called
+           if no call with the same key is queued or running.
+           raises:
+              Overloaded if max_pending calls are already queued or running
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                call.waiters += 1
+                self.coalesced += 1
+                return Ticket(self, key, call, True)
+            if len(self._calls) >= self.max_pending:
+                self.rejected += 1
+                raise Overloaded()
+            call = _Call()
+            call.waiters = 1
+            call.future = self._pool.submit(func, *args, **kwargs)
+            self._calls[key] = call
+            self.submitted += 1
+        call.future.add_done_callback(lambda future: self._forget(key, call))
+        return Ticket(self, key, call, False)
+
+    def _forget(self, key, call):
+        # A later call with the same key must not be coalesced with a finished one.
+        with self._lock:
+            if self._calls.get(key) is call:
+                del self._calls[key]
+
+    def _release(self, key, call, cancel):
+        with self._lock:
+            call.waiters -= 1
+            if not cancel or call.waiters > 0:
+                return
+            # Nobody may join the call once we decide to cancel it.
+            if self._calls.get(key) is call:
+                del self._calls[key]
+        # cancel() runs the done callback, which takes the lock.
+        if call.future.cancel():
+            with self._lock:
+                self.cancelled += 1
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False)
+
+    def stats(self):
+        with self._lock:
+            return {'max_workers': self.max_workers,
+                    'pending': len(self._calls),
+                    'submitted': self.submitted,
+                    'coalesced': self.coalesced,
+                    'cancelled': self.cancelled,
+                    'rejected': self.rejected}
+
+def client_disconnected(environ):
+    """Return True if the client of a WSGI request has closed its connection.
+       This peeks at the socket without consuming any data. It returns False
+       when the server does not provide the socket."""
+    sock = environ.get('gunicorn.socket') or environ.get('werkzeug.socket')
+    if sock is None:
+        return False
+    try:
+        return sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT) == b''
+    except (BlockingIOError, InterruptedError):
+        return False
+    except ValueError:
+        # SSL sockets do not accept flags.
+        return False
+    except OSError:
+        return True
@@ -0,0 +1,61 @@
+"""Canonical country codes for filtering and facets.
+
+FundReg gives countries as lower case ISO 3166 alpha-3 codes such as
+deu, while ROR uses alpha-2 codes such as DE. The index stores one
+canonical code for each funder, the lower case alpha-3 code, so that a
+country filter matches funders from both sources. Filters may also
+name the country, as in "Germany". Free text, such as the locationq of a
+search, is only taken as a country if it is the whole name, since short
+words such as "in" or "no" are also codes.
+"""
+
+import json
+import os
+import threading
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+_lock = threading.Lock()
+_tables = None
+
+def _load():
+    global _tables
+    with _lock:
+        if _tables is None:
+            with open(os.path.join(DATA_DIR, 'country_map.json'), 'r', encoding='UTF-8') as fp:
+                names = json.load(fp)
+            with open(os.path.join(DATA_DIR, 'countries.json'), 'r', encoding='UTF-8') as fp:
+                countries = json.load(fp)
+            codes = {}
+            by_name = {}
+            for country in countries:
+                iso3 = country['iso3'].lower()
+                codes[country['iso2'].lower()] = iso3
+                by_name[country['name'].casefold()] = iso3
+            for iso3, name in names.items():
+                codes[iso3] = iso3
+                by_name[name.casefold()] = iso3
+            codes.update(by_name)
+            _tables = (codes, names, by_name)
+    return _tables
+
+def canonical_country(value):
+    """Return the lower case alpha-3 code for an alpha-2 or alpha-3 code or
+       the name of a country, or None if it is not recognized."""
+    if not value:
+        return None
+    codes, _, _ = _load()
+    return codes.get(' '.join(value.split()).casefold())
+
+def country_from_name(value):
+    """Return the lower case alpha-3 code for the name of a country, or None
+       if value is not the whole name of a country. Codes are not accepted."""
+    if not value:
+        return None
+    _, _, by_name = _load()
+    return by_name.get(' '.join(value.split()).casefold())
+
+def country_name(code):
+    """Return the name of a canonical country code."""
+    _, names, _ = _load()
+    return names.get(code, code)
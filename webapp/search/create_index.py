@@ -2,134 +2,276 @@
 
 """
 Main driver for the index build. Note that running this will not
-overwrite an existing index specified in args.dbpath. If you are
-replacing an existing database, then write it to a temporary location
-and then move the directory to the production directory.
+overwrite an existing index specified in args.dbpath. To replace an
+index that is in use by the web app, use --publish. This builds the
+index into a new generation directory next to args.dbpath and then
+atomically switches args.dbpath (a symbolic link) to it. Running
+workers pick up the new generation without a restart, and older
+generations are removed once no reader has them open (see
+generations.py).
 
 This is able to parse both crossref Funder registry and ROR data.
 
 """
 
 import argparse
+from collections import deque
+import itertools
 import json
-from naya import tokenize, stream_array
+import multiprocessing
 from pathlib import Path
 import os
-import requests
+import shutil
 import sys
+import tempfile
 import xapian
 from xml.etree import ElementTree as ET
-from zipfile import ZipFile
 
-from model import Funder, FunderList, RelationshipType, DataSource
-from rdf_parser import parse_rdf
-from search_lib import index_funder
+from fetch import fetch_fundreg, fetch_ror, FUNDREG_URL, ZENODO_URL, RDF_FILE, ROR_ZIP_FILE
+from generations import collect_garbage, is_managed, new_generation, publish
+from model import Funder, FunderList, RelationshipType, DataSource, VALIDATE_EVERY
+from rdf_parser import parse_rdf, rdf_names, iter_rdf
+from ror_parser import parse_ror, iter_ror_funders, open_ror_dump
+from snapshot import Snapshot, read_snapshot, write_snapshot
+from search_lib import (index_funder, funder_hash, get_edge_ngram_length, has_unique_ids,
+                        static_score, EDGE_NGRAM_KEY, EDGE_NGRAM_LENGTH, HASH_KEY_PREFIX,
+                        SearchPrefix)
+from hierarchy import HierarchyBuilder, HIERARCHY_FILE
+from merge import merge_funders
+from suggest import SuggestBuilder, SUGGEST_FILE
 
 assert sys.version_info >= (3,0)
 
-def create_index(dbpath, funderlist, verbose=False):
-    db = xapian.WritableDatabase(dbpath, xapian.DB_CREATE_OR_OPEN)
+# Number of funders in each shard of a parallel build.
+SHARD_SIZE = 10000
 
-    # Set up a TermGenerator that we'll use in indexing.
+def new_termgenerator(db):
+    """Set up a TermGenerator that we'll use in indexing."""
     termgenerator = xapian.TermGenerator()
     termgenerator.set_database(db)
     # use Porter's 2002 stemmer
     termgenerator.set_stemmer(xapian.Stem("english")) 
     termgenerator.set_flags(termgenerator.FLAG_SPELLING);
+    return termgenerator
+
+def index_funders(db, funders, edge_ngram_length=0):
+    """Index a sequence of funders into a WritableDatabase and return the count."""
+    termgenerator = new_termgenerator(db)
+    if edge_ngram_length:
+        db.set_metadata(EDGE_NGRAM_KEY, str(edge_ngram_length))
     count = 0
-    for funder in funderlist.funders.values():
-        narrower = {}
-        index_funder(funder, db, termgenerator)
+    for funder in funders:
+        index_funder(funder, db, termgenerator, edge_ngram_length)
         count += 1
         if count % 5000 == 0:
             print(f'{count} funders')
             db.commit()
     db.commit()
+    return count
+
+def create_index(dbpath, funders, verbose=False, jobs=1, edge_ngram_length=0):
+    """Build a new index at dbpath.
+       args:
+          funders: an iterable of Funder or FunderRecord. They are consumed
+             one at a time, so this may be a generator.
+          jobs: number of worker processes used to build the index
+          edge_ngram_length: index the prefixes of words in names up to
+             this length, for typeahead. 0 for none.
+    """
+    suggestions = SuggestBuilder(static_score)
+    hierarchy = HierarchyBuilder()
+    funders = hierarchy.observe(suggestions.observe(funders))
+    if jobs > 1:
+        count = create_index_parallel(dbpath, funders, jobs, verbose, edge_ngram_length)
+    else:
+        db = xapian.WritableDatabase(dbpath, xapian.DB_CREATE_OR_OPEN)
+        count = index_funders(db, funders, edge_ngram_length)
+        db.close()
     print(f'Indexed {count} documents')
+    write_suggestions(dbpath, suggestions)
+    write_hierarchy(dbpath, hierarchy)
 
-def fetch_fundreg():
-    print('fetching data/registry.rdf file...')
-    url = 'https://gitlab.com/crossref/open_funder_registry/-/raw/master/registry.rdf?inline=false'
-    response = requests.get(url)
-    rdf_file = Path('data/registry.rdf')
-    rdf_file.write_text(response.text, encoding='UTF-8')
-    print('updated registry.rdf file')
-
-def fetch_ror():
-    print('fetching ROR data')
-    response = requests.get('https://zenodo.org/api/records/?communities=ror-data&sort=mostrecent')
-    version_data = response.json().get('hits').get('hits')[0]
-    print(json.dumps(version_data, indent=2))
-    publication_date = version_data.get('metadata').get('publication_date')
-    print('ROR data from {}'.format(publication_date))
-    latest_url = version_data.get('files')[0].get('links').get('self')
-    print('fetching {}'.format(latest_url))
-    # latest_url should be a zip file.
-    with requests.get(latest_url, stream=True) as stream:
-        stream.raise_for_status()
-        with open('data/latest.ror.zip', 'wb') as f:
-            for chunk in stream.iter_content(chunk_size=8192):
-                f.write(chunk)
-    with ZipFile('data/latest.ror.zip', 'r') as zipObj:
-        filename = zipObj.infolist()[0].filename
-        zipObj.extractall()
-        os.rename(filename, 'data/raw_ror.json')
-
-def extract_ror_id(uri):
-    """Extract 0abcdefg12 from https://ror.org/0abcdefg12"""
-    return uri.split('/')[-1]
-
-def parse_ror(filename):
-    """Return a map from id to potential Funder from ROR."""
-    fp = open(filename, 'r')
-    funderslist = FunderList(funders={})
-    items = stream_array(tokenize(fp))
-    count = 0
-    for item in items:
-        count += 1
-        if count % 5000 == 0:
-            print('read {} ror entries'.format(count))
-        ror = item.get('id')
-        id = extract_ror_id(ror)
-        org = {'source_id': id,
-               'source': 'ror',
-               'name': item.get('name'),
-               'altnames': item.get('aliases'),
-               'country_code': item.get('country').get('country_code'),
-               'country': item.get('country').get('country_name'),
-               'children': [],
-               'parents': [],
-               'related': []
-               }
-        if len(item.get('types')) > 0:
-            org['funder_type'] = item.get('types')[0]
+def index_shard(task):
+    """Run in a worker process to index one batch of the funders."""
+    shard_path, funders, edge_ngram_length = task
+    db = xapian.WritableDatabase(shard_path, xapian.DB_CREATE_OR_OPEN)
+    count = index_funders(db, funders, edge_ngram_length)
+    db.close()
+    return count
+
+def create_index_parallel(dbpath, funders, jobs, verbose=False, edge_ngram_length=0):
+    """Index funders with jobs worker processes. The funders are split
+       into contiguous batches of SHARD_SIZE, and each batch is indexed
+       into its own shard. At most two batches per worker are outstanding,
+       so memory stays bounded when funders is a generator. The shards are
+       then compacted in order into dbpath. Compaction renumbers documents
+       so that each shard follows the previous one, so documents get the
+       same docids as they would from the serial build.
+    """
+    funders = iter(funders)
+    workdir = tempfile.mkdtemp(prefix='shards-', dir=os.path.dirname(os.path.abspath(dbpath)))
+    try:
+        shard_paths = []
+        counts = []
+        with multiprocessing.Pool(jobs) as pool:
+            pending = deque()
+            while True:
+                batch = list(itertools.islice(funders, SHARD_SIZE))
+                if batch:
+                    shard_path = os.path.join(workdir, 'shard{}'.format(len(shard_paths)))
+                    shard_paths.append(shard_path)
+                    pending.append(pool.apply_async(index_shard, ((shard_path, batch, edge_ngram_length),)))
+                if pending and (not batch or len(pending) >= 2 * jobs):
+                    counts.append(pending.popleft().get())
+                if not batch and not pending:
+                    break
+        if verbose:
+            print('compacting {} shards with {} documents'.format(len(shard_paths), counts))
+        if os.path.isdir(dbpath):
+            # An empty generation directory from new_generation().
+            os.rmdir(dbpath)
+        if not shard_paths:
+            xapian.WritableDatabase(dbpath, xapian.DB_CREATE_OR_OPEN).close()
+            return 0
+        combined = xapian.Database()
+        for shard_path in shard_paths:
+            combined.add_database(xapian.Database(shard_path))
+        combined.compact(dbpath)
+        combined.close()
+        return sum(counts)
+    finally:
+        shutil.rmtree(workdir)
+
+def write_suggestions(dbpath, suggestions):
+    """Write the prefix completion data used by /suggest next to the index."""
+    path = os.path.join(dbpath, SUGGEST_FILE)
+    suggestions.write(path)
+    print('wrote {}'.format(path))
+
+def write_hierarchy(dbpath, hierarchy):
+    """Write the graph of related funders used by /hierarchy next to the index."""
+    path = os.path.join(dbpath, HIERARCHY_FILE)
+    hierarchy.write(path)
+    print('wrote {}'.format(path))
+
+def update_index(dbpath, funders, verbose=False):
+    """Apply the differences between funders and the existing index at
+       dbpath. Funders are compared by the content hash stored by
+       index_funder(), so only added and changed funders are reindexed
+       and funders that are no longer present are deleted. Edge n-grams
+       are indexed if the existing index has them.
+       args:
+          funders: an iterable of Funder or FunderRecord
+       returns:
+          a dict with counts of added, changed, removed, and unchanged funders.
+    """
+    db = xapian.WritableDatabase(dbpath, xapian.DB_OPEN)
+    termgenerator = new_termgenerator(db)
+    edge_ngram_length = get_edge_ngram_length(db)
+    old_hashes = {}
+    for key in db.metadata_keys(HASH_KEY_PREFIX):
+        key = key.decode('utf-8')
+        old_hashes[key[len(HASH_KEY_PREFIX):]] = db.get_metadata(key).decode('utf-8')
+    counts = {'added': 0, 'changed': 0, 'removed': 0, 'unchanged': 0}
+    # Indexes before INDEX_FORMAT 6 only mark each document with its global
+    # ID as an unprefixed term, so their documents are deleted by that term
+    # rather than replaced. The new INDEX_FORMAT changes every hash, so each
+    # of them is reindexed or removed here.
+    legacy = db.get_doccount() and not has_unique_ids(db)
+    suggestions = SuggestBuilder(static_score)
+    hierarchy = HierarchyBuilder()
+    for funder in hierarchy.observe(suggestions.observe(funders)):
+        old_hash = old_hashes.pop(funder.global_id(), None)
+        if old_hash == funder_hash(funder):
+            counts['unchanged'] += 1
+            continue
+        if legacy and old_hash is not None:
+            db.delete_document(funder.global_id())
+        index_funder(funder, db, termgenerator, edge_ngram_length)
+        if old_hash is None:
+            counts['added'] += 1
+        else:
+            counts['changed'] += 1
+        if verbose:
+            print('{} {}'.format('added' if old_hash is None else 'changed', funder.global_id()))
+    for docid in old_hashes:
+        db.delete_document(docid if legacy else SearchPrefix.UNIQUE_ID.value + docid)
+        db.set_metadata(HASH_KEY_PREFIX + docid, '')
+        counts['removed'] += 1
+        if verbose:
+            print('removed {}'.format(docid))
+    db.commit()
+    write_suggestions(dbpath, suggestions)
+    write_hierarchy(dbpath, hierarchy)
+    print('Added {added}, changed {changed}, removed {removed}, unchanged {unchanged} documents'.format(**counts))
+    return counts
+
+def stream_funders(args, country_map, funders_file, ror_file, raw_ror_file,
+                   use_fundreg_cache, use_ror_cache):
+    """Yield every funder to be indexed without building a FunderList.
+       Relationship names for FundReg come from a table of names that is
+       read in a first pass over the RDF, and --defer_to_fundreg only
+       needs the set of FundReg IDs. Only one funder record is held at a
+       time, but the table of names, the set of IDs, and the suggestion
+       and hierarchy data that create_index() collects still grow with
+       the number of funders, so this saves memory rather than bounding
+       it. No caches are written in this mode.
+    """
+    fundreg_ids = set()
+    if args.include_fundreg:
+        if use_fundreg_cache and funders_file.exists():
+            with Snapshot(funders_file) as snapshot:
+                fundreg_ids = set(snapshot.global_ids())
+                yield from snapshot.iter_records()
+        elif use_fundreg_cache:
+            funderlist = read_cache(funders_file)
+            fundreg_ids = set(funderlist.funders)
+            yield from funderlist.funders.values()
+        else:
+            print('reading names from data/registry.rdf...')
+            names = rdf_names(country_map)
+            fundreg_ids = set(names)
+            print('streaming data/registry.rdf...')
+            yield from iter_rdf(country_map, names, validate_every=args.validate_every)
+    if args.include_ror:
+        if use_ror_cache and ror_file.exists():
+            snapshot = Snapshot(ror_file)
+            ror_funders = snapshot.iter_records()
+        elif use_ror_cache:
+            snapshot = None
+            ror_funders = read_cache(ror_file).funders.values()
         else:
-            org['funder_type'] = 'Other' 
-        org['altnames'].extend(item.get('acronyms'))
-        org['altnames'].extend([l['label'] for l in item.get('labels')])
-        external_ids = item.get('external_ids')
-        if external_ids:
-            fundref = external_ids.get('FundRef')
-            if fundref:
-                preferred = fundref.get('preferred')
-                if preferred:
-                    org['preferred_fundref'] = preferred
-        for rel in item['relationships']:
-            if rel['type'] == RelationshipType.RELATED.value:
-                org['related'].append({'source': DataSource.ROR.value,
-                                       'source_id': extract_ror_id(rel['id']),
-                                       'name': rel['label']})
-            elif rel['type'] == RelationshipType.CHILD:
-                org['children'].append({'source': DataSource.ROR.value,
-                                       'source_id': extract_ror_id(rel['id']),
-                                       'name': rel['label']})
-            elif rel['type'] == RelationshipType.PARENT:
-                org['parents'].append({'source': DataSource.ROR.value,
-                                       'source_id': extract_ror_id(rel['id']),
-                                       'name': rel['label']})
-        funder = Funder(**org)
-        funderslist.funders[funder.global_id()] = funder
-    return funderslist
+            snapshot = open_ror_dump(raw_ror_file)
+            print('streaming {}...'.format(raw_ror_file))
+            ror_funders = iter_ror_funders(snapshot, args.validate_every)
+        try:
+            for funder in ror_funders:
+                if args.defer_to_fundreg and funder.preferred_fundref:
+                    preferred_fundreg = '{}_{}'.format(DataSource.FUNDREG.value, funder.preferred_fundref)
+                    if preferred_fundreg in fundreg_ids:
+                        continue
+                yield funder
+        finally:
+            if snapshot:
+                snapshot.close()
+
+def read_cache(snapshot_file):
+    """Read a cache of parsed funders. Caches written before snapshots were
+       introduced are JSON files with the same name and a .json suffix.
+    """
+    if snapshot_file.exists():
+        print('reading {}'.format(snapshot_file))
+        return read_snapshot(snapshot_file)
+    json_file = snapshot_file.with_suffix('.json')
+    print('reading {}'.format(json_file))
+    return FunderList.parse_raw(json_file.read_text(encoding='UTF-8'))
+
+def cache_is_current(snapshot_file, source_file):
+    """Return True if snapshot_file was written after source_file changed.
+       --stream does not write caches, so a cache may be older than the
+       dump that was fetched by an earlier run."""
+    return (snapshot_file.exists() and Path(source_file).exists() and
+            snapshot_file.stat().st_mtime >= Path(source_file).stat().st_mtime)
 
 if __name__ == '__main__':
     arguments = argparse.ArgumentParser()
@@ -148,6 +290,12 @@ if __name__ == '__main__':
     arguments.add_argument('--fetch_ror',
                            action='store_true',
                            help='Whether to refetch the json file for ROR')
+    arguments.add_argument('--fundreg_url',
+                           default=FUNDREG_URL,
+                           help='URL to fetch registry.rdf from')
+    arguments.add_argument('--ror_api_url',
+                           default=ZENODO_URL,
+                           help='Zenodo API URL listing ROR releases')
     arguments.add_argument('--dbpath',
                            default='xapian.db',
                            help='Path to writable database directory.')
@@ -157,55 +305,122 @@ if __name__ == '__main__':
     arguments.add_argument('--defer_to_fundreg',
                            action='store_true',
                            help='Whether to replace ROR IDs by related fundreg ID')
+    arguments.add_argument('--merge',
+                           action='store_true',
+                           help='Merge ROR records into the FundReg funders that they duplicate')
+    arguments.add_argument('--publish',
+                           action='store_true',
+                           help='Build a new generation and switch dbpath to it')
+    arguments.add_argument('--delta',
+                           action='store_true',
+                           help='Update the existing index at dbpath with only the changed funders')
+    arguments.add_argument('--jobs',
+                           type=int,
+                           default=1,
+                           help='Number of processes used to build the index')
+    arguments.add_argument('--validate_every',
+                           type=int,
+                           default=VALIDATE_EVERY,
+                           help='Validate one parsed record in this many as a Funder (0 for none)')
+    arguments.add_argument('--edge_ngrams',
+                           action='store_true',
+                           help='Index word prefixes so that typeahead queries need no wildcards')
+    arguments.add_argument('--stream',
+                           action='store_true',
+                           help='Index records as they are parsed, without writing caches')
     args = arguments.parse_args()
     funders = {}
     outdated = []
-    funders_file = Path('data/registry.json')
-    ror_file = Path('data/ror.json')
-    raw_ror_file = Path('data/raw_ror.json')
+    funders_file = Path('data/registry.snap')
+    ror_file = Path('data/ror.snap')
+    # Older checkouts have the dump extracted from the zip file.
+    raw_ror_file = ROR_ZIP_FILE if ROR_ZIP_FILE.exists() else Path('data/raw_ror.json')
     country_map = json.loads(open('data/country_map.json', 'r').read())
     funderlist = FunderList(funders={})
-    if os.path.isfile(args.dbpath) or os.path.isdir(args.dbpath):
+    if args.delta:
+        if args.publish:
+            print('--delta updates the live index in place and cannot be used with --publish')
+            sys.exit(2)
+        if not os.path.exists(args.dbpath):
+            print('--delta requires an existing index at dbpath')
+            sys.exit(2)
+    elif args.publish:
+        if os.path.exists(args.dbpath) and not is_managed(args.dbpath):
+            print('CANNOT PUBLISH: dbpath exists and is not a link to a generation')
+            sys.exit(2)
+    elif os.path.isfile(args.dbpath) or os.path.isdir(args.dbpath):
         print('CANNOT OVERWRITE dbpath')
         sys.exit(2)
     if not args.include_fundreg and not args.include_ror:
         print('To build an index, you need either --include_fundreg and/or --include_ror')
         sys.exit(3)
+    if args.merge and args.stream:
+        # FundReg funders are indexed before the ROR records that would be merged into them.
+        print('--merge needs every funder in memory and cannot be used with --stream')
+        sys.exit(2)
+    # A source that was fetched and has not changed is read from its
+    # cache instead of being parsed again.
+    use_fundreg_cache = args.use_cache
+    use_ror_cache = args.use_cache
     if args.fetch_fundreg:
         print('updating fundref.rdf...')
-        fetch_fundreg()
+        if not fetch_fundreg(args.fundreg_url) and cache_is_current(funders_file, RDF_FILE):
+            use_fundreg_cache = True
     if args.fetch_ror:
         print('fetching ror data...')
-        fetch_ror()
-    if args.include_fundreg:
-        if args.use_cache:
-            print('reading {}'.format(funders_file.name))
-            funderlist = FunderList.parse_raw(funders_file.read_text(encoding='UTF-8'))
-        else:
-            print('parsing data/registryrdf for fundreg...')
-            funderlist = parse_rdf(country_map)
-            funders_file.write_text(funderlist.json(indent=2), encoding='UTF-8')
-    if args.include_ror:
-        ror_funders = FunderList(funders={})
-        if args.use_cache:
-            print('reading {}'.format(ror_file.name))
-            ror_funders = FunderList.parse_raw(ror_file.read_text(encoding='UTF-8'))
-        else:
-            print('parsing data/raw_ror.json...this is slow to parse 112000 entries...')
-            ror_funders = parse_ror('data/raw_ror.json')
-            print('saving cache in data/ror.json')
-            ror_file.write_text(ror_funders.json(indent=2), encoding='UTF-8')
-        # For now simply add them without merging.
-        for key, value in ror_funders.funders.items():
-            if args.defer_to_fundreg and value.preferred_fundref:
-                preferred_fundreg = '{}_{}'.format(DataSource.FUNDREG.value, value.preferred_fundref)
-                preferred_fundreg = funderlist.funders.get(preferred_fundreg)
-                if not preferred_fundreg: # unlikely
-                    funderlist.funders[key] = value
+        if not fetch_ror(args.ror_api_url) and cache_is_current(ror_file, ROR_ZIP_FILE):
+            use_ror_cache = True
+        raw_ror_file = ROR_ZIP_FILE
+    if args.stream:
+        funders = stream_funders(args, country_map, funders_file, ror_file, raw_ror_file,
+                                 use_fundreg_cache, use_ror_cache)
+    else:
+        if args.include_fundreg:
+            if use_fundreg_cache:
+                funderlist = read_cache(funders_file)
             else:
-                funderlist.funders[key] = value
+                print('parsing data/registryrdf for fundreg...')
+                funderlist = parse_rdf(country_map, args.validate_every)
+                write_snapshot(funderlist, funders_file)
+        if args.include_ror:
+            ror_funders = FunderList(funders={})
+            if use_ror_cache:
+                ror_funders = read_cache(ror_file)
+            else:
+                print('parsing {}...'.format(raw_ror_file))
+                ror_funders = parse_ror(raw_ror_file, args.validate_every)
+                print('saving cache in {}'.format(ror_file))
+                write_snapshot(ror_funders, ror_file)
+            if args.merge:
+                merged, report = merge_funders(funderlist.funders, ror_funders.funders)
+                print('merged {by_fundref} ROR records by preferred_fundref and {by_name} by name, '
+                      '{ambiguous} ambiguous, {missing_fundref} with an unknown preferred_fundref, '
+                      '{remapped_relationships} relationships remapped, '
+                      '{documents} documents'.format(**report))
+                funderlist = FunderList.construct(funders=merged)
+            else:
+                # Without --merge simply add them.
+                for key, value in ror_funders.funders.items():
+                    if args.defer_to_fundreg and value.preferred_fundref:
+                        preferred_fundreg = '{}_{}'.format(DataSource.FUNDREG.value, value.preferred_fundref)
+                        preferred_fundreg = funderlist.funders.get(preferred_fundreg)
+                        if not preferred_fundreg: # unlikely
+                            funderlist.funders[key] = value
+                    else:
+                        funderlist.funders[key] = value
+        funders = funderlist.funders.values()
 
     if args.verbose:
         print('creating index')
-    create_index(args.dbpath, funderlist, args.verbose)
-
+    edge_ngram_length = EDGE_NGRAM_LENGTH if args.edge_ngrams else 0
+    if args.delta:
+        update_index(args.dbpath, funders, args.verbose)
+    elif args.publish:
+        gen_dir = new_generation(args.dbpath)
+        create_index(str(gen_dir), funders, args.verbose, args.jobs, edge_ngram_length)
+        publish(args.dbpath, gen_dir)
+        print('published {} as {}'.format(gen_dir, args.dbpath))
+        for old_dir in collect_garbage(args.dbpath):
+            print('removed old generation {}'.format(old_dir))
+    else:
+        create_index(args.dbpath, funders, args.verbose, args.jobs, edge_ngram_length)
@@ -0,0 +1,228 @@
+"""A pool of open xapian databases and query parsers used by search_lib.
+
+Opening a xapian.Database and configuring a QueryParser costs more
+than most of the queries that the typeahead UI sends, so each worker
+process keeps a few open handles per db_path and hands them out to
+one thread at a time. A xapian.Database is not safe to share between
+threads, and neither is a QueryParser since it remembers the spelling
+correction of the last query, so a handle is never used concurrently.
+
+Idle handles periodically call reopen() so that they pick up new
+revisions of the index. If db_path is a link managed by generations.py,
+then the pool also notices when the link points at a new generation.
+Idle handles on the old generation are closed right away, and handles
+that are in use are closed when they are returned, so queries that are
+already running are not interrupted.
+"""
+
+from contextlib import contextmanager
+import threading
+import time
+import xapian
+try:
+    from .generations import ReaderLock, resolve_generation
+except ImportError: # imported from the search directory by create_index.py
+    from generations import ReaderLock, resolve_generation
+
+# Minimum number of seconds between checks for a new revision of the index.
+REOPEN_INTERVAL = 2.0
+# Maximum number of idle handles that are kept open for each db_path.
+MAX_IDLE = 8
+
+class SearchHandle:
+    """An open database together with a QueryParser configured on it.
+       args:
+          generation: resolved directory of the database
+          setup: function called with the new QueryParser to configure it
+    """
+    def __init__(self, generation, setup=None):
+        self.generation = generation
+        self.reader_lock = ReaderLock(generation)
+        try:
+            self.db = xapian.Database(generation)
+        except Exception:
+            self.reader_lock.release()
+            raise
+        self.queryparser = xapian.QueryParser()
+        self.queryparser.set_database(self.db)
+        if setup:
+            setup(self.queryparser)
+        # Facts about the database cached by the caller, such as its metadata.
+        self.info = {}
+        self.checked = time.monotonic()
+
+    def close(self):
+        self.db.close()
+        self.reader_lock.release()
+
+class DatabasePool:
+    """Thread-safe pool of SearchHandle objects for a single db_path.
+       args:
+          db_path: path to the xapian database
+          setup: function called with each new QueryParser to configure it
+          max_idle: maximum number of idle handles to keep open
+          reopen_interval: seconds between checks for a new revision
+    """
+    def __init__(self, db_path, setup=None, max_idle=MAX_IDLE, reopen_interval=REOPEN_INTERVAL):
+        self.db_path = db_path
+        self.setup = setup
+        self.max_idle = max_idle
+        self.reopen_interval = reopen_interval
+        self._lock = threading.Lock()
+        self._idle = []
+        self.generation = resolve_generation(db_path)
+        self._listeners = []
+        self.in_use = 0
+        self.opened = 0
+        self.closed = 0
+        self.reopens = 0
+        self.swaps = 0
+        # Incremented whenever the index that we serve may have changed.
+        self.epoch = 0
+        self._revision_checked = time.monotonic()
+
+    @contextmanager
+    def handle(self):
+        """Context manager that checks out a SearchHandle. If the body
+           raises an exception then the handle is discarded rather than
+           returned to the pool, since it may be in a bad state.
+        """
+        handle = self._checkout()
+        ok = False
+        try:
+            yield handle
+            ok = True
+        finally:
+            self._checkin(handle, ok)
+
+    def _checkout(self):
+        self._check_generation()
+        with self._lock:
+            handle = self._idle.pop() if self._idle else None
+            self.in_use += 1
+            generation = self.generation
+        try:
+            if handle is None:
+                try:
+                    handle = SearchHandle(generation, self.setup)
+                except FileNotFoundError:
+                    # The generation was removed after we resolved it.
+                    self._check_generation(force=True)
+                    handle = SearchHandle(self.generation, self.setup)
+                with self._lock:
+                    self.opened += 1
+            else:
+                self._refresh(handle)
+        except Exception:
+            with self._lock:
+                self.in_use -= 1
+            raise
+        return handle
+
+    def _check_generation(self, force=False):
+        """Check whether db_path now resolves to a different generation.
+           The generation is shared with the files loaded by generations.py,
+           so suggestions and hierarchies match the database."""
+        generation = resolve_generation(self.db_path, force, self.reopen_interval)
+        with self._lock:
+            if generation == self.generation:
+                return
+            self.generation = generation
+            self.swaps += 1
+            self.epoch += 1
+            listeners = list(self._listeners)
+        self.clear()
+        for listener in listeners:
+            listener(generation)
+
+    def add_listener(self, listener):
+        """Call listener with the new generation whenever the pool moves to
+           one. It is called in the thread that noticed the change, so it
+           should return quickly."""
+        with self._lock:
+            if listener not in self._listeners:
+                self._listeners.append(listener)
+
+    def refresh_generation(self):
+        """Resolve db_path now, switching to a new generation if it has
+           changed, and return the generation that the pool serves."""
+        self._check_generation(force=True)
+        with self._lock:
+            return self.generation
+
+    def _refresh(self, handle):
+        """Call reopen() if we have not checked for a new revision recently."""
+        now = time.monotonic()
+        if now - handle.checked < self.reopen_interval:
+            return
+        handle.checked = now
+        if handle.db.reopen():
+            with self._lock:
+                self.reopens += 1
+                self.epoch += 1
+
+    def token(self):
+        """Return a value that changes whenever the index that this pool
+           serves may have changed. This is used to invalidate cached
+           results, so it also checks for a new revision periodically even
+           if every query is answered from a cache.
+        """
+        self._check_generation()
+        now = time.monotonic()
+        if now - self._revision_checked >= self.reopen_interval:
+            self._revision_checked = now
+            with self.handle():
+                pass # checking out a handle calls reopen() if it is due.
+        with self._lock:
+            return (self.generation, self.epoch)
+
+    def _checkin(self, handle, ok):
+        with self._lock:
+            self.in_use -= 1
+            current = handle.generation == self.generation
+            if ok and current and len(self._idle) < self.max_idle:
+                self._idle.append(handle)
+                return
+            self.closed += 1
+        handle.close()
+
+    def clear(self):
+        """Close all idle handles. Handles in use are closed when they are
+           returned if they are not on the current generation.
+        """
+        with self._lock:
+            idle = self._idle
+            self._idle = []
+            self.closed += len(idle)
+        for handle in idle:
+            handle.close()
+
+    def stats(self):
+        with self._lock:
+            return {'generation': self.generation,
+                    'idle': len(self._idle),
+                    'in_use': self.in_use,
+                    'size': len(self._idle) + self.in_use,
+                    'opened': self.opened,
+                    'closed': self.closed,
+                    'reopens': self.reopens,
+                    'swaps': self.swaps,
+                    'epoch': self.epoch}
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_pool(db_path, setup=None):
+    """Return the process-wide DatabasePool for db_path, creating it if needed."""
+    with _pools_lock:
+        pool = _pools.get(db_path)
+        if pool is None:
+            pool = DatabasePool(db_path, setup)
+            _pools[db_path] = pool
+        return pool
+
+def pool_stats():
+    """Return a dict from db_path to the stats of its pool."""
+    with _pools_lock:
+        pools = list(_pools.values())
+    return {pool.db_path: pool.stats() for pool in pools}
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+
+"""
+Download of the FundReg and ROR dumps. Responses are streamed to a
+temporary file next to the destination and renamed into place, so
+memory use does not depend on the size of the dump and a failed
+download never leaves a partial file behind.
+
+Each downloaded file has a sidecar file with a .fetch.json suffix that
+records the ETag and Last-Modified headers of the response, and for
+ROR the Zenodo record that it came from. The next fetch sends them as
+If-None-Match and If-Modified-Since, and skips the download if the
+server answers 304 Not Modified. ROR is checked against the latest
+Zenodo record first, so an unchanged release costs one small API call.
+
+The ROR zip file is kept as it is downloaded, and
+ror_parser.open_ror_dump() reads the JSON member directly out of it
+without extracting it.
+
+The URLs are arguments so that this can be run against a local
+HTTP server instead of the real services. requests is only imported
+when something is fetched, since create_index.py imports this module
+on every run.
+"""
+
+import argparse
+import json
+import os
+from pathlib import Path
+
+FUNDREG_URL = 'https://gitlab.com/crossref/open_funder_registry/-/raw/master/registry.rdf?inline=false'
+ZENODO_URL = 'https://zenodo.org/api/records/?communities=ror-data&sort=mostrecent'
+RDF_FILE = Path('data/registry.rdf')
+ROR_ZIP_FILE = Path('data/latest.ror.zip')
+META_SUFFIX = '.fetch.json'
+# Number of bytes written to disk at a time.
+CHUNK_SIZE = 1 << 20
+TIMEOUT = 60
+
+def meta_path(path):
+    """Return the sidecar file that records how path was fetched."""
+    return Path(str(path) + META_SUFFIX)
+
+def read_meta(path):
+    """Return the fetch metadata for path, or an empty dict if path or
+       its metadata are missing."""
+    try:
+        if Path(path).exists():
+            return json.loads(meta_path(path).read_text(encoding='UTF-8'))
+    except (OSError, ValueError):
+        pass
+    return {}
+
+def write_meta(path, meta):
+    target = meta_path(path)
+    tmp_path = '{}.tmp-{}'.format(target, os.getpid())
+    with open(tmp_path, 'w', encoding='UTF-8') as fp:
+        json.dump(meta, fp, indent=2)
+    os.replace(tmp_path, target)
+
+def _session(session):
+    """Return session, or the requests module if it is None."""
+    if session is None:
+        import requests
+        session = requests
+    return session
+
+def fetch_file(url, path, extra_meta=None, session=None):
+    """Download url to path unless the server reports that it has not
+       changed since the last download.
+       args:
+          extra_meta: a dict stored with the ETag and Last-Modified values
+          session: a requests.Session, or None for the requests module
+       returns:
+          True if path was downloaded, and False if it was unchanged.
+    """
+    path = Path(path)
+    meta = read_meta(path)
+    headers = {}
+    if meta.get('url') == url:
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+    tmp_path = path.with_name('{}.tmp-{}'.format(path.name, os.getpid()))
+    with _session(session).get(url, headers=headers, stream=True, timeout=TIMEOUT) as response:
+        if response.status_code == 304:
+            print('{} is unchanged'.format(path))
+            return False
+        response.raise_for_status()
+        try:
+            with open(tmp_path, 'wb') as fp:
+                for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                    fp.write(chunk)
+            os.replace(tmp_path, path)
+        finally:
+            if tmp_path.exists():
+                tmp_path.unlink()
+        meta = {'url': url,
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified')}
+    if extra_meta:
+        meta.update(extra_meta)
+    write_meta(path, meta)
+    print('updated {}'.format(path))
+    return True
+
+def fetch_fundreg(url=FUNDREG_URL, path=RDF_FILE, session=None):
+    """Fetch registry.rdf. Returns True if it changed."""
+    print('fetching {}...'.format(path))
+    return fetch_file(url, path, session=session)
+
+def latest_ror_release(api_url=ZENODO_URL, session=None):
+    """Return the id, version, and download URL of the latest ROR release on Zenodo."""
+    response = _session(session).get(api_url, timeout=TIMEOUT)
+    response.raise_for_status()
+    version_data = response.json().get('hits').get('hits')[0]
+    metadata = version_data.get('metadata', {})
+    print('ROR data from {}'.format(metadata.get('publication_date')))
+    # latest_url should be a zip file.
+    latest_url = version_data.get('files')[0].get('links').get('self')
+    return {'record_id': str(version_data.get('id')),
+            'version': metadata.get('version'),
+            'download_url': latest_url}
+
+def fetch_ror(api_url=ZENODO_URL, path=ROR_ZIP_FILE, session=None):
+    """Fetch the zip file of the latest ROR release unless we already
+       have it. Returns True if it changed."""
+    print('fetching ROR data')
+    release = latest_ror_release(api_url, session)
+    meta = read_meta(path)
+    if meta.get('record_id') == release['record_id'] and meta.get('url') == release['download_url']:
+        print('ROR release {} is unchanged'.format(release['version']))
+        return False
+    print('fetching {}'.format(release['download_url']))
+    return fetch_file(release['download_url'], path,
+                      extra_meta={'record_id': release['record_id'],
+                                  'version': release['version']},
+                      session=session)
+
+if __name__ == '__main__':
+    arguments = argparse.ArgumentParser()
+    arguments.add_argument('--fundreg_url',
+                           default=FUNDREG_URL,
+                           help='URL of registry.rdf')
+    arguments.add_argument('--ror_api_url',
+                           default=ZENODO_URL,
+                           help='Zenodo API URL listing ROR releases')
+    arguments.add_argument('--skip_fundreg',
+                           action='store_true',
+                           help='Do not fetch registry.rdf')
+    arguments.add_argument('--skip_ror',
+                           action='store_true',
+                           help='Do not fetch ROR data')
+    args = arguments.parse_args()
+    if not args.skip_fundreg:
+        fetch_fundreg(args.fundreg_url)
+    if not args.skip_ror:
+        fetch_ror(args.ror_api_url)
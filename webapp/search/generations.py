@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+
+"""
+Management of index generations so that a new index can be published
+while the web app is serving queries from the old one.
+
+A managed dbpath such as xapian.db is a symbolic link to a generation
+directory inside xapian.db.generations/. A new index is built into a
+fresh generation directory, and publish() atomically replaces the
+symbolic link to point at it. Readers notice the new target of the
+link (see db_pool.py) and open the new generation, while queries
+that are already running finish on the old one.
+
+Every reader holds a shared flock() on the .readers.lock file of the
+generation that it has open. An old generation is only removed by
+collect_garbage() when it can take an exclusive lock on that file,
+which means that no process has it open.
+
+Within a process, resolve_generation() resolves the link at most once
+every RESOLVE_INTERVAL seconds and shares the result, so the database
+pool and the files that are loaded with GenerationFile, such as
+suggest.json and hierarchy.json, move to a new generation together.
+"""
+
+import argparse
+import fcntl
+import os
+from pathlib import Path
+import re
+import shutil
+import sys
+import threading
+import time
+
+GENERATIONS_SUFFIX = '.generations'
+READERS_LOCK = '.readers.lock'
+GENERATION_PATTERN = re.compile(r'^gen-(\d+)$')
+# Minimum number of seconds between checks for a new generation.
+RESOLVE_INTERVAL = 2.0
+
+def generations_dir(dbpath):
+    """Return the directory holding all generations of dbpath."""
+    return Path(str(dbpath) + GENERATIONS_SUFFIX)
+
+def is_managed(dbpath):
+    """Return True if dbpath is a link to a generation."""
+    return os.path.islink(dbpath)
+
+def current_generation(dbpath):
+    """Return the resolved directory that dbpath currently refers to."""
+    return os.path.realpath(dbpath)
+
+_resolved = {}
+_resolved_lock = threading.Lock()
+
+def resolve_generation(dbpath, force=False, interval=RESOLVE_INTERVAL):
+    """Return the generation that this process reads dbpath from. The link
+       is only resolved again after interval seconds, or right away if
+       force is True, and the result is shared by every reader of dbpath.
+    """
+    now = time.monotonic()
+    with _resolved_lock:
+        cached = _resolved.get(dbpath)
+        if cached and not force and now - cached[0] < interval:
+            return cached[1]
+    generation = current_generation(dbpath)
+    with _resolved_lock:
+        _resolved[dbpath] = (now, generation)
+    return generation
+
+class GenerationFile:
+    """A file that create_index.py writes inside the database directory,
+       loaded for the generation returned by resolve_generation(). It is
+       loaded again when the generation changes, or when the file itself
+       changes, which is checked at most once every RESOLVE_INTERVAL
+       seconds.
+       args:
+          name: name of the file inside the database directory
+          load: function called with the path of the file that returns
+             the loaded object
+    """
+    def __init__(self, name, load):
+        self.name = name
+        self.load = load
+        self._lock = threading.Lock()
+        self._loaded = {}
+
+    def get(self, dbpath):
+        """Return the loaded file for the current generation of dbpath.
+           Raises OSError if the file does not exist."""
+        generation = resolve_generation(dbpath)
+        now = time.monotonic()
+        with self._lock:
+            cached = self._loaded.get(dbpath)
+        if cached and cached[1] == generation and now - cached[0] < RESOLVE_INTERVAL:
+            return cached[3]
+        path = os.path.join(generation, self.name)
+        stat = os.stat(path)
+        key = (stat.st_mtime_ns, stat.st_size)
+        if cached and cached[1] == generation and cached[2] == key:
+            loaded = cached[3]
+        else:
+            loaded = self.load(path)
+        with self._lock:
+            self._loaded[dbpath] = (now, generation, key, loaded)
+        return loaded
+
+def list_generations(dbpath):
+    """Return the generation directories of dbpath, oldest first."""
+    root = generations_dir(dbpath)
+    if not root.is_dir():
+        return []
+    gens = []
+    for child in root.iterdir():
+        m = GENERATION_PATTERN.match(child.name)
+        if m and child.is_dir():
+            gens.append((int(m.group(1)), child))
+    return [child for _, child in sorted(gens)]
+
+def new_generation(dbpath):
+    """Create and return an empty directory for the next generation."""
+    root = generations_dir(dbpath)
+    root.mkdir(exist_ok=True)
+    gens = list_generations(dbpath)
+    number = 1
+    if gens:
+        number = int(GENERATION_PATTERN.match(gens[-1].name).group(1)) + 1
+    gen_dir = root / 'gen-{:06d}'.format(number)
+    gen_dir.mkdir()
+    return gen_dir
+
+def publish(dbpath, gen_dir):
+    """Atomically point dbpath at gen_dir. The generation must be fully
+       built and committed before this is called.
+    """
+    if os.path.exists(dbpath) and not is_managed(dbpath):
+        raise ValueError('{} is not a link to a generation'.format(dbpath))
+    (Path(gen_dir) / READERS_LOCK).touch()
+    dbpath = Path(dbpath)
+    target = os.path.relpath(gen_dir, dbpath.parent.resolve())
+    tmp_link = dbpath.with_name('{}.tmp-{}'.format(dbpath.name, os.getpid()))
+    if os.path.lexists(tmp_link):
+        os.unlink(tmp_link)
+    os.symlink(target, tmp_link)
+    # rename() replaces the old link in one step, so readers either see
+    # the old generation or the new one.
+    os.replace(tmp_link, dbpath)
+
+def collect_garbage(dbpath):
+    """Remove generations other than the current one that have no readers.
+       Returns the list of directories that were removed.
+    """
+    current = current_generation(dbpath)
+    removed = []
+    for gen_dir in list_generations(dbpath):
+        if os.path.realpath(gen_dir) == current:
+            continue
+        lock_file = gen_dir / READERS_LOCK
+        if not lock_file.exists():
+            # Never published, such as a build that failed part way.
+            shutil.rmtree(gen_dir)
+            removed.append(gen_dir)
+            continue
+        fd = os.open(lock_file, os.O_RDONLY)
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                continue # still in use by a reader.
+            shutil.rmtree(gen_dir)
+            removed.append(gen_dir)
+        finally:
+            os.close(fd)
+    return removed
+
+class ReaderLock:
+    """A shared lock held by a reader on the generation that it has open.
+       For an unmanaged dbpath this holds no lock.
+    """
+    def __init__(self, gen_dir):
+        self.fd = None
+        lock_file = os.path.join(gen_dir, READERS_LOCK)
+        try:
+            fd = os.open(lock_file, os.O_RDONLY)
+        except FileNotFoundError:
+            return
+        fcntl.flock(fd, fcntl.LOCK_SH)
+        if not os.path.exists(lock_file):
+            # collect_garbage() removed the generation before we locked it.
+            os.close(fd)
+            raise FileNotFoundError(gen_dir)
+        self.fd = fd
+
+    def release(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+if __name__ == '__main__':
+    arguments = argparse.ArgumentParser()
+    arguments.add_argument('--dbpath',
+                           default='xapian.db',
+                           help='Path to the managed database link.')
+    arguments.add_argument('--gc',
+                           action='store_true',
+                           help='Remove old generations that have no readers')
+    args = arguments.parse_args()
+    if not is_managed(args.dbpath):
+        print('{} is not a managed database'.format(args.dbpath))
+        sys.exit(2)
+    print('current generation is {}'.format(current_generation(args.dbpath)))
+    if args.gc:
+        for gen_dir in collect_garbage(args.dbpath):
+            print('removed {}'.format(gen_dir))
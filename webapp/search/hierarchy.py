@@ -0,0 +1,225 @@
+"""
+The graph of parent, child, and related funders.
+
+Walking a hierarchy with search() takes one query per funder, so
+create_index.py also writes a file hierarchy.json inside the database
+directory. Funders are numbered in order of global_id, and the edges
+are stored as compressed sparse rows: the children of funder i are
+children[child_offsets[i]:child_offsets[i+1]], and likewise for parents
+and related funders. Edges are made symmetric, so a child that names
+its parent is also a child of that parent even if the parent does not
+list it. The ancestors of every funder are precomputed in the same
+form, nearest first, up to MAX_ANCESTORS of them so that a tangled
+graph cannot make the file quadratic in size. Relationships to
+funders that are not in the index are left out.
+"""
+
+import bisect
+from collections import deque
+import json
+import os
+import sys
+try:
+    from .generations import GenerationFile
+except ImportError: # imported from the search directory by create_index.py
+    from generations import GenerationFile
+
+HIERARCHY_FILE = 'hierarchy.json'
+HIERARCHY_FORMAT = 1
+# Maximum number of ancestors stored for each funder.
+MAX_ANCESTORS = 64
+# Maximum number of funders returned by subtree().
+MAX_SUBTREE = 5000
+
+def _csr(rows):
+    """Return the offsets and targets of a list of lists."""
+    offsets = [0]
+    targets = []
+    for row in rows:
+        targets.extend(row)
+        offsets.append(len(targets))
+    return offsets, targets
+
+class HierarchyBuilder:
+    """Collects the relationships of funders as they are indexed, and
+       writes hierarchy.json. Only IDs and names are kept.
+    """
+    def __init__(self):
+        self.funders = {}
+
+    def add(self, funder):
+        self.funders[sys.intern(funder.global_id())] = (
+            funder.name,
+            [sys.intern(rel.global_id()) for rel in funder.children],
+            [sys.intern(rel.global_id()) for rel in funder.parents],
+            [sys.intern(rel.global_id()) for rel in funder.related])
+
+    def observe(self, funders):
+        """Yield each of funders after adding it."""
+        for funder in funders:
+            self.add(funder)
+            yield funder
+
+    def write(self, path):
+        """Write the graph to path, usually HIERARCHY_FILE in the database directory."""
+        ids = sorted(self.funders)
+        index = {global_id: num for num, global_id in enumerate(ids)}
+        children = [set() for _ in ids]
+        parents = [set() for _ in ids]
+        related = [set() for _ in ids]
+        for num, global_id in enumerate(ids):
+            _, child_ids, parent_ids, related_ids = self.funders[global_id]
+            for other in child_ids:
+                other = index.get(other)
+                if other is not None and other != num:
+                    children[num].add(other)
+                    parents[other].add(num)
+            for other in parent_ids:
+                other = index.get(other)
+                if other is not None and other != num:
+                    parents[num].add(other)
+                    children[other].add(num)
+            for other in related_ids:
+                other = index.get(other)
+                if other is not None and other != num:
+                    related[num].add(other)
+                    related[other].add(num)
+        parents = [sorted(row) for row in parents]
+        ancestors = []
+        for num in range(len(ids)):
+            found = []
+            seen = {num}
+            queue = deque(parents[num])
+            while queue and len(found) < MAX_ANCESTORS:
+                other = queue.popleft()
+                if other in seen:
+                    continue
+                seen.add(other)
+                found.append(other)
+                queue.extend(parents[other])
+            ancestors.append(found)
+        child_offsets, child_targets = _csr(sorted(row) for row in children)
+        parent_offsets, parent_targets = _csr(parents)
+        related_offsets, related_targets = _csr(sorted(row) for row in related)
+        ancestor_offsets, ancestor_targets = _csr(ancestors)
+        data = {'format': HIERARCHY_FORMAT,
+                'ids': ids,
+                'names': [self.funders[global_id][0] for global_id in ids],
+                'child_offsets': child_offsets,
+                'children': child_targets,
+                'parent_offsets': parent_offsets,
+                'parents': parent_targets,
+                'related_offsets': related_offsets,
+                'related': related_targets,
+                'ancestor_offsets': ancestor_offsets,
+                'ancestors': ancestor_targets}
+        tmp_path = '{}.tmp-{}'.format(path, os.getpid())
+        with open(tmp_path, 'w', encoding='UTF-8') as fp:
+            json.dump(data, fp, ensure_ascii=False, separators=(',', ':'))
+        os.replace(tmp_path, path)
+
+class Hierarchy:
+    """The graph loaded from a hierarchy.json file. Methods take and
+       return global IDs, and return None for an unknown funder.
+    """
+    def __init__(self, path):
+        with open(path, 'r', encoding='UTF-8') as fp:
+            data = json.load(fp)
+        if data.get('format') != HIERARCHY_FORMAT:
+            raise ValueError('unsupported hierarchy format in {}'.format(path))
+        self.ids = data['ids']
+        self.names = data['names']
+        self.edges = {'children': (data['child_offsets'], data['children']),
+                      'parents': (data['parent_offsets'], data['parents']),
+                      'related': (data['related_offsets'], data['related']),
+                      'ancestors': (data['ancestor_offsets'], data['ancestors'])}
+
+    def _num(self, global_id):
+        num = bisect.bisect_left(self.ids, global_id)
+        if num < len(self.ids) and self.ids[num] == global_id:
+            return num
+        return None
+
+    def _row(self, kind, num):
+        offsets, targets = self.edges[kind]
+        return targets[offsets[num]:offsets[num + 1]]
+
+    def _node(self, num):
+        return {'id': self.ids[num], 'name': self.names[num]}
+
+    def neighbors(self, global_id, kind):
+        """Return the children, parents, related, or ancestors of a funder."""
+        num = self._num(global_id)
+        if num is None:
+            return None
+        return [self._node(other) for other in self._row(kind, num)]
+
+    def ancestors(self, global_id):
+        """Return the ancestors of a funder, nearest first."""
+        return self.neighbors(global_id, 'ancestors')
+
+    def siblings(self, global_id):
+        """Return the other children of the parents of a funder."""
+        num = self._num(global_id)
+        if num is None:
+            return None
+        seen = {num}
+        siblings = []
+        for parent in self._row('parents', num):
+            for other in self._row('children', parent):
+                if other not in seen:
+                    seen.add(other)
+                    siblings.append(self._node(other))
+        return siblings
+
+    def subtree(self, global_id, max_depth=None, max_nodes=MAX_SUBTREE):
+        """Return a funder with its descendants as nested children. A funder
+           that is reachable by more than one path appears only once, at
+           its smallest depth. The result has truncated set if max_nodes
+           funders were reached.
+        """
+        num = self._num(global_id)
+        if num is None:
+            return None
+        root = self._node(num)
+        root['children'] = []
+        seen = {num}
+        queue = deque([(num, root, 0)])
+        truncated = False
+        while queue:
+            parent, node, depth = queue.popleft()
+            if max_depth is not None and depth >= max_depth:
+                continue
+            for child in self._row('children', parent):
+                if child in seen:
+                    continue
+                if len(seen) >= max_nodes:
+                    truncated = True
+                    break
+                seen.add(child)
+                child_node = self._node(child)
+                child_node['children'] = []
+                node['children'].append(child_node)
+                queue.append((child, child_node, depth + 1))
+        root['truncated'] = truncated
+        return root
+
+    def family(self, global_id, max_depth=None):
+        """Return the ancestors, siblings, related funders, and subtree of a
+           funder in one dict, or None if the funder is unknown."""
+        subtree = self.subtree(global_id, max_depth)
+        if subtree is None:
+            return None
+        return {'ancestors': self.ancestors(global_id),
+                'parents': self.neighbors(global_id, 'parents'),
+                'siblings': self.siblings(global_id),
+                'related': self.neighbors(global_id, 'related'),
+                'subtree': subtree}
+
+_hierarchies = GenerationFile(HIERARCHY_FILE, Hierarchy)
+
+def get_hierarchy(db_path):
+    """Return the Hierarchy for the current generation of db_path. It is
+       reloaded when the generation or the hierarchy.json file changes.
+    """
+    return _hierarchies.get(db_path)
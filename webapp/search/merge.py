@@ -0,0 +1,160 @@
+"""Merging ROR organizations into the FundReg funders that they duplicate.
+
+Many organizations are in both registries. ROR gives the FundReg ID of
+some of them as preferred_fundref, and others have the same name and
+country as a FundReg funder. Without merging, both records are indexed
+and a search for such an organization returns two near-identical hits.
+
+merge_funders() folds each such ROR record into its FundReg funder in
+linear time. One pass over the FundReg funders builds a hash index from
+normalized name and country to funder, one pass over the ROR records
+looks each of them up by preferred_fundref and then by name, and one
+pass applies the matches. The name, aliases, acronyms, and labels of
+the ROR record become altnames of the FundReg funder, its relationships
+are added, and its global ID is kept in merged_ids so that it can still
+be looked up. A final pass rewrites relationships that point at a
+merged ROR record so that they point at the FundReg funder instead.
+The FundReg funder keeps its source and ID, so links to it do not
+change.
+
+A name is only used for matching if it belongs to one FundReg funder
+in the country and one ROR record claims it. Otherwise it is counted
+as ambiguous and the records are left apart.
+"""
+
+import re
+import unicodedata
+try:
+    from .countries import canonical_country
+    from .model import DataSource, FunderRecord, RelationshipRecord
+except ImportError: # imported from the search directory by create_index.py
+    from countries import canonical_country
+    from model import DataSource, FunderRecord, RelationshipRecord
+
+WORD_RE = re.compile(r'\w+')
+RELATIONSHIP_KINDS = ('children', 'parents', 'related')
+
+def normalize_name(name):
+    """Return the form of a name used for matching, with case folded and
+       accents and punctuation removed."""
+    decomposed = unicodedata.normalize('NFKD', name.casefold())
+    stripped = ''.join(c for c in decomposed if not unicodedata.combining(c))
+    return ' '.join(WORD_RE.findall(stripped))
+
+def _country(funder):
+    return canonical_country(funder.country_code) or canonical_country(funder.country)
+
+def _as_record(funder):
+    """Return a FunderRecord that may be changed without changing funder."""
+    return FunderRecord.from_dict(funder.dict())
+
+def _fold(target, ror):
+    """Add the names and relationships of a ROR record to a FundReg record."""
+    seen = {normalize_name(name) for name in [target.name] + target.altnames}
+    for name in [ror.name] + list(ror.altnames):
+        key = normalize_name(name)
+        if key and key not in seen:
+            seen.add(key)
+            target.altnames.append(name)
+    for kind in RELATIONSHIP_KINDS:
+        rels = getattr(target, kind)
+        ids = {rel.global_id() for rel in rels}
+        for rel in getattr(ror, kind):
+            if rel.global_id() not in ids:
+                ids.add(rel.global_id())
+                rels.append(RelationshipRecord(rel.source, rel.source_id, rel.name))
+    target.merged_ids.append(ror.global_id())
+
+def _remap(funder, merged_into, funders):
+    """Return funder with its relationships to merged ROR records pointing at
+       the FundReg funders, or funder itself if it has none."""
+    if not any(rel.global_id() in merged_into
+               for kind in RELATIONSHIP_KINDS for rel in getattr(funder, kind)):
+        return funder, 0
+    funder = _as_record(funder)
+    own_id = funder.global_id()
+    count = 0
+    for kind in RELATIONSHIP_KINDS:
+        rels = []
+        ids = set()
+        for rel in getattr(funder, kind):
+            target_id = merged_into.get(rel.global_id())
+            if target_id:
+                target = funders[target_id]
+                rel = RelationshipRecord(target.source, target.source_id, target.name)
+                count += 1
+            gid = rel.global_id()
+            if gid != own_id and gid not in ids:
+                ids.add(gid)
+                rels.append(rel)
+        setattr(funder, kind, rels)
+    return funder, count
+
+def merge_funders(fundreg, ror, match_names=True):
+    """Merge ROR records into the FundReg funders that they duplicate.
+       args:
+          fundreg: dict from global_id to Funder or FunderRecord from FundReg
+          ror: dict from global_id to Funder or FunderRecord from ROR
+          match_names: also match records that have the same normalized
+             name and country, not only by preferred_fundref
+       returns:
+          (funders, report), where funders is a dict from global_id to the
+          funders to index, and report is a dict of counts.
+    """
+    by_name = {}
+    ambiguous = set()
+    if match_names:
+        for global_id, funder in fundreg.items():
+            key = (normalize_name(funder.name), _country(funder))
+            if not key[0] or not key[1]:
+                continue
+            if key in by_name:
+                ambiguous.add(key)
+            else:
+                by_name[key] = global_id
+    report = {'fundreg': len(fundreg), 'ror': len(ror), 'by_fundref': 0, 'by_name': 0,
+              'ambiguous': 0, 'missing_fundref': 0, 'remapped_relationships': 0}
+    # global_id of each ROR record to the FundReg global_id it matches,
+    # and whether the match was by name.
+    matches = {}
+    fundref_targets = set()
+    name_claims = {}
+    for global_id, funder in ror.items():
+        if funder.preferred_fundref:
+            target_id = '{}_{}'.format(DataSource.FUNDREG.value, funder.preferred_fundref)
+            if target_id in fundreg:
+                matches[global_id] = (target_id, False)
+                fundref_targets.add(target_id)
+                continue
+            report['missing_fundref'] += 1
+        if match_names:
+            key = (normalize_name(funder.name), _country(funder))
+            if key in ambiguous:
+                report['ambiguous'] += 1
+            elif key in by_name:
+                target_id = by_name[key]
+                matches[global_id] = (target_id, True)
+                name_claims[target_id] = name_claims.get(target_id, 0) + 1
+    funders = dict(fundreg)
+    merged_into = {}
+    for global_id, (target_id, by_name_match) in matches.items():
+        if by_name_match and (name_claims[target_id] > 1 or target_id in fundref_targets):
+            report['ambiguous'] += 1
+            continue
+        target = funders[target_id]
+        if target is fundreg[target_id]:
+            target = funders[target_id] = _as_record(target)
+        _fold(target, ror[global_id])
+        merged_into[global_id] = target_id
+        report['by_name' if by_name_match else 'by_fundref'] += 1
+    for global_id, funder in ror.items():
+        if global_id not in merged_into:
+            funders[global_id] = funder
+    if merged_into:
+        for global_id, funder in funders.items():
+            funder, count = _remap(funder, merged_into, funders)
+            if count:
+                funders[global_id] = funder
+                report['remapped_relationships'] += count
+    report['documents'] = len(funders)
+    return funders, report
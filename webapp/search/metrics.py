@@ -0,0 +1,182 @@
+"""Per-stage timing of queries, exposed in the Prometheus text format.
+
+A Timer is created for each request with Metrics.timer(). The code
+calls timer.mark(stage) at the end of each stage, and the time since
+the previous mark is recorded under that stage. When the request is
+done, finish() adds the stages to histograms, counts the request and
+its results, and logs it if it was slower than the slow query
+threshold. The stages of the last request are also available as a
+Server-Timing header.
+
+When metrics are disabled, Metrics.timer() returns NULL_TIMER whose
+methods do nothing, so the cost is one method call per stage.
+
+Like the result cache, metrics are kept per process, so each worker
+reports its own counters.
+"""
+
+import bisect
+import logging
+import threading
+import time
+
+# Upper bounds in seconds of the latency histogram buckets.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+# Upper bounds of the histogram of the number of results.
+RESULT_BUCKETS = (0, 1, 5, 10, 50, 100, 500, 1000)
+
+slow_query_log = logging.getLogger('search.slow_queries')
+
+class Histogram:
+    """Counts of observations in fixed buckets, as in Prometheus. The
+       caller holds the lock of Metrics."""
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def lines(self, name, labels):
+        """Return the lines of the Prometheus text format for this histogram."""
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append('{}_bucket{{{}le="{}"}} {}'.format(name, labels, bound, cumulative))
+        lines.append('{}_bucket{{{}le="+Inf"}} {}'.format(name, labels, self.count))
+        labels = '{' + labels.rstrip(',') + '}' if labels else ''
+        lines.append('{}_sum{} {}'.format(name, labels, self.sum))
+        lines.append('{}_count{} {}'.format(name, labels, self.count))
+        return lines
+
+class NullTimer:
+    """The Timer used when metrics are disabled."""
+    def mark(self, stage):
+        pass
+
+    def note(self, **info):
+        pass
+
+    def finish(self):
+        pass
+
+    def server_timing(self):
+        return None
+
+NULL_TIMER = NullTimer()
+
+class Timer:
+    """Records the stages of one request.
+       args:
+          metrics: the Metrics that finish() reports to
+          endpoint: name of the request type, such as search or lookup
+    """
+    def __init__(self, metrics, endpoint):
+        self.metrics = metrics
+        self.endpoint = endpoint
+        self.start = self.last = time.perf_counter()
+        self.stages = []
+        self.info = {}
+
+    def mark(self, stage):
+        """Record the time since the previous mark as stage."""
+        now = time.perf_counter()
+        self.stages.append((stage, now - self.last))
+        self.last = now
+
+    def note(self, **info):
+        """Attach information about the request, such as the query or
+           the number of results, for metrics and the slow query log."""
+        self.info.update(info)
+
+    def total(self):
+        return self.last - self.start
+
+    def finish(self):
+        self.metrics.record(self)
+
+    def server_timing(self):
+        """Return the value of a Server-Timing header with the stages in milliseconds."""
+        parts = ['{};dur={:.3f}'.format(stage, 1000 * seconds) for stage, seconds in self.stages]
+        parts.append('total;dur={:.3f}'.format(1000 * self.total()))
+        return ', '.join(parts)
+
+class Metrics:
+    """Histograms and counters of requests.
+       args:
+          enabled: if False then timer() returns NULL_TIMER and nothing is recorded
+          slow_query_seconds: log requests that take longer than this. None disables the log.
+    """
+    def __init__(self, enabled=False, slow_query_seconds=None):
+        self.enabled = enabled
+        self.slow_query_seconds = slow_query_seconds
+        self._lock = threading.Lock()
+        self.requests = {}
+        self.cache_hits = {}
+        self.slow_queries = 0
+        self.latency = {}
+        self.stage_latency = {}
+        self.results = {}
+
+    def timer(self, endpoint):
+        if not self.enabled:
+            return NULL_TIMER
+        return Timer(self, endpoint)
+
+    def record(self, timer):
+        endpoint = timer.endpoint
+        total = timer.total()
+        with self._lock:
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+            if timer.info.get('cache_hit'):
+                self.cache_hits[endpoint] = self.cache_hits.get(endpoint, 0) + 1
+            if endpoint not in self.latency:
+                self.latency[endpoint] = Histogram(LATENCY_BUCKETS)
+            self.latency[endpoint].observe(total)
+            for stage, seconds in timer.stages:
+                histogram = self.stage_latency.get((endpoint, stage))
+                if histogram is None:
+                    histogram = self.stage_latency[(endpoint, stage)] = Histogram(LATENCY_BUCKETS)
+                histogram.observe(seconds)
+            if 'results' in timer.info:
+                if endpoint not in self.results:
+                    self.results[endpoint] = Histogram(RESULT_BUCKETS)
+                self.results[endpoint].observe(timer.info['results'])
+            slow = self.slow_query_seconds is not None and total > self.slow_query_seconds
+            if slow:
+                self.slow_queries += 1
+        if slow:
+            slow_query_log.warning('slow %s %.1fms %s %s', endpoint, 1000 * total,
+                                   timer.server_timing(),
+                                   {k: v for k, v in timer.info.items() if k != 'results'})
+
+    def lines(self, prefix):
+        """Return the lines of the Prometheus text format for these metrics."""
+        with self._lock:
+            lines = ['# TYPE {}_requests_total counter'.format(prefix)]
+            for endpoint, count in sorted(self.requests.items()):
+                lines.append('{}_requests_total{{endpoint="{}"}} {}'.format(prefix, endpoint, count))
+            lines.append('# TYPE {}_cached_requests_total counter'.format(prefix))
+            for endpoint, count in sorted(self.cache_hits.items()):
+                lines.append('{}_cached_requests_total{{endpoint="{}"}} {}'.format(prefix, endpoint, count))
+            lines.append('# TYPE {}_slow_requests_total counter'.format(prefix))
+            lines.append('{}_slow_requests_total {}'.format(prefix, self.slow_queries))
+            lines.append('# TYPE {}_request_seconds histogram'.format(prefix))
+            for endpoint, histogram in sorted(self.latency.items()):
+                lines.extend(histogram.lines(prefix + '_request_seconds',
+                                             'endpoint="{}",'.format(endpoint)))
+            lines.append('# TYPE {}_stage_seconds histogram'.format(prefix))
+            for (endpoint, stage), histogram in sorted(self.stage_latency.items()):
+                lines.extend(histogram.lines(prefix + '_stage_seconds',
+                                             'endpoint="{}",stage="{}",'.format(endpoint, stage)))
+            lines.append('# TYPE {}_results histogram'.format(prefix))
+            for endpoint, histogram in sorted(self.results.items()):
+                lines.extend(histogram.lines(prefix + '_results',
+                                             'endpoint="{}",'.format(endpoint)))
+        return lines
@@ -28,6 +28,7 @@ Funder types in ROR have the following distribution:
 """
 
 from enum import Enum
+import sys
 from pydantic import BaseModel, Field, Extra, constr, conint, conlist, validator, root_validator, validate_model, AnyUrl
 from typing import List, Dict, Optional, Union, Literal
 from typing_extensions import Annotated
@@ -117,6 +118,9 @@ class Funder(GlobalEntity):
     related: List[Relationship] = Field(...,
                                         title='Related entities',
                                         description='From FundReg and ROR.')
+    merged_ids: List[str] = Field([],
+                                  title='Global IDs of ROR records merged into this one',
+                                  description='See merge.py. They can still be looked up.')
     # def children(self):
     #     return [i for i in self.relationships if i.reltype == RelationshipType.CHILD]
 
@@ -138,22 +142,145 @@ class FunderList(BaseModel):
                                        title='Map from global_id to Funder objects',
                                        description='Useful for serialization and lookup')
 
+# Used to store enums as small integers in the records below.
+SOURCES = list(DataSource)
+SOURCE_CODES = {source.value: code for code, source in enumerate(SOURCES)}
+FUNDER_TYPES = list(FunderType)
+FUNDER_TYPE_CODES = {funder_type.value: code for code, funder_type in enumerate(FUNDER_TYPES)}
+# By default the parsers validate one record in this many as a Funder.
+VALIDATE_EVERY = 100
+
+def _intern(value):
+    return sys.intern(value) if value is not None else None
+
+def _enum_value(value):
+    # Enum members hash by name, so look them up in the code maps by value.
+    return value.value if isinstance(value, Enum) else value
+
+class RelationshipRecord:
+    """Compact form of a Relationship used by FunderRecord."""
+    __slots__ = ('source_code', 'source_id', 'name')
+
+    def __init__(self, source, source_id, name):
+        self.source_code = SOURCE_CODES[_enum_value(source)]
+        self.source_id = _intern(source_id)
+        self.name = _intern(name)
+
+    @property
+    def source(self):
+        return SOURCES[self.source_code]
+
+    def global_id(self):
+        return '{}_{}'.format(self.source.value, self.source_id)
+
+    def dict(self):
+        return {'source': self.source, 'source_id': self.source_id, 'name': self.name}
+
+class FunderRecord:
+    """A compact and unvalidated Funder for the build pipeline. A full
+       Funder costs a lot of memory and validation time when there are
+       more than 100000 of them, so the parsers produce these instead.
+       It has the same attributes as a Funder, and dict() returns the
+       same value as Funder.dict(), so it can be indexed directly. Enums
+       are stored as small integers and repeated strings are interned.
+       Use to_funder() to get a validated Funder.
+    """
+    __slots__ = ('source_code', 'source_id', 'name', 'country', 'country_code',
+                 'type_code', 'preferred_fundref', 'altnames', 'children',
+                 'parents', 'related', 'merged_ids')
+
+    @classmethod
+    def from_dict(cls, data, validate=False):
+        """Build a record from a dict with the fields of a Funder. If
+           validate is True then the dict is first validated as a Funder,
+           which raises a ValidationError if it is not valid.
+        """
+        if validate:
+            Funder.parse_obj(data)
+        record = cls()
+        record.source_code = SOURCE_CODES[_enum_value(data['source'])]
+        record.source_id = data['source_id']
+        record.name = data['name']
+        record.country = _intern(data['country'])
+        record.country_code = _intern(data.get('country_code'))
+        record.type_code = FUNDER_TYPE_CODES[_enum_value(data['funder_type'])]
+        record.preferred_fundref = data.get('preferred_fundref')
+        record.altnames = list(data['altnames'])
+        record.children = [RelationshipRecord(**rel) for rel in data['children']]
+        record.parents = [RelationshipRecord(**rel) for rel in data['parents']]
+        record.related = [RelationshipRecord(**rel) for rel in data['related']]
+        record.merged_ids = list(data.get('merged_ids') or [])
+        return record
+
+    @classmethod
+    def from_funder(cls, funder):
+        return cls.from_dict(funder.dict())
+
+    @property
+    def source(self):
+        return SOURCES[self.source_code]
+
+    @property
+    def funder_type(self):
+        return FUNDER_TYPES[self.type_code]
+
+    def global_id(self):
+        return '{}_{}'.format(self.source.value, self.source_id)
+
+    def dict(self):
+        return {'source': self.source,
+                'source_id': self.source_id,
+                'name': self.name,
+                'country': self.country,
+                'country_code': self.country_code,
+                'funder_type': self.funder_type,
+                'preferred_fundref': self.preferred_fundref,
+                'altnames': list(self.altnames),
+                'children': [rel.dict() for rel in self.children],
+                'parents': [rel.dict() for rel in self.parents],
+                'related': [rel.dict() for rel in self.related],
+                'merged_ids': list(self.merged_ids)}
+
+    def to_funder(self):
+        """Return a validated Funder."""
+        return Funder.parse_obj(self.dict())
+
+class ValidationSampler:
+    """Decides which records are validated. With every=1 all records are
+       validated and with every=0 none are.
+    """
+    def __init__(self, every=VALIDATE_EVERY):
+        self.every = every
+        self.count = 0
+
+    def __call__(self):
+        self.count += 1
+        return bool(self.every) and self.count % self.every == 1 % self.every
+
+def add_names_from_table(funder, names):
+    """Fill in the names of relationships that were specified by ID only.
+       args:
+          funder: a Funder or FunderRecord
+          names: a dict from global_id to name, such as from rdf_parser.rdf_names()
+    """
+    for rel in funder.children:
+        if not rel.name:
+            rel.name = names.get(rel.global_id(), '')
+    for rel in funder.parents:
+        if not rel.name:
+            rel.name = names.get(rel.global_id(), '')
+    for rel in funder.related:
+        if not rel.name:
+            rel.name = names.get(rel.global_id(), '')
+
 def add_names_to_relationships(funderlist):
     """When ROR entities are read in, they contain relationships specified by ID
            without names. This propagates the names to the relationships by looking them
            up.
         """
+    names = {key: funder.name for key, funder in funderlist.funders.items()}
     for funder in funderlist.funders.values():
-        # lookup the names for all relationships.
-        for rel in funder.children:
-            if not rel.name:
-                rel.name = funderlist.funders.get(rel.global_id()).name
-        for rel in funder.parents:
-            if not rel.name:
-                rel.name = funderlist.funders.get(rel.global_id()).name
-        for rel in funder.related:
-            if not rel.name:
-                rel.name = funderlist.funders.get(rel.global_id()).name
+        add_names_from_table(funder, names)
 
     
 if __name__ == '__main__':
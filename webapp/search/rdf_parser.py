@@ -1,13 +1,22 @@
 """This parses the RDF for the Funders Registry, and produces a FunderMap.
+It can also yield one FunderRecord at a time with iter_rdf(), which
+needs a small table from global_id to name that is read by a first
+pass over the file with rdf_names().
+
+The file is parsed with ConceptParser, which drives expat directly.
+FunderHandler is the SAX handler that it replaced, and is kept for
+comparison in benchmarks/bench_rdf.py.
 """
 
 from enum import Enum
 import json
 import sys
+from xml.parsers import expat
 from xml.sax import parse
 from xml.sax.handler import ContentHandler
 from model import Funder, RelationshipType, DataSource, StrEnum, FunderType, FunderList
-from model import add_names_to_relationships
+from model import FunderRecord, ValidationSampler, VALIDATE_EVERY
+from model import add_names_to_relationships, add_names_from_table
 # This is a map from the values of svf:fundingBodySubType to the
 # associated FunderType.  We don't have a schema to define the values
 # of svf:fundingBodySubType. They were apparently provided by
@@ -24,7 +33,11 @@ funderTypeMap = {
     'Research institutes and centers': FunderType.INSTITUTE.value,
     'Trusts, charities, foundations (both public and private)': FunderType.NONPROFIT.value,
     'Universities (academic only)': FunderType.EDU.value}
-      
+
+RDF_FILE = 'data/registry.rdf'
+# Number of bytes fed to the incremental parser at a time.
+CHUNK_SIZE = 1 << 16
+
 class Tag(str, Enum):
     """XML Tags that we recognize and act on in SAX parser."""
     Concept            = 'skos:Concept'
@@ -38,10 +51,17 @@ class Tag(str, Enum):
     addressCountry     = 'schema:addressCountry'
             
 class FunderHandler(ContentHandler):
-    """Sax parser Handler for parsing registry.rdf."""
-    def __init__(self, funderlist, country_map):
-        self.funderlist = funderlist
+    """Sax parser Handler for parsing registry.rdf. It produces a
+       FunderRecord for each concept and validates a sample of them.
+       args:
+          emit: function that is called with each FunderRecord
+          country_map: a dict from iso3 country codes to names
+          validate_every: validate one record in this many as a Funder
+    """
+    def __init__(self, emit, country_map, validate_every=VALIDATE_EVERY):
+        self.emit = emit
         self.country_map = country_map
+        self.should_validate = ValidationSampler(validate_every)
         self.item = None
         # Keep track of current tag for characters()
         self.current_tag = None
@@ -85,8 +105,8 @@ class FunderHandler(ContentHandler):
     def endElement(self, name):
         self.content = self.content.strip()
         if name == 'skos:Concept':
-            funder = Funder.parse_obj(self.item)
-            self.funderlist.funders[funder.global_id()] = funder
+            funder = FunderRecord.from_dict(self.item, validate=self.should_validate())
+            self.emit(funder)
             self.item = None
         elif name == Tag.prefLabel:
             self.in_prefLabel = False
@@ -114,20 +134,179 @@ class FunderHandler(ContentHandler):
         self.current_tag = None
         self.content = '' # reset at end of tag.
 
-def parse_rdf(country_map):
+class ConceptParser:
+    """Incremental expat parser for registry.rdf that produces the same
+       FunderRecords as FunderHandler. The text of an element is buffered
+       in a list and joined once at the end of the element, and start and
+       end tags are dispatched through dicts keyed by tag name, so only
+       the tags that we act on cost more than a dict lookup.
+       args:
+          emit: function that is called with each FunderRecord
+          country_map: a dict from iso3 country codes to names
+          validate_every: validate one record in this many as a Funder
+    """
+    def __init__(self, emit, country_map, validate_every=VALIDATE_EVERY):
+        self.emit = emit
+        self.country_map = country_map
+        self.should_validate = ValidationSampler(validate_every)
+        self.item = None
+        # The key of item that a skosxl:literalForm is stored under.
+        self.label = None
+        self.text = []
+        self.start_handlers = {Tag.Concept.value: self.start_concept,
+                               Tag.broader.value: self.start_broader,
+                               Tag.narrower.value: self.start_narrower,
+                               Tag.prefLabel.value: self.start_prefLabel,
+                               Tag.altLabel.value: self.start_altLabel}
+        self.end_handlers = {Tag.Concept.value: self.end_concept,
+                             Tag.prefLabel.value: self.end_label,
+                             Tag.altLabel.value: self.end_label,
+                             Tag.literalForm.value: self.end_literalForm,
+                             Tag.fundingBodyType.value: self.end_fundingBodyType,
+                             Tag.fundingBodySubType.value: self.end_fundingBodySubType,
+                             Tag.addressCountry.value: self.end_addressCountry}
+        self.parser = expat.ParserCreate()
+        self.parser.buffer_text = True
+        self.parser.buffer_size = CHUNK_SIZE
+        self.parser.StartElementHandler = self.start_element
+        self.parser.EndElementHandler = self.end_element
+        self.parser.CharacterDataHandler = self.text.append
+
+    def feed(self, data, final=False):
+        self.parser.Parse(data, final)
+
+    def start_element(self, name, attrs):
+        self.text.clear()
+        handler = self.start_handlers.get(name)
+        if handler:
+            handler(attrs)
+
+    def end_element(self, name):
+        handler = self.end_handlers.get(name)
+        if handler:
+            handler(''.join(self.text).strip())
+        self.text.clear()
+
+    def start_concept(self, attrs):
+        self.item = {'source_id': id_from_uri(attrs.get('rdf:about')),
+                     'source': DataSource.FUNDREG.value,
+                     'altnames': [],
+                     'children': [],
+                     'parents': [],
+                     'related': []}
+
+    def start_broader(self, attrs):
+        self.item['parents'].append({'name': '', # don't know yet
+                                     'source': DataSource.FUNDREG.value,
+                                     'source_id': id_from_uri(attrs.get('rdf:resource'))})
+
+    def start_narrower(self, attrs):
+        self.item['children'].append({'name': '', # don't know yet
+                                      'source': DataSource.FUNDREG.value,
+                                      'source_id': id_from_uri(attrs.get('rdf:resource'))})
+
+    def start_prefLabel(self, attrs):
+        self.label = 'name'
+
+    def start_altLabel(self, attrs):
+        self.label = 'altnames'
+
+    def end_concept(self, content):
+        funder = FunderRecord.from_dict(self.item, validate=self.should_validate())
+        self.emit(funder)
+        self.item = None
+
+    def end_label(self, content):
+        self.label = None
+
+    def end_literalForm(self, content):
+        if self.label == 'altnames':
+            self.item['altnames'].append(content)
+        elif self.label == 'name':
+            self.item['name'] = content
+
+    def end_fundingBodyType(self, content):
+        if content == 'gov':
+            self.item['funder_type'] = FunderType.GOV.value
+        elif content == 'pri':
+            self.item['funder_type'] = FunderType.OTHER.value
+        else:
+            raise ValueError('unexpected fundingBodyType:' + content)
+
+    def end_fundingBodySubType(self, content):
+        try:
+            self.item['funder_type'] = funderTypeMap[content]
+        except KeyError:
+            raise ValueError('unrecognized funder type: ' + content)
+
+    def end_addressCountry(self, content):
+        self.item['country_code'] = content
+        self.item['country'] = self.country_map.get(content, 'unknown')
+
+def id_from_uri(uri):
+    return uri.split('/')[-1]
+
+def _iter_concepts(country_map, filename, validate_every):
+    """Yield a FunderRecord for each concept in filename, feeding the
+       file to ConceptParser in chunks so that only the records from
+       the current chunk are held in memory.
+    """
+    pending = []
+    parser = ConceptParser(pending.append, country_map, validate_every)
+    with open(filename, 'rb') as fp:
+        while True:
+            chunk = fp.read(CHUNK_SIZE)
+            parser.feed(chunk, final=not chunk)
+            yield from pending
+            pending.clear()
+            if not chunk:
+                return
+
+def parse_rdf(country_map, validate_every=VALIDATE_EVERY, filename=RDF_FILE):
     """Parse the registry.rdf file and return a dict.
        args:
           country_map: a dict from iso3 country codes to names
+          validate_every: validate one record in this many as a Funder
+          filename: the RDF file to parse
        return:
-          a dict with items.
+          a FunderList of FunderRecord.
     """
     funderlist = FunderList(funders=[])
-    handler = FunderHandler(funderlist, country_map)
-    parse("data/registry.rdf", handler)
+    for funder in _iter_concepts(country_map, filename, validate_every):
+        funderlist.funders[funder.global_id()] = funder
     add_names_to_relationships(funderlist)
     return funderlist
 
+def parse_rdf_sax(country_map, validate_every=VALIDATE_EVERY, filename=RDF_FILE):
+    """Parse filename with FunderHandler. This is slower than parse_rdf()
+       and returns the same FunderList.
+    """
+    funderlist = FunderList(funders=[])
+    def emit(funder):
+        funderlist.funders[funder.global_id()] = funder
+    handler = FunderHandler(emit, country_map, validate_every)
+    parse(filename, handler)
+    add_names_to_relationships(funderlist)
+    return funderlist
+
+def rdf_names(country_map, filename=RDF_FILE):
+    """Return a dict from global_id to name for every concept in filename."""
+    return {funder.global_id(): funder.name
+            for funder in _iter_concepts(country_map, filename, 0)}
+
+def iter_rdf(country_map, names, filename=RDF_FILE, validate_every=VALIDATE_EVERY):
+    """Yield a FunderRecord for each concept in filename, with the names of
+       relationships filled in from names.
+       args:
+          country_map: a dict from iso3 country codes to names
+          names: a dict from global_id to name from rdf_names()
+    """
+    for funder in _iter_concepts(country_map, filename, validate_every):
+        add_names_from_table(funder, names)
+        yield funder
+
 if __name__ == '__main__':
     country_map = json.loads(open('data/country_map.json', 'r').read())
     funderlist = parse_rdf(country_map)
-    print(funderlist.json(indent=2))
+    funders = {key: value.to_funder() for key, value in funderlist.funders.items()}
+    print(FunderList(funders=funders).json(indent=2))
@@ -0,0 +1,89 @@
+"""An in-process LRU cache of search results used by search_lib.
+
+Entries are stored with the index token of the pool (see
+DatabasePool.token()) at the time they were computed. When the token
+changes because a new generation was published or the index was
+updated in place, all entries are dropped. Entries also expire after
+a fixed number of seconds, which bounds how long a stale result can be
+served if an update is noticed late.
+
+The cache is per process. Cached results are shared between callers,
+so they must not be modified.
+"""
+
+from collections import OrderedDict
+import threading
+import time
+
+# Default maximum number of cached results.
+MAX_SIZE = 2048
+# Default number of seconds that a result stays in the cache.
+TTL = 300.0
+
+class ResultCache:
+    """Thread-safe LRU cache with a size bound and a time to live.
+       args:
+          max_size: maximum number of entries. If this is 0 then nothing is cached.
+          ttl: number of seconds before an entry expires
+    """
+    def __init__(self, max_size=MAX_SIZE, ttl=TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._token = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def _check_token(self, token):
+        # Caller holds self._lock.
+        if token != self._token:
+            if self._entries:
+                self.invalidations += 1
+            self._entries.clear()
+            self._token = token
+
+    def get(self, key, token):
+        """Return the cached value for key, or None if there is none."""
+        if self.max_size <= 0:
+            return None
+        now = time.monotonic()
+        with self._lock:
+            self._check_token(token)
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < now:
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, token, value):
+        if self.max_size <= 0:
+            return
+        expires = time.monotonic() + self.ttl
+        with self._lock:
+            self._check_token(token)
+            self._entries[key] = (expires, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._entries),
+                    'max_size': self.max_size,
+                    'ttl': self.ttl,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'invalidations': self.invalidations}
@@ -0,0 +1,165 @@
+"""This parses the ROR data dump, and produces FunderRecord objects.
+
+The dump is a single JSON array of about 100000 organizations. Rather
+than tokenizing it in python, we read it in large chunks and let the
+C decoder in the json module decode one organization at a time with
+raw_decode(). Only one chunk and the organizations in flight are held
+in memory. Organizations are converted to FunderRecord objects, and
+only a sample of them is validated as a Funder.
+
+The conversion is not spread over processes. Finding where one
+organization ends means decoding it, so the decoding would stay in this
+process, and sending the decoded items to workers and their records back
+costs more than the conversion itself.
+"""
+
+import io
+import json
+from model import Funder, FunderList, FunderRecord, RelationshipType, DataSource
+from model import ValidationSampler, VALIDATE_EVERY
+from zipfile import ZipFile
+
+# Number of characters read from the dump at a time.
+CHUNK_SIZE = 1 << 20
+
+def extract_ror_id(uri):
+    """Extract 0abcdefg12 from https://ror.org/0abcdefg12"""
+    return uri.split('/')[-1]
+
+def iter_ror_items(fp, chunk_size=CHUNK_SIZE):
+    """Yield the elements of a JSON array of objects from a text file."""
+    decoder = json.JSONDecoder()
+    buf = ''
+    pos = 0
+    started = False
+    while True:
+        # Skip whitespace, the opening bracket, and separating commas.
+        while pos < len(buf) and buf[pos] in ' \t\r\n,[':
+            if buf[pos] == '[':
+                if started:
+                    raise ValueError('unexpected [ at offset {}'.format(pos))
+                started = True
+            pos += 1
+        if pos >= len(buf):
+            more = fp.read(chunk_size)
+            if not more:
+                raise ValueError('unexpected end of ROR data')
+            buf = buf[pos:] + more
+            pos = 0
+            continue
+        if buf[pos] == ']':
+            return
+        if not started:
+            raise ValueError('ROR data is not a JSON array')
+        try:
+            item, end = decoder.raw_decode(buf, pos)
+        except json.JSONDecodeError:
+            # Most likely the object continues in the next chunk.
+            more = fp.read(chunk_size)
+            if not more:
+                raise
+            buf = buf[pos:] + more
+            pos = 0
+            continue
+        yield item
+        pos = end
+        if pos > chunk_size:
+            buf = buf[pos:]
+            pos = 0
+
+def ror_item_to_dict(item):
+    """Convert an organization from the ROR dump to a dict with the fields of a Funder."""
+    ror = item.get('id')
+    id = extract_ror_id(ror)
+    org = {'source_id': id,
+           'source': 'ror',
+           'name': item.get('name'),
+           'altnames': item.get('aliases'),
+           'country_code': item.get('country').get('country_code'),
+           'country': item.get('country').get('country_name'),
+           'children': [],
+           'parents': [],
+           'related': []
+           }
+    if len(item.get('types')) > 0:
+        org['funder_type'] = item.get('types')[0]
+    else:
+        org['funder_type'] = 'Other'
+    org['altnames'].extend(item.get('acronyms'))
+    org['altnames'].extend([l['label'] for l in item.get('labels')])
+    external_ids = item.get('external_ids')
+    if external_ids:
+        fundref = external_ids.get('FundRef')
+        if fundref:
+            preferred = fundref.get('preferred')
+            if preferred:
+                org['preferred_fundref'] = preferred
+    for rel in item['relationships']:
+        if rel['type'] == RelationshipType.RELATED.value:
+            org['related'].append({'source': DataSource.ROR.value,
+                                   'source_id': extract_ror_id(rel['id']),
+                                   'name': rel['label']})
+        elif rel['type'] == RelationshipType.CHILD:
+            org['children'].append({'source': DataSource.ROR.value,
+                                   'source_id': extract_ror_id(rel['id']),
+                                   'name': rel['label']})
+        elif rel['type'] == RelationshipType.PARENT:
+            org['parents'].append({'source': DataSource.ROR.value,
+                                   'source_id': extract_ror_id(rel['id']),
+                                   'name': rel['label']})
+    return org
+
+def ror_item_to_funder(item):
+    """Convert an organization from the ROR dump to a validated Funder."""
+    return Funder(**ror_item_to_dict(item))
+
+def ror_items_to_records(items, validate_every=VALIDATE_EVERY):
+    """Yield a FunderRecord for each organization in items, validating one
+       in validate_every of them as a Funder."""
+    should_validate = ValidationSampler(validate_every)
+    for item in items:
+        yield FunderRecord.from_dict(ror_item_to_dict(item), validate=should_validate())
+
+def iter_ror_funders(fp, validate_every=VALIDATE_EVERY):
+    """Yield a FunderRecord for each organization in the ROR dump fp."""
+    return ror_items_to_records(iter_ror_items(fp), validate_every)
+
+def ror_json_member(zipfile):
+    """Return the name of the JSON dump in a ROR zip file. Recent releases
+       also contain a CSV file and a JSON file in the v2 schema, which we
+       do not parse."""
+    names = [info.filename for info in zipfile.infolist() if info.filename.endswith('.json')]
+    for name in names:
+        if 'schema_v2' not in name:
+            return name
+    raise ValueError('no JSON dump in ROR zip file')
+
+def open_ror_dump(path):
+    """Open the ROR dump as a text file. If path is a zip file then the
+       JSON member is decompressed as it is read."""
+    if not str(path).endswith('.zip'):
+        return open(path, 'r', encoding='UTF-8')
+    zipfile = ZipFile(path, 'r')
+    try:
+        member = zipfile.open(ror_json_member(zipfile), 'r')
+    except:
+        zipfile.close()
+        raise
+    # Closing the member does not close the ZipFile, but ZipFile closes
+    # its file once the last open member is closed.
+    zipfile.close()
+    return io.TextIOWrapper(member, encoding='UTF-8')
+
+def parse_ror(filename, validate_every=VALIDATE_EVERY):
+    """Return a FunderList of FunderRecord for potential Funders from ROR.
+       filename may be the JSON dump or the zip file that contains it.
+    """
+    funderslist = FunderList(funders={})
+    count = 0
+    with open_ror_dump(filename) as fp:
+        for funder in iter_ror_funders(fp, validate_every):
+            count += 1
+            if count % 5000 == 0:
+                print('read {} ror entries'.format(count))
+            funderslist.funders[funder.global_id()] = funder
+    return funderslist
@@ -2,22 +2,97 @@
 1. inserting and updating the database
 2. performing a search on the database.
 
-This is imported from the UI as well as create_index.py
+This is imported from the UI as well as create_index.py, so it does not
+import flask, and modules that only the web app needs are imported when
+they are first used.
 """
 
 import argparse
 from datetime import datetime, timezone
 from enum import Enum
+import hashlib
+import itertools
 import json
+import logging
 import math
+import re
 import sys
 import xapian
-from flask import current_app as app
+try:
+    from .countries import canonical_country, country_from_name, country_name
+    from .db_pool import get_pool, pool_stats
+    from .metrics import Metrics, NULL_TIMER
+    from .result_cache import ResultCache
+except ImportError: # imported from the search directory by create_index.py
+    from countries import canonical_country, country_from_name, country_name
+    from db_pool import get_pool, pool_stats
+    from metrics import Metrics, NULL_TIMER
+    from result_cache import ResultCache
 
 # where we store the source for sorting.
 SLOT_NUMBER = 0
+# Fields that are needed to render a list of results are also stored
+# in value slots, so that they can be read without decoding the JSON
+# document data. Optional fields are stored as '' when they are None.
+VALUE_SLOTS = {'id': 1,
+               'name': 2,
+               'source': 3,
+               'source_id': 4,
+               'country': 5,
+               'country_code': 6,
+               'funder_type': 7}
+OPTIONAL_FIELDS = {'country_code'}
+# Fields of a search result that describe the match rather than the funder.
+SCORE_FIELDS = ('docid', 'rank', 'weight', 'percent')
+# The canonical country code from countries.py, used for country facets.
+COUNTRY_SLOT = 8
+# static_score() as a sortable_serialise() value, used by the static ranking.
+STATIC_SCORE_SLOT = 9
+# Weight added to the relevance of a result for a static_score() of 1.
+# A FundReg funder gets 0.6 of this, which usually puts it ahead of a
+# ROR funder with a similar name, as sorting on SLOT_NUMBER used to.
+STATIC_SCORE_WEIGHT = 3.0
+# How results are ordered. 'static' adds the static score to the weight,
+# so the match can stop once no other document can reach the page.
+# 'source' sorts on SLOT_NUMBER and then relevance, which needs every
+# candidate to be examined.
+RANKINGS = ('static', 'source')
+# Number of documents examined by the source ranking, and for facets.
+CHECK_AT_LEAST = 1000
+# Maximum number of values returned for each facet.
+FACET_SIZE = 20
+# Fields that search() can filter on, and the prefix of their boolean terms.
+FILTER_FIELDS = ('country', 'funder_type', 'source')
 # We give extra weight to terms in name
 NAME_WEIGHT = 10
+# Number of related organizations at which static_score() stops growing.
+STATIC_SCORE_SIZE = 500
+# Metadata key prefix for the content hash of each indexed funder.
+HASH_KEY_PREFIX = 'hash:'
+# Length of the longest edge n-gram term, when they are indexed.
+EDGE_NGRAM_LENGTH = 10
+# Metadata key that records the edge n-gram length of an index.
+EDGE_NGRAM_KEY = 'edge_ngram_length'
+# Name of the field that queries edge n-gram terms, as in edge:foun
+EDGE_FIELD = 'edge'
+# Maximum number of terms that a wildcard such as nat* expands to.
+MAX_WILDCARD_EXPANSION = 100
+# Increment this when index_funder() changes how documents are indexed,
+# so that create_index.py --delta reindexes every funder.
+INDEX_FORMAT = 6
+
+log = logging.getLogger('search')
+
+# Results of search() are cached in each process. See configure_result_cache().
+_result_cache = ResultCache()
+# Timings of search() and lookup(). See configure_metrics().
+_metrics = Metrics()
+# Prefix of the names in metrics_text().
+METRICS_PREFIX = 'fundreg'
+# Runs search() for submit_search(). See configure_executor().
+_executor = None
+# See configure_ranking().
+_ranking = 'static'
 
 class SearchPrefix(str, Enum):
     NAME = 'S'
@@ -25,8 +100,54 @@ class SearchPrefix(str, Enum):
     ORGTYPE = 'O'
     ID = 'Q'
     SOURCE = 'XS'
+    COUNTRY = 'XC'
+    FUNDER_TYPE = 'XT'
+    EDGE = 'XE'
+    MERGED = 'XM'
+    UNIQUE_ID = 'XU'
+
+# Words as split for edge n-grams, and the last word of a query that is still being typed.
+WORD_RE = re.compile(r'\w+')
+# A word with a + or - in front is left alone, since a sign cannot apply to
+# the bracketed rewrite.
+PARTIAL_WORD_RE = re.compile(r'(^|\s)(\w+)(\*?)$')
+# The rewrite of a partial word at the end of a spelling-corrected query.
+REWRITTEN_WORD_RE = re.compile(r'\((\S+) OR \S+\)$')
+# Words that the QueryParser treats as operators with FLAG_BOOLEAN.
+OPERATORS = {'AND', 'OR', 'NOT', 'XOR', 'NEAR', 'ADJ'}
+
+def funder_hash(funder):
+    """Return a hash of the content of a Funder. This is stored with each
+       document so that create_index.py --delta can tell which funders changed.
+    """
+    data = json.dumps([INDEX_FORMAT, funder.dict()], sort_keys=True)
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
 
-def index_funder(funder, writable_db=None, termgenerator=None):
+def static_score(funder):
+    """Return a query-independent score between 0 and 1 for a funder. We
+       prefer FundReg entities, and then funders that head or belong to a
+       larger group of organizations.
+    """
+    score = 0.6 if funder.source.value == 'fundreg' else 0.0
+    size = len(funder.children) + len(funder.parents) + len(funder.related)
+    score += 0.4 * min(1.0, math.log1p(size) / math.log1p(STATIC_SCORE_SIZE))
+    return score
+
+def edge_ngrams(text, length=EDGE_NGRAM_LENGTH):
+    """Return the prefixes of each word in text, up to length characters,
+       in lower case. A word may appear more than once."""
+    ngrams = []
+    for word in WORD_RE.findall(text.lower()):
+        ngrams.extend(word[:end] for end in range(1, min(len(word), length) + 1))
+    return ngrams
+
+def get_edge_ngram_length(db):
+    """Return the length of the edge n-gram terms in a database, or 0 if
+       it was built without them."""
+    value = db.get_metadata(EDGE_NGRAM_KEY)
+    return int(value) if value else 0
+
+def index_funder(funder, writable_db=None, termgenerator=None, edge_ngram_length=0):
     """Index the funder. It returns no value. It is used by create_index.py.
        args:
           funder: a Funder from model.py
@@ -34,6 +155,10 @@ def index_funder(funder, writable_db=None, termgenerator=None):
                   the database is opened and closed at the end. This is
                   only useful for indexing individual items that are updated.
           termgenerator: a xapian TermGenerator
+          edge_ngram_length: if this is not 0, then the prefixes of the
+                  words in the names up to this length are also indexed
+                  under SearchPrefix.EDGE, so that a word that is still
+                  being typed is matched by a single term.
     """
     if not termgenerator:
         termgenerator = xapian.TermGenerator()
@@ -43,11 +168,24 @@ def index_funder(funder, writable_db=None, termgenerator=None):
 
     doc = xapian.Document()
     docid = funder.global_id()
-    doc.add_boolean_term(docid)
+    # The only term of a document that is unique to it. Names are indexed
+    # without a prefix, so an unprefixed global ID could also be a word.
+    unique_term = SearchPrefix.UNIQUE_ID.value + docid
+    doc.add_boolean_term(unique_term)
+    # IDs of ROR records merged into this funder by merge.py, for lookup().
+    # They have their own prefix so that they never match unique_term.
+    for merged_id in funder.merged_ids:
+        doc.add_boolean_term(SearchPrefix.MERGED.value + merged_id)
     doc.add_boolean_term(SearchPrefix.SOURCE.value + funder.source.value)
+    country = canonical_country(funder.country_code) or canonical_country(funder.country)
+    if country:
+        doc.add_boolean_term(SearchPrefix.COUNTRY.value + country)
+    doc.add_value(COUNTRY_SLOT, country or '')
+    doc.add_boolean_term(SearchPrefix.FUNDER_TYPE.value + funder.funder_type.value.casefold())
     # We sort on SLOT_NUMBER
     slot_value = '1' if funder.source.value == 'fundreg' else '0'
     doc.add_value(SLOT_NUMBER, slot_value)
+    doc.add_value(STATIC_SCORE_SLOT, xapian.sortable_serialise(static_score(funder)))
     termgenerator.set_document(doc)
 
     name = funder.name
@@ -58,7 +196,11 @@ def index_funder(funder, writable_db=None, termgenerator=None):
     for altname in funder.altnames:
         termgenerator.index_text(altname, 1, SearchPrefix.NAME.value)
         termgenerator.index_text(altname, NAME_WEIGHT)
-    
+    if edge_ngram_length:
+        for text in [name] + list(funder.altnames):
+            for ngram in edge_ngrams(text, edge_ngram_length):
+                doc.add_term(SearchPrefix.EDGE.value + ngram)
+
     termgenerator.increase_termpos()
     location = funder.country
     termgenerator.index_text(location, 1, SearchPrefix.LOCATION.value)
@@ -70,103 +212,611 @@ def index_funder(funder, writable_db=None, termgenerator=None):
 
     termgenerator.increase_termpos()
     termgenerator.index_text(docid, 1, SearchPrefix.ID.value)
+    for merged_id in funder.merged_ids:
+        termgenerator.increase_termpos()
+        termgenerator.index_text(merged_id, 1, SearchPrefix.ID.value)
 
     data = funder.dict()
     data['id'] = docid
-    data['source_id']
-    doc.set_data(json.dumps(data, indent=2))
-    writable_db.replace_document(docid, doc)
+    for field, slot in VALUE_SLOTS.items():
+        value = data.get(field)
+        if isinstance(value, Enum):
+            value = value.value
+        doc.add_value(slot, value if value is not None else '')
+    # No indentation or escaping of non-ASCII names keeps the index small.
+    doc.set_data(json.dumps(data, separators=(',', ':'), ensure_ascii=False))
+    writable_db.replace_document(unique_term, doc)
+    writable_db.set_metadata(HASH_KEY_PREFIX + docid, funder_hash(funder))
 
-def search(db_path, offset=0, limit=1000, textq=None, locationq=None, source=None):
-    """Execute a query on the index. At least one of textq or locationq
-    must be non-None.
+def decode_document(doc, fields=None):
+    """Return a dict with the stored fields of a document.
+       args:
+          doc: a xapian.Document written by index_funder()
+          fields: an optional collection of field names to return. If all
+             of them are in VALUE_SLOTS then the JSON data is not decoded.
+             If this is None then all fields are returned.
+    """
+    if fields is not None and all(f in VALUE_SLOTS for f in fields):
+        # Indexes from before VALUE_SLOTS have no values, so fall back to the data.
+        if doc.get_value(VALUE_SLOTS['id']):
+            item = {}
+            for field in fields:
+                value = doc.get_value(VALUE_SLOTS[field]).decode('utf-8')
+                if not value and field in OPTIONAL_FIELDS:
+                    value = None
+                item[field] = value
+            return item
+    data = json.loads(doc.get_data().decode('utf-8'))
+    if fields is None:
+        return data
+    return {field: data.get(field) for field in fields}
+
+def search(db_path, offset=0, limit=1000, textq=None, locationq=None, source=None, fields=None,
+           timer=None, filters=None, facets=False):
+    """Execute a query on the index. At least one of textq, locationq, or
+    filters must be given.
 
     Args:
        db_path: path to database
        offset: starting offset for paging of results
-       textq: raw query string from the user to be applied to any text field
-       locationq: raw query for location field
-    Returns: dict with the following:
+       textq: raw query string from the user to be applied to any text field.
+          If the index has edge n-grams, then the last word matches any word
+          that starts with it, unless textq ends with a space.
+       locationq: raw query for location field. If it is the whole name of
+          a country then it is applied as a country filter instead. Country
+          codes are only taken as filters when given in filters.
+       fields: optional list of Funder fields and SCORE_FIELDS to return for
+          each result. By default all of them are returned. See decode_document().
+       timer: optional Timer from new_timer() that the stages are recorded
+          in. The caller then calls timer.finish(). By default search()
+          records its own timings.
+       filters: optional dict from a field in FILTER_FIELDS to a list of
+          allowed values. A result must match one value of each field.
+          Countries may be given by name or code.
+       facets: if True then also count the countries and funder types
+          of the matching documents.
+    Returns: dict with the following. It may be shared with the result
+       cache, so callers must not modify it.
        error: string if an error occurs (no other fields in this case)
        parsed_query: debug parsed query
        estimated_results: number of total results available
        results: an array of results
+       facets: if requested, a dict from country and funder_type to a list
+          of values with their counts, most frequent first. The counts cover
+          the facet_documents documents that were examined, which is all of
+          them unless there are more than 1000.
     """
-    if (not textq and not locationq):
-        return {'estimated_results': 0,
-                'parsed_query': '',
-                'spell_corrected_query': '',
-                'sort_order': '',
-                'results': []}
-    db = None
+    if (not textq and not locationq and not filters):
+        return _empty_result()
+    own_timer = timer is None
+    if own_timer:
+        timer = _metrics.timer('search')
+    timer.note(textq=textq, locationq=locationq, source=source, offset=offset)
     try:
-        # Open the database we're going to search.
-
-        db = xapian.Database(db_path)
-
-        # Set up a QueryParser with a stemmer and suitable prefixes
-        queryparser = xapian.QueryParser()
-        queryparser.set_database(db)
-        queryparser.set_stemmer(xapian.Stem("en"))
-        queryparser.set_stemming_strategy(queryparser.STEM_SOME)
-        # Allow users to type id:1001022
-        queryparser.add_prefix('id', SearchPrefix.ID.value)
-
-        # flags are described here: https://getting-started-with-xapian.readthedocs.io/en/latest/concepts/search/queryparser.html
-        # FLAG_BOOLEAN enables boolean operators AND, OR, etc in the query
-        # FLAG_LOVEHATE enables + and -
-        # FLAG_PHRASE enables enclosing phrases in "
-        # FLAG_WILDCARD enables things like * signature scheme to expand the *
-        flags = queryparser.FLAG_SPELLING_CORRECTION | queryparser.FLAG_BOOLEAN | queryparser.FLAG_LOVEHATE | queryparser.FLAG_PHRASE | queryparser.FLAG_WILDCARD
-        # we build a list of subqueries and combine them later with AND.
-        if not textq and not locationq:
-            return {'error': 'missing query'}
-        query_list = []
-        if textq:
-            query_list.append(queryparser.parse_query(textq, flags))
-        if locationq:
-            location_query = queryparser.parse_query(locationq, flags, SearchPrefix.LOCATION.value)
-            query_list.append(location_query)
-        query = xapian.Query(xapian.Query.OP_AND, query_list)
-        if source: # filter on this source value.
-            source_query = xapian.Query(SearchPrefix.SOURCE.value + source)
-            query = xapian.Query(xapian.Query.OP_FILTER, query, source_query)
-        # Use an Enquire object on the database to run the query
-        enquire = xapian.Enquire(db)
-        enquire.set_query(query)
-        res = {'parsed_query': str(query)}
-        # Use source then relevance score.
-        enquire.set_sort_by_value_then_relevance(SLOT_NUMBER, True)
-        # enquire.set_sort_by_relevance()
-        res['sort_order'] = 'sorted by relevance'
-        matches = []
-        # Retrieve the matched set of documents.
-        mset = enquire.get_mset(offset, limit, 1000)
-        for match in mset:
-            item = {'docid': match.docid,
-                    'rank': match.rank,
-                    'weight': match.weight,
-                    'percent': match.percent}
-            fields = json.loads(match.document.get_data().decode())
-            for k,v in fields.items():
-                item[k] = v
-            matches.append(item)
-        res['estimated_results'] = mset.get_matches_estimated()
-        res['results'] = matches
-        spell_corrected = queryparser.get_corrected_query_string()
-        if spell_corrected:
-            res['spell_corrected_query'] = spell_corrected.decode('utf-8')
+        offset = int(offset)
+        limit = int(limit)
+        key = _cache_key(db_path, offset, limit, textq, locationq, source, fields, filters, facets)
+        pool = get_pool(db_path, configure_queryparser)
+        token = pool.token()
+        res = _result_cache.get(key, token)
+        timer.mark('cache')
+        if res is not None:
+            timer.note(cache_hit=True, results=len(res['results']))
+            return res
+        with pool.handle() as handle:
+            timer.mark('open')
+            try:
+                res = _run_search(handle, offset, limit, textq, locationq, source, fields,
+                                  filters, facets, timer)
+            except xapian.DatabaseModifiedError:
+                # The index was updated underneath us, so reopen and try once more.
+                handle.db.reopen()
+                res = _run_search(handle, offset, limit, textq, locationq, source, fields,
+                                  filters, facets, timer)
+        timer.note(results=len(res['results']))
+        _result_cache.put(key, token, res)
+        return res
+    except Exception as e:
+        log.critical('Error in search: {}'.format(str(e)))
+        return {'error': 'Error in server'}
+    finally:
+        if own_timer:
+            timer.finish()
+
+def _empty_result():
+    return {'estimated_results': 0,
+            'parsed_query': '',
+            'spell_corrected_query': '',
+            'sort_order': '',
+            'results': []}
+
+def search_batch(db_path, queries, limit=10, fields=None, jobs=1, timer=None):
+    """Run many queries, such as funder strings from the acknowledgments of
+    a whole volume, without the overhead of one search() call per query.
+    The queries are split into jobs contiguous chunks, and each chunk runs
+    in its own thread on one database handle and QueryParser from the pool.
+
+    Args:
+       db_path: path to database
+       queries: list of (textq, locationq, source) tuples, or of dicts with
+          those keys and optionally filters as for search()
+       limit: number of results returned for each query
+       fields: optional list of Funder fields to return. See decode_document().
+       jobs: number of threads
+       timer: optional Timer from new_timer(), as for search()
+    Returns: dict with the following:
+       error: string if an error occurs (no other fields in this case)
+       results: a list with the result of search() for each query, in the
+          same order. A query that fails has only an error.
+    """
+    own_timer = timer is None
+    if own_timer:
+        timer = _metrics.timer('batch')
+    timer.note(queries=len(queries))
+    try:
+        pool = get_pool(db_path, configure_queryparser)
+        token = pool.token()
+        jobs = max(1, min(jobs, len(queries)))
+        if jobs == 1:
+            results = _run_batch(pool, token, queries, int(limit), fields)
         else:
-            res['spell_corrected_query'] = ''
-        db.close()
+            from concurrent.futures import ThreadPoolExecutor
+            size = math.ceil(len(queries) / jobs)
+            chunks = [queries[i:i + size] for i in range(0, len(queries), size)]
+            with ThreadPoolExecutor(len(chunks)) as executor:
+                results = list(itertools.chain.from_iterable(
+                    executor.map(lambda chunk: _run_batch(pool, token, chunk, int(limit), fields), chunks)))
+        timer.mark('search')
+        timer.note(results=sum(len(res.get('results', [])) for res in results))
+        return {'results': results}
+    except Exception as e:
+        log.critical('Error in search_batch: {}'.format(str(e)))
+        return {'error': 'Error in server'}
+    finally:
+        if own_timer:
+            timer.finish()
+
+def _batch_query(query):
+    """Return (textq, locationq, source, filters) for a query of search_batch()."""
+    if isinstance(query, dict):
+        return (query.get('textq'), query.get('locationq'), query.get('source'), query.get('filters'))
+    textq, locationq, source = (list(query) + [None, None, None])[:3]
+    return (textq, locationq, source, None)
+
+def _run_batch(pool, token, queries, limit, fields):
+    """Run queries on one handle. A query that fails gets an error in its
+       place, so that it cannot take the rest of the batch with it."""
+    results = []
+    with pool.handle() as handle:
+        for query in queries:
+            try:
+                res = _run_batch_query(pool.db_path, handle, token, query, limit, fields)
+            except (xapian.QueryParserError, ValueError, TypeError, AttributeError) as e:
+                res = {'error': 'Invalid query: {}'.format(str(e))}
+            except Exception as e:
+                log.error('Error in search_batch query {!r}: {}'.format(query, str(e)))
+                res = {'error': 'Error in server'}
+            results.append(res)
+    return results
+
+def _run_batch_query(db_path, handle, token, query, limit, fields):
+    textq, locationq, source, filters = _batch_query(query)
+    if not textq and not locationq and not filters:
+        return _empty_result()
+    key = _cache_key(db_path, 0, limit, textq, locationq, source, fields, filters, False)
+    res = _result_cache.get(key, token)
+    if res is None:
+        try:
+            res = _run_search(handle, 0, limit, textq, locationq, source, fields,
+                              filters, False, NULL_TIMER)
+        except xapian.DatabaseModifiedError:
+            handle.db.reopen()
+            res = _run_search(handle, 0, limit, textq, locationq, source, fields,
+                              filters, False, NULL_TIMER)
+        # Results are not added to the cache, since a large batch of
+        # one-off queries would evict the popular ones.
+    return res
+
+def _cache_key(db_path, offset, limit, textq, locationq, source, fields, filters=None, facets=False):
+    """Normalize the arguments of search() into a key for the result cache.
+       The cache is shared by every db_path that a process serves, so the
+       key includes it. Case is preserved since the QueryParser treats AND and and differently,
+       and so is a trailing space, which marks the last word as complete.
+    """
+    def normalize(q):
+        if not q:
+            return ''
+        return ' '.join(q.split()) + (' ' if q[-1].isspace() and q.strip() else '')
+    if filters:
+        filters = tuple(sorted((field, tuple(sorted(values))) for field, values in filters.items() if values))
+    return (db_path, normalize(textq), normalize(locationq), source or '', offset, limit,
+            tuple(fields) if fields is not None else None, filters or None, bool(facets))
+
+def configure_result_cache(max_size, ttl):
+    """Replace the result cache of search(). A max_size of 0 disables it."""
+    global _result_cache
+    _result_cache = ResultCache(max_size, ttl)
+
+def cache_stats():
+    """Return the counters of the result cache of search()."""
+    return _result_cache.stats()
+
+def configure_executor(max_workers, max_pending):
+    """Run submit_search() in a pool of max_workers threads. Identical
+       queries that are queued or running at the same time are run once."""
+    global _executor
+    try:
+        from .coalesce import CoalescingExecutor
+    except ImportError:
+        from coalesce import CoalescingExecutor
+    if _executor:
+        _executor.shutdown()
+    _executor = CoalescingExecutor(max_workers, max_pending)
+
+def submit_search(db_path, offset=0, limit=1000, textq=None, locationq=None, source=None, fields=None,
+                  filters=None, facets=False):
+    """Queue search() in the pool set up by configure_executor(). If the
+       same query is already queued or running, this shares its result.
+    Returns: a coalesce.Ticket. Its wait() returns the result of search().
+    Raises: coalesce.Overloaded if too many queries are pending.
+    """
+    key = _cache_key(db_path, offset, limit, textq, locationq, source, fields, filters, facets)
+    return _executor.submit(key, search, db_path, offset, limit, textq, locationq, source, fields,
+                            filters=filters, facets=facets)
+
+def configure_metrics(enabled, slow_query_seconds=None):
+    """Replace the metrics of search() and lookup(). When enabled is False,
+       new_timer() returns a timer that records nothing. Queries slower than
+       slow_query_seconds are logged to the search.slow_queries logger."""
+    global _metrics
+    _metrics = Metrics(enabled, slow_query_seconds)
+
+def configure_ranking(ranking):
+    """Set how search() orders results, one of RANKINGS. Indexes built
+       before STATIC_SCORE_SLOT are always ranked by source. The result
+       cache is cleared, since its results were ranked the old way."""
+    global _ranking
+    if ranking not in RANKINGS:
+        raise ValueError('unknown ranking {}'.format(ranking))
+    _ranking = ranking
+    _result_cache.clear()
+
+def new_timer(endpoint):
+    """Return a Timer for a request that calls search() or lookup(), so
+       that the caller can add its own stages such as jsonify."""
+    return _metrics.timer(endpoint)
+
+def metrics_text():
+    """Return the metrics of this process in the Prometheus text format."""
+    lines = _metrics.lines(METRICS_PREFIX)
+    cache = _result_cache.stats()
+    for name in ['hits', 'misses', 'evictions', 'invalidations']:
+        lines.append('# TYPE {}_result_cache_{}_total counter'.format(METRICS_PREFIX, name))
+        lines.append('{}_result_cache_{}_total {}'.format(METRICS_PREFIX, name, cache[name]))
+    lines.append('# TYPE {}_result_cache_size gauge'.format(METRICS_PREFIX))
+    lines.append('{}_result_cache_size {}'.format(METRICS_PREFIX, cache['size']))
+    pools = pool_stats()
+    for name, kind in [('epoch', 'gauge'), ('swaps', 'counter'), ('reopens', 'counter'),
+                       ('opened', 'counter'), ('in_use', 'gauge'), ('idle', 'gauge')]:
+        metric = '{}_index_{}{}'.format(METRICS_PREFIX, name, '_total' if kind == 'counter' else '')
+        lines.append('# TYPE {} {}'.format(metric, kind))
+        for db_path, stats in sorted(pools.items()):
+            lines.append('{}{{db_path="{}"}} {}'.format(metric, db_path, stats[name]))
+    if _executor:
+        stats = _executor.stats()
+        for name in ['submitted', 'coalesced', 'cancelled', 'rejected']:
+            lines.append('# TYPE {}_executor_{}_total counter'.format(METRICS_PREFIX, name))
+            lines.append('{}_executor_{}_total {}'.format(METRICS_PREFIX, name, stats[name]))
+        lines.append('# TYPE {}_executor_pending gauge'.format(METRICS_PREFIX))
+        lines.append('{}_executor_pending {}'.format(METRICS_PREFIX, stats['pending']))
+    # The generation is reported as a label, as with the info metrics of Prometheus.
+    lines.append('# TYPE {}_index_generation_info gauge'.format(METRICS_PREFIX))
+    for db_path, stats in sorted(pools.items()):
+        lines.append('{}_index_generation_info{{db_path="{}",generation="{}"}} 1'.format(
+            METRICS_PREFIX, db_path, stats['generation']))
+    return '\n'.join(lines) + '\n'
+
+def lookup(db_path, ids, fields=None, timer=None):
+    """Fetch funders by global ID, such as fundreg_100000001 or ror_05wvpxv85.
+    This reads the posting list of the unique boolean term that index_funder()
+    adds for the global ID, so there is no query parsing or ranking. The ID
+    of a ROR record that was merged into a FundReg funder returns that funder.
+
+    Args:
+       db_path: path to database
+       ids: list of global IDs
+       fields: optional list of Funder fields to return. See decode_document().
+       timer: optional Timer from new_timer(), as for search()
+    Returns: dict with the following:
+       error: string if an error occurs (no other fields in this case)
+       results: dict from each ID to its funder, or None if it does not exist
+    """
+    own_timer = timer is None
+    if own_timer:
+        timer = _metrics.timer('lookup')
+    timer.note(ids=len(ids))
+    try:
+        pool = get_pool(db_path, configure_queryparser)
+        with pool.handle() as handle:
+            timer.mark('open')
+            try:
+                res = _run_lookup(handle, ids, fields)
+            except xapian.DatabaseModifiedError:
+                handle.db.reopen()
+                res = _run_lookup(handle, ids, fields)
+        timer.mark('lookup')
+        timer.note(results=sum(1 for item in res['results'].values() if item))
         return res
     except Exception as e:
-        app.logger.critical('Error in search: {}'.format(str(e)))
-        if db:
-            db.close()
+        log.critical('Error in lookup: {}'.format(str(e)))
         return {'error': 'Error in server'}
-                            
-            
+    finally:
+        if own_timer:
+            timer.finish()
+
+def _document_id(doc):
+    """Return the global ID of a document written by index_funder()."""
+    value = doc.get_value(VALUE_SLOTS['id'])
+    if value:
+        return value.decode('utf-8')
+    return json.loads(doc.get_data().decode('utf-8')).get('id')
+
+def has_unique_ids(db):
+    """Return True if index_funder() gave the documents of db unique ID terms."""
+    for _ in db.allterms(SearchPrefix.UNIQUE_ID.value):
+        return True
+    return False
+
+def _run_lookup(handle, ids, fields):
+    db = handle.db
+    results = {}
+    for docid in ids:
+        item = None
+        if not docid:
+            results[docid] = None
+            continue
+        for posting in db.postlist(SearchPrefix.UNIQUE_ID.value + docid):
+            item = decode_document(db.get_document(posting.docid), fields)
+            break
+        if item is None:
+            if 'unique_ids' not in handle.info:
+                handle.info['unique_ids'] = has_unique_ids(db)
+            if not handle.info['unique_ids']:
+                # Indexes before INDEX_FORMAT 6 have the global ID as an
+                # unprefixed term, which words of names share, so every
+                # document with the term has to be checked.
+                for posting in db.postlist(docid):
+                    doc = db.get_document(posting.docid)
+                    if _document_id(doc) == docid:
+                        item = decode_document(doc, fields)
+                        break
+        if item is None:
+            # The prefix means that only merged IDs can match here.
+            for posting in db.postlist(SearchPrefix.MERGED.value + docid):
+                item = decode_document(db.get_document(posting.docid), fields)
+                break
+        results[docid] = item
+    return {'results': results}
+
+def configure_queryparser(queryparser):
+    """Set up a QueryParser with a stemmer and suitable prefixes. This is
+       called once for each database handle in the pool rather than for
+       every query.
+    """
+    queryparser.set_stemmer(xapian.Stem("en"))
+    queryparser.set_stemming_strategy(queryparser.STEM_SOME)
+    # Allow users to type id:1001022
+    queryparser.add_prefix('id', SearchPrefix.ID.value)
+    # rewrite_partial_word() turns the last word into edge:word
+    queryparser.add_prefix(EDGE_FIELD, _edge_processor)
+    # Short wildcards like a* would otherwise expand to much of the vocabulary.
+    queryparser.set_max_expansion(MAX_WILDCARD_EXPANSION, xapian.Query.WILDCARD_LIMIT_MOST_FREQUENT)
+
+class EdgeFieldProcessor(xapian.FieldProcessor):
+    """Parses edge:word into the single edge n-gram term for word. A
+       prefix added with a term prefix would be stemmed by the QueryParser."""
+    def __call__(self, text):
+        return xapian.Query(SearchPrefix.EDGE.value + text.lower())
+
+# The QueryParser does not keep a reference to the processor.
+_edge_processor = EdgeFieldProcessor()
+
+def rewrite_partial_word(textq, length):
+    """Return textq with the word at the end, which may still be incomplete
+       because the user is typing, rewritten to match either the word itself,
+       stemmed and open to spelling correction as usual, or any word that
+       starts with it. For a word of up to length characters the prefix is
+       edge:word, which is one term built by index_funder(), and for a
+       longer word it is the wildcard word*, which matches few terms, so
+       foun becomes (foun OR edge:foun). A word that already ends with *
+       becomes edge:word alone if it is short enough. A query that ends
+       with a space, an operator, a word with a sign, or inside a phrase is
+       returned unchanged.
+       returns:
+          (query, tail, rewritten tail), where tail is None if there was no change
+    """
+    match = PARTIAL_WORD_RE.search(textq)
+    if not match or textq.count('"') % 2 or match.group(2) in OPERATORS:
+        return textq, None, None
+    space, word, star = match.groups()
+    if star:
+        if len(word) > length:
+            return textq, None, None
+        rewritten = '{}:{}'.format(EDGE_FIELD, word)
+    elif len(word) <= length:
+        rewritten = '({0} OR {1}:{0})'.format(word, EDGE_FIELD)
+    else:
+        rewritten = '({0} OR {0}*)'.format(word)
+    tail = textq[match.start() + len(space):]
+    return textq[:match.start() + len(space)] + rewritten, tail, rewritten
+
+def restore_partial_word(corrected, tail, rewritten):
+    """Return the spelling-corrected form of a query from
+       rewrite_partial_word() with the rewrite undone, so that the user
+       sees what they typed, or the correction of the word if it has one."""
+    match = REWRITTEN_WORD_RE.search(corrected)
+    if rewritten.startswith('(') and match:
+        return corrected[:match.start()] + match.group(1)
+    if corrected.endswith(rewritten):
+        return corrected[:-len(rewritten)] + tail
+    return corrected
+
+# flags are described here: https://getting-started-with-xapian.readthedocs.io/en/latest/concepts/search/queryparser.html
+# FLAG_BOOLEAN enables boolean operators AND, OR, etc in the query
+# FLAG_LOVEHATE enables + and -
+# FLAG_PHRASE enables enclosing phrases in "
+# FLAG_WILDCARD enables things like * signature scheme to expand the *
+QUERY_FLAGS = (xapian.QueryParser.FLAG_SPELLING_CORRECTION |
+               xapian.QueryParser.FLAG_BOOLEAN |
+               xapian.QueryParser.FLAG_LOVEHATE |
+               xapian.QueryParser.FLAG_PHRASE |
+               xapian.QueryParser.FLAG_WILDCARD)
+
+def filter_terms(field, values):
+    """Return the boolean terms for the values of a filter on field."""
+    terms = []
+    for value in values:
+        if field == 'country':
+            value = canonical_country(value) or value.casefold()
+            terms.append(SearchPrefix.COUNTRY.value + value)
+        elif field == 'funder_type':
+            terms.append(SearchPrefix.FUNDER_TYPE.value + value.casefold())
+        elif field == 'source':
+            terms.append(SearchPrefix.SOURCE.value + value)
+        else:
+            raise ValueError('cannot filter on {}'.format(field))
+    return terms
+
+def filter_query(filters):
+    """Return a boolean query that matches the filters, or None if there are
+       none. A field with an empty list of values matches nothing."""
+    subqueries = []
+    for field, values in sorted(filters.items()):
+        terms = filter_terms(field, values)
+        if not terms:
+            return xapian.Query.MatchNothing
+        subqueries.append(xapian.Query(xapian.Query.OP_OR, [xapian.Query(t) for t in terms]))
+    if not subqueries:
+        return None
+    return xapian.Query(xapian.Query.OP_AND, subqueries)
+
+def _narrow(filters, field, value):
+    """Restrict the filter on field to value. The values of a field are
+       alternatives, so if the filter already has values then the result
+       is value if it is one of them, and otherwise nothing."""
+    if field in filters:
+        allowed = set(filter_terms(field, filters[field]))
+        filters[field] = [value] if filter_terms(field, [value])[0] in allowed else []
+    else:
+        filters[field] = [value]
+
+def _facet_values(spy, describe):
+    values = []
+    for item in spy.top_values(FACET_SIZE):
+        value = item.term.decode('utf-8')
+        if value:
+            values.append(dict(describe(value), count=item.termfreq))
+    return values
+
+def _run_search(handle, offset, limit, textq, locationq, source, fields, filters, facets, timer):
+    """Run the query using a SearchHandle from the pool."""
+    db = handle.db
+    queryparser = handle.queryparser
+    filters = {field: list(values) for field, values in (filters or {}).items() if values}
+    if source:
+        _narrow(filters, 'source', source)
+    # A country name in locationq is a filter rather than text. Codes are
+    # not, since a typed prefix such as "in" or "aus" is often one.
+    country = country_from_name(locationq)
+    if country:
+        _narrow(filters, 'country', country)
+        locationq = None
+    # we build a list of subqueries and combine them later with AND.
+    query_list = []
+    if textq:
+        if 'edge_ngram_length' not in handle.info:
+            handle.info['edge_ngram_length'] = get_edge_ngram_length(db)
+        tail = None
+        if handle.info['edge_ngram_length']:
+            textq, tail, rewritten = rewrite_partial_word(textq, handle.info['edge_ngram_length'])
+        query_list.append(queryparser.parse_query(textq, QUERY_FLAGS))
+    if locationq:
+        location_query = queryparser.parse_query(locationq, QUERY_FLAGS, SearchPrefix.LOCATION.value)
+        query_list.append(location_query)
+    if query_list:
+        query = xapian.Query(xapian.Query.OP_AND, query_list)
+    else:
+        query = xapian.Query.MatchAll
+    ranking = _ranking
+    if ranking == 'static':
+        if 'static_score' not in handle.info:
+            handle.info['static_score'] = bool(db.get_value_upper_bound(STATIC_SCORE_SLOT))
+        if not handle.info['static_score']:
+            ranking = 'source'
+    if ranking == 'static':
+        # The posting source has an upper bound from the value statistics,
+        # which lets the matcher skip documents that cannot make the page.
+        static_source = xapian.ValueWeightPostingSource(STATIC_SCORE_SLOT)
+        static_query = xapian.Query(xapian.Query.OP_SCALE_WEIGHT, xapian.Query(static_source),
+                                    STATIC_SCORE_WEIGHT)
+        query = xapian.Query(xapian.Query.OP_AND_MAYBE, query, static_query)
+    boolean_query = filter_query(filters)
+    if boolean_query:
+        query = xapian.Query(xapian.Query.OP_FILTER, query, boolean_query)
+    timer.mark('parse')
+    # Use an Enquire object on the database to run the query
+    enquire = xapian.Enquire(db)
+    enquire.set_query(query)
+    if facets:
+        country_spy = xapian.ValueCountMatchSpy(COUNTRY_SLOT)
+        type_spy = xapian.ValueCountMatchSpy(VALUE_SLOTS['funder_type'])
+        enquire.add_matchspy(country_spy)
+        enquire.add_matchspy(type_spy)
+    res = {'parsed_query': str(query)}
+    if ranking == 'static':
+        enquire.set_sort_by_relevance()
+        res['sort_order'] = 'sorted by relevance and static score'
+        # Facet counts need a fixed number of documents to be examined.
+        check_at_least = CHECK_AT_LEAST if facets else 0
+    else:
+        # Use source then relevance score.
+        enquire.set_sort_by_value_then_relevance(SLOT_NUMBER, True)
+        res['sort_order'] = 'sorted by source and relevance'
+        check_at_least = CHECK_AT_LEAST
+    matches = []
+    # Retrieve the matched set of documents.
+    mset = enquire.get_mset(offset, limit, check_at_least)
+    timer.mark('match')
+    if fields is None:
+        score_fields = SCORE_FIELDS
+        doc_fields = None
+    else:
+        score_fields = [field for field in fields if field in SCORE_FIELDS]
+        doc_fields = [field for field in fields if field not in SCORE_FIELDS]
+    for match in mset:
+        item = {field: getattr(match, field) for field in score_fields}
+        if doc_fields is None or doc_fields:
+            item.update(decode_document(match.document, doc_fields))
+        matches.append(item)
+    timer.mark('decode')
+    if facets:
+        res['facets'] = {'country': _facet_values(country_spy,
+                                                  lambda code: {'value': code, 'name': country_name(code)}),
+                         'funder_type': _facet_values(type_spy, lambda value: {'value': value})}
+        res['facet_documents'] = country_spy.get_total()
+    res['estimated_results'] = mset.get_matches_estimated()
+    res['results'] = matches
+    spell_corrected = queryparser.get_corrected_query_string()
+    if spell_corrected:
+        spell_corrected = spell_corrected.decode('utf-8')
+        if textq and tail:
+            # Show the user what they typed rather than our rewrite.
+            spell_corrected = restore_partial_word(spell_corrected, tail, rewritten)
+        res['spell_corrected_query'] = spell_corrected
+    else:
+        res['spell_corrected_query'] = ''
+    return res
+
 if __name__ == '__main__':
     arguments = argparse.ArgumentParser()
     arguments.add_argument('--dbpath',
@@ -178,9 +828,20 @@ if __name__ == '__main__':
                            help='query restricted to location')
     arguments.add_argument('--source',
                            help='ror or fundreg or None')
+    arguments.add_argument('--country',
+                           action='append',
+                           help='only funders from this country (may be repeated)')
+    arguments.add_argument('--funder_type',
+                           action='append',
+                           help='only funders of this type (may be repeated)')
+    arguments.add_argument('--facets',
+                           action='store_true',
+                           help='count countries and funder types of the results')
     args = arguments.parse_args()
-    if not args.name and not args.location:
-        print('one of --name or --location is required')
+    filters = {'country': args.country, 'funder_type': args.funder_type}
+    if not args.name and not args.location and not args.country and not args.funder_type:
+        print('one of --name, --location, --country, or --funder_type is required')
         sys.exit(2)
-    results = search(args.dbpath, 0, 100, args.name, args.location, args.source)
+    results = search(args.dbpath, 0, 100, args.name, args.location, args.source,
+                     filters=filters, facets=args.facets)
     print(json.dumps(results, indent=2))
@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+
+"""
+A binary snapshot format for a FunderList. This is used for the caches
+of parsed data in data/registry.snap and data/ror.snap, because
+FunderList.parse_raw() on the equivalent JSON has to parse and validate
+hundreds of MB of text before indexing can start.
+
+The file is read through mmap, so a single Funder can be read with
+Snapshot.get() without loading the rest. Records were validated when
+they were parsed, so they are built with construct() which skips
+validation, or as a FunderRecord for the build pipeline. All integers
+are little-endian. The layout is:
+
+   header:   magic, version, and the counts of strings, records,
+             altnames, and relationships (HEADER)
+   strings:  nstrings+1 u32 byte offsets into the string data
+   records:  nrecords records (RECORD). Strings are indices into the
+             string table, with NONE for a missing value. Lists are a
+             start and count in the altnames or relationships table.
+   altnames: naltnames u32 string indices
+   rels:     nrels relationships (RELATIONSHIP)
+   index:    nrecords u32 record numbers sorted by global_id
+   data:     UTF-8 string data
+"""
+
+import argparse
+from array import array
+import mmap
+import struct
+import sys
+from model import Funder, FunderList, FunderRecord, Relationship, DataSource, FunderType
+
+MAGIC = b'FUNDSNAP'
+VERSION = 1
+HEADER = struct.Struct('<8sIIIII')
+# source, funder_type, then global_id, source_id, name, country,
+# country_code, preferred_fundref, and start and count for altnames,
+# children, parents, and related.
+RECORD = struct.Struct('<BBxx14I')
+# source, source_id, name
+RELATIONSHIP = struct.Struct('<BxxxII')
+NONE = 0xFFFFFFFF
+SOURCES = list(DataSource)
+FUNDER_TYPES = list(FunderType)
+
+class _StringTable:
+    """Interns strings while a snapshot is written."""
+    def __init__(self):
+        self.index = {}
+        self.data = []
+
+    def add(self, value):
+        if value is None:
+            return NONE
+        num = self.index.get(value)
+        if num is None:
+            num = len(self.data)
+            self.index[value] = num
+            self.data.append(value.encode('utf-8'))
+        return num
+
+def write_snapshot(funderlist, path):
+    """Write the funders of a FunderList to path."""
+    strings = _StringTable()
+    records = []
+    altnames = array('I')
+    rels = bytearray()
+    gids = []
+    nrels = 0
+    for funder in funderlist.funders.values():
+        gid = funder.global_id()
+        gids.append(gid)
+        fields = [SOURCES.index(funder.source), FUNDER_TYPES.index(funder.funder_type),
+                  strings.add(gid), strings.add(funder.source_id), strings.add(funder.name),
+                  strings.add(funder.country), strings.add(funder.country_code),
+                  strings.add(funder.preferred_fundref),
+                  len(altnames), len(funder.altnames)]
+        altnames.extend(strings.add(name) for name in funder.altnames)
+        for rel_list in (funder.children, funder.parents, funder.related):
+            fields.extend([nrels, len(rel_list)])
+            for rel in rel_list:
+                rels += RELATIONSHIP.pack(SOURCES.index(rel.source),
+                                          strings.add(rel.source_id),
+                                          strings.add(rel.name))
+                nrels += 1
+        records.append(RECORD.pack(*fields))
+    offsets = array('I', [0])
+    for data in strings.data:
+        offsets.append(offsets[-1] + len(data))
+    index = array('I', sorted(range(len(gids)), key=lambda i: gids[i]))
+    if sys.byteorder != 'little':
+        for arr in (offsets, altnames, index):
+            arr.byteswap()
+    with open(path, 'wb') as fp:
+        fp.write(HEADER.pack(MAGIC, VERSION, len(strings.data), len(records), len(altnames), nrels))
+        fp.write(offsets.tobytes())
+        fp.write(b''.join(records))
+        fp.write(altnames.tobytes())
+        fp.write(rels)
+        fp.write(index.tobytes())
+        fp.write(b''.join(strings.data))
+
+class Snapshot:
+    """Read access to a snapshot file written by write_snapshot()."""
+    def __init__(self, path):
+        self._fp = open(path, 'rb')
+        self._mm = mmap.mmap(self._fp.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.nstrings, self.nrecords, naltnames, nrels = HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC:
+            raise ValueError('{} is not a funder snapshot'.format(path))
+        if version != VERSION:
+            raise ValueError('unsupported snapshot version {} in {}'.format(version, path))
+        self._offsets = HEADER.size
+        self._records = self._offsets + 4 * (self.nstrings + 1)
+        self._altnames = self._records + RECORD.size * self.nrecords
+        self._rels = self._altnames + 4 * naltnames
+        self._index = self._rels + RELATIONSHIP.size * nrels
+        self._data = self._index + 4 * self.nrecords
+        self._strings = None
+
+    def close(self):
+        self._strings = None
+        self._mm.close()
+        self._fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return self.nrecords
+
+    def _string(self, num):
+        if num == NONE:
+            return None
+        if self._strings is not None:
+            return self._strings[num]
+        start, end = struct.unpack_from('<II', self._mm, self._offsets + 4 * num)
+        return self._mm[self._data + start:self._data + end].decode('utf-8')
+
+    def _u32(self, base, num):
+        return struct.unpack_from('<I', self._mm, base + 4 * num)[0]
+
+    def _relationships(self, start, count):
+        rels = []
+        for num in range(start, start + count):
+            source, source_id, name = RELATIONSHIP.unpack_from(self._mm, self._rels + RELATIONSHIP.size * num)
+            rels.append({'source': SOURCES[source],
+                         'source_id': self._string(source_id),
+                         'name': self._string(name)})
+        return rels
+
+    def record(self, num, compact=False):
+        """Return the Funder stored as record number num, or a FunderRecord
+           if compact is True.
+        """
+        (source, funder_type, _, source_id, name, country, country_code, preferred_fundref,
+         alt_start, alt_count, children_start, children_count, parents_start, parents_count,
+         related_start, related_count) = RECORD.unpack_from(self._mm, self._records + RECORD.size * num)
+        altnames = [self._string(self._u32(self._altnames, i))
+                    for i in range(alt_start, alt_start + alt_count)]
+        data = {'source': SOURCES[source],
+                'source_id': self._string(source_id),
+                'name': self._string(name),
+                'country': self._string(country),
+                'country_code': self._string(country_code),
+                'funder_type': FUNDER_TYPES[funder_type],
+                'preferred_fundref': self._string(preferred_fundref),
+                'altnames': altnames,
+                'children': self._relationships(children_start, children_count),
+                'parents': self._relationships(parents_start, parents_count),
+                'related': self._relationships(related_start, related_count)}
+        if compact:
+            return FunderRecord.from_dict(data)
+        for key in ('children', 'parents', 'related'):
+            data[key] = [Relationship.construct(**rel) for rel in data[key]]
+        return Funder.construct(**data)
+
+    def _global_id(self, num):
+        gid = RECORD.unpack_from(self._mm, self._records + RECORD.size * num)[2]
+        return self._string(gid)
+
+    def global_ids(self):
+        """Yield the global_id of every record."""
+        for num in range(self.nrecords):
+            yield self._global_id(num)
+
+    def get(self, global_id):
+        """Return the Funder with global_id, or None. This is a binary
+           search on the index, so only a few pages of the file are read.
+        """
+        lo, hi = 0, self.nrecords
+        while lo < hi:
+            mid = (lo + hi) // 2
+            num = self._u32(self._index, mid)
+            gid = self._global_id(num)
+            if gid == global_id:
+                return self.record(num)
+            if gid < global_id:
+                lo = mid + 1
+            else:
+                hi = mid
+        return None
+
+    def __iter__(self):
+        for num in range(self.nrecords):
+            yield self.record(num)
+
+    def iter_records(self):
+        """Yield a FunderRecord for every record."""
+        for num in range(self.nrecords):
+            yield self.record(num, compact=True)
+
+    def load_strings(self):
+        """Decode the whole string table at once, which is much faster
+           than decoding strings one at a time when reading every record.
+        """
+        offsets = array('I', self._mm[self._offsets:self._records])
+        if sys.byteorder != 'little':
+            offsets.byteswap()
+        data = self._mm[self._data:]
+        self._strings = [data[offsets[i]:offsets[i + 1]].decode('utf-8')
+                         for i in range(self.nstrings)]
+
+    def funderlist(self):
+        """Return a FunderList with a FunderRecord for every record."""
+        self.load_strings()
+        funders = {}
+        for funder in self.iter_records():
+            funders[funder.global_id()] = funder
+        return FunderList.construct(funders=funders)
+
+def read_snapshot(path):
+    """Return the FunderList stored in a snapshot file."""
+    with Snapshot(path) as snapshot:
+        return snapshot.funderlist()
+
+if __name__ == '__main__':
+    arguments = argparse.ArgumentParser()
+    arguments.add_argument('--json',
+                           help='Convert this JSON FunderList to a snapshot')
+    arguments.add_argument('--snapshot',
+                           required=True,
+                           help='Path to the snapshot file')
+    arguments.add_argument('--id',
+                           help='Print the funder with this global ID')
+    args = arguments.parse_args()
+    if args.json:
+        with open(args.json, 'r', encoding='UTF-8') as fp:
+            write_snapshot(FunderList.parse_raw(fp.read()), args.snapshot)
+    with Snapshot(args.snapshot) as snapshot:
+        print('{} records in {}'.format(len(snapshot), args.snapshot))
+        if args.id:
+            funder = snapshot.get(args.id)
+            print(funder.json(indent=2) if funder else 'no such funder')
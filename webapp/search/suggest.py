@@ -0,0 +1,168 @@
+"""
+Prefix completion of funder names for the typeahead in the UI.
+
+This does not use xapian. create_index.py writes a file suggest.json
+inside the database directory with a sorted array of normalized names
+and altnames. A lookup is a binary search for the range of names
+that start with the prefix. Funders are numbered in order of
+decreasing static score, so the best matches in a range are the ones
+with the smallest numbers. For short prefixes the range can be very
+large, so the best TOP_N funders are precomputed for every prefix
+whose range has more than SCAN_LIMIT names.
+
+Each suggestion has the name that matched the prefix as well as the
+main name of the funder, since a browser hides the options of a
+datalist that do not contain what was typed, so "nsf" must be offered
+as "NSF" rather than as "National Science Foundation".
+"""
+
+import bisect
+import heapq
+import itertools
+import json
+import os
+import unicodedata
+try:
+    from .generations import GenerationFile
+except ImportError: # imported from the search directory by create_index.py
+    from generations import GenerationFile
+
+SUGGEST_FILE = 'suggest.json'
+SUGGEST_FORMAT = 2
+# Maximum number of suggestions that can be returned.
+TOP_N = 20
+# Prefixes matching more than this many names have precomputed results.
+SCAN_LIMIT = 256
+
+def normalize(text):
+    """Fold case, remove accents, and collapse whitespace."""
+    text = unicodedata.normalize('NFKD', text)
+    text = ''.join(c for c in text if not unicodedata.combining(c))
+    return ' '.join(text.casefold().split())
+
+class SuggestBuilder:
+    """Collects the names of funders as they are indexed, and writes the
+       completion data. Only the names and scores are kept, so this can
+       be used on a stream of funders.
+       args:
+          score: function that returns the static score of a Funder
+    """
+    def __init__(self, score):
+        self.score = score
+        self.funders = []
+
+    def add(self, funder):
+        # Each normalized key with the name that it came from, or None for
+        # the main name.
+        keys = {}
+        for name in [funder.name] + list(funder.altnames):
+            key = normalize(name)
+            if key and key not in keys:
+                keys[key] = None if name == funder.name else name
+        self.funders.append((-self.score(funder), funder.global_id(), funder.name, keys))
+
+    def observe(self, funders):
+        """Yield each of funders after adding it."""
+        for funder in funders:
+            self.add(funder)
+            yield funder
+
+    def write(self, path):
+        """Write the completion data to path, usually SUGGEST_FILE in the database directory."""
+        ranked = sorted(self.funders, key=lambda x: (x[0], x[1]))
+        funder_names = [[global_id, name] for _, global_id, name, _ in ranked]
+        entries = sorted((key, num, name) for num, (_, _, _, keys) in enumerate(ranked)
+                         for key, name in keys.items())
+        keys = [key for key, _, _ in entries]
+        refs = [num for _, num, _ in entries]
+        names = [name for _, _, name in entries]
+        top = {}
+        # Ranges of entries that share a prefix one shorter than length.
+        # Only ranges with more than SCAN_LIMIT entries are split further,
+        # so each entry is grouped once for every precomputed prefix of it.
+        ranges = [(0, len(keys), 1)]
+        while ranges:
+            lo, hi, length = ranges.pop()
+            for prefix, group in itertools.groupby(range(lo, hi), key=lambda i: keys[i][:length]):
+                if len(prefix) < length:
+                    continue
+                group = list(group)
+                if len(group) > SCAN_LIMIT:
+                    top[prefix] = best_entries(group, refs, names, TOP_N)
+                    ranges.append((group[0], group[-1] + 1, length + 1))
+        data = {'format': SUGGEST_FORMAT,
+                'scan_limit': SCAN_LIMIT,
+                'top_n': TOP_N,
+                'funders': funder_names,
+                'keys': keys,
+                'refs': refs,
+                'names': names,
+                'top': top}
+        tmp_path = '{}.tmp-{}'.format(path, os.getpid())
+        with open(tmp_path, 'w', encoding='UTF-8') as fp:
+            json.dump(data, fp, ensure_ascii=False, separators=(',', ':'))
+        os.replace(tmp_path, path)
+
+def best_entries(entries, refs, names, n):
+    """Return the indexes of up to n of entries, one for each funder, best
+       funders first. The entry of the main name of a funder is preferred
+       to those of its altnames.
+       args:
+          entries: iterable of indexes into refs and names
+          refs: number of the funder of each entry
+          names: matched name of each entry, or None for the main name
+    """
+    best = {}
+    for i in entries:
+        num = refs[i]
+        if num not in best or (names[i] is None and names[best[num]] is not None):
+            best[num] = i
+    return [best[num] for num in heapq.nsmallest(n, best)]
+
+class Suggester:
+    """Completion data loaded from a suggest.json file."""
+    def __init__(self, path):
+        with open(path, 'r', encoding='UTF-8') as fp:
+            data = json.load(fp)
+        if data.get('format') != SUGGEST_FORMAT:
+            raise ValueError('unsupported suggest format in {}'.format(path))
+        self.scan_limit = data['scan_limit']
+        self.top_n = data['top_n']
+        self.funders = data['funders']
+        self.keys = data['keys']
+        self.refs = data['refs']
+        self.names = data['names']
+        self.top = data['top']
+
+    def suggest(self, prefix, n=10):
+        """Return up to n dicts with the id and name of funders that have a
+           name starting with prefix, best first, and the name that matched
+           as match, which is an altname or the name itself.
+        """
+        prefix = normalize(prefix)
+        n = min(n, self.top_n)
+        if not prefix or n <= 0:
+            return []
+        lo = bisect.bisect_left(self.keys, prefix)
+        hi = bisect.bisect_left(self.keys, prefix + '\U0010ffff', lo)
+        if hi - lo > self.scan_limit:
+            found = self.top[prefix][:n]
+        else:
+            found = best_entries(range(lo, hi), self.refs, self.names, n)
+        results = []
+        for i in found:
+            global_id, name = self.funders[self.refs[i]]
+            results.append({'id': global_id, 'name': name, 'match': self.names[i] or name})
+        return results
+
+_suggesters = GenerationFile(SUGGEST_FILE, Suggester)
+
+def get_suggester(db_path):
+    """Return the Suggester for the current generation of db_path. It is
+       reloaded when the generation or the suggest.json file changes.
+    """
+    return _suggesters.get(db_path)
+
+def suggest(db_path, prefix, n=10):
+    """Return up to n completions of prefix from the index at db_path."""
+    return get_suggester(db_path).suggest(prefix, n)
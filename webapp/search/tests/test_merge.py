@@ -0,0 +1,75 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from merge import merge_funders
+from model import DataSource, FunderRecord, FunderType
+
+def record(source, source_id, name, preferred_fundref=None, altnames=(), children=(), parents=()):
+    def rels(ids):
+        return [{'source': src, 'source_id': sid, 'name': rel_name} for src, sid, rel_name in ids]
+    return FunderRecord.from_dict({'source': source,
+                                   'source_id': source_id,
+                                   'name': name,
+                                   'country': 'Germany',
+                                   'country_code': 'deu' if source == DataSource.FUNDREG else 'DE',
+                                   'funder_type': FunderType.GOV,
+                                   'preferred_fundref': preferred_fundref,
+                                   'altnames': list(altnames),
+                                   'children': rels(children),
+                                   'parents': rels(parents),
+                                   'related': []})
+
+def by_id(*records):
+    return {rec.global_id(): rec for rec in records}
+
+def test_fundref_match_beats_name_claim():
+    fundreg = by_id(record(DataSource.FUNDREG, '100', 'German Research Foundation'))
+    ror = by_id(record(DataSource.ROR, 'r1', 'DFG', preferred_fundref='100'),
+                record(DataSource.ROR, 'r2', 'German Research Foundation'))
+    funders, report = merge_funders(fundreg, ror)
+    merged = funders['fundreg_100']
+    assert merged.merged_ids == ['ror_r1']
+    assert 'DFG' in merged.altnames
+    assert 'ror_r2' in funders
+    assert report['by_fundref'] == 1
+    assert report['by_name'] == 0
+    assert report['ambiguous'] == 1
+    assert report['documents'] == 2
+
+def test_two_ror_records_claiming_one_name():
+    fundreg = by_id(record(DataSource.FUNDREG, '100', 'Max Planck Society'))
+    ror = by_id(record(DataSource.ROR, 'r1', 'Max Planck Society'),
+                record(DataSource.ROR, 'r2', 'Max-Planck Society'))
+    funders, report = merge_funders(fundreg, ror)
+    assert funders['fundreg_100'].merged_ids == []
+    assert 'ror_r1' in funders and 'ror_r2' in funders
+    assert report['by_name'] == 0
+    assert report['ambiguous'] == 2
+    assert report['documents'] == 3
+
+def test_name_match_merges_and_leaves_input_unchanged():
+    original = record(DataSource.FUNDREG, '100', 'Volkswagen Foundation')
+    fundreg = by_id(original)
+    ror = by_id(record(DataSource.ROR, 'r1', 'Volkswagen Foundation', altnames=['VolkswagenStiftung']))
+    funders, report = merge_funders(fundreg, ror)
+    assert funders['fundreg_100'].merged_ids == ['ror_r1']
+    assert funders['fundreg_100'].altnames == ['VolkswagenStiftung']
+    assert original.merged_ids == [] and original.altnames == []
+    assert report['by_name'] == 1
+    assert 'ror_r1' not in funders
+
+def test_relationships_to_merged_record_are_remapped():
+    fundreg = by_id(record(DataSource.FUNDREG, '100', 'Helmholtz Association'))
+    ror = by_id(record(DataSource.ROR, 'r1', 'Helmholtz', preferred_fundref='100',
+                       children=[(DataSource.ROR, 'r2', 'DESY')]),
+                record(DataSource.ROR, 'r2', 'DESY',
+                       parents=[(DataSource.ROR, 'r1', 'Helmholtz')]))
+    funders, report = merge_funders(fundreg, ror)
+    parents = funders['ror_r2'].parents
+    assert [rel.global_id() for rel in parents] == ['fundreg_100']
+    assert parents[0].name == 'Helmholtz Association'
+    assert [rel.global_id() for rel in funders['fundreg_100'].children] == ['ror_r2']
+    assert ror['ror_r2'].parents[0].global_id() == 'ror_r1'
+    assert report['remapped_relationships'] == 1
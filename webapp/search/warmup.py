@@ -0,0 +1,269 @@
+"""Warming up a worker before it serves queries.
+
+The first queries on a new worker, or after a new generation of the
+index is published, are slow: the database and its query parsers have
+to be opened, and the blocks of the index are not yet in the page
+cache. A Warmer runs a set of representative queries and ID lookups in
+a background thread, opens several handles in the pool, and loads the
+suggestion and hierarchy files, so that real queries do not pay for
+this.
+
+The queries come from a workload file written by
+benchmarks/bench_query.py --save_workload, or else they are typed
+prefixes of the names of the most important funders in suggest.json,
+together with lookups of their IDs.
+
+/ready reports a worker as ready once its first warmup has finished.
+When the pool moves to a new generation of the index, the warmup runs
+again in the background, whether or not anything polls /ready. The
+worker stays ready meanwhile, since every worker notices the
+new generation at about the same time and taking them all out of
+service together would be worse than a few slow queries.
+"""
+
+from contextlib import ExitStack
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+try:
+    from .db_pool import get_pool
+    from .generations import resolve_generation
+    from .hierarchy import get_hierarchy
+    from .metrics import NULL_TIMER
+    from .search_lib import configure_queryparser, configure_result_cache, lookup, search
+    from .suggest import get_suggester, SUGGEST_FILE
+except ImportError: # imported from the search directory
+    from db_pool import get_pool
+    from generations import resolve_generation
+    from hierarchy import get_hierarchy
+    from metrics import NULL_TIMER
+    from search_lib import configure_queryparser, configure_result_cache, lookup, search
+    from suggest import get_suggester, SUGGEST_FILE
+
+# Number of funders from suggest.json whose names are used as queries.
+WARMUP_FUNDERS = 200
+# Number of database handles opened at once, so that concurrent queries
+# find them already open.
+WARMUP_HANDLES = 4
+# Number of results asked for, as by the front end.
+WARMUP_LIMIT = 20
+# Number of IDs in each lookup.
+LOOKUP_BATCH = 20
+# Seconds to wait before trying again after a warmup failed.
+RETRY_INTERVAL = 30.0
+
+log = logging.getLogger('search.warmup')
+
+def workload_from_file(path):
+    """Read queries written by bench_query.py --save_workload."""
+    with open(path, 'r', encoding='UTF-8') as fp:
+        return [json.loads(line) for line in fp if line.strip()]
+
+def workload_from_index(db_path, count=WARMUP_FUNDERS):
+    """Return typeahead queries and lookups for the count most important
+       funders of the index, as listed in suggest.json. Indexes built
+       before suggest.json have no queries."""
+    try:
+        with open(os.path.join(db_path, SUGGEST_FILE), 'r', encoding='UTF-8') as fp:
+            funders = json.load(fp)['funders'][:count]
+    except FileNotFoundError:
+        return []
+    workload = []
+    for _, name in funders:
+        first_word = name.split()[0] if name.split() else name
+        for textq in dict.fromkeys([first_word[:3], first_word, name]):
+            workload.append({'kind': 'typeahead', 'textq': textq})
+    for start in range(0, len(funders), LOOKUP_BATCH):
+        workload.append({'kind': 'lookup',
+                         'ids': [global_id for global_id, _ in funders[start:start + LOOKUP_BATCH]]})
+    return workload
+
+class Warmer:
+    """Warms up the index at db_path and keeps track of whether this
+       worker is ready.
+       args:
+          db_path: path to the database
+          workload_file: optional file of queries from bench_query.py. By
+             default the queries are made from suggest.json.
+          funders: number of funders used for the default queries
+          handles: number of handles to open in the pool
+    """
+    def __init__(self, db_path, workload_file=None, funders=WARMUP_FUNDERS, handles=WARMUP_HANDLES):
+        self.db_path = db_path
+        self.workload_file = workload_file
+        self.funders = funders
+        self.handles = handles
+        self._lock = threading.Lock()
+        self.ready = False
+        self.warming = False
+        self.generation = None
+        self.report = None
+        self.error = None
+        self.failed_at = None
+        # Set when a new generation appears while a warmup is running.
+        self._again = False
+        self._thread = None
+
+    def start(self):
+        """Start a warmup in a background thread. If one is running then it
+           runs again when it has finished."""
+        with self._lock:
+            if self.warming:
+                self._again = True
+                return
+            self.warming = True
+            self._thread = threading.Thread(target=self._run, name='warmup', daemon=True)
+            self._thread.start()
+
+    def _new_generation(self, generation):
+        """Called by the pool when it moves to a new generation. A change
+           noticed by the warmup itself is handled in _run()."""
+        if threading.current_thread() is self._thread:
+            return
+        log.info('rewarming for new generation %s', generation)
+        self.start()
+
+    def skip(self):
+        """Report ready without warming up."""
+        with self._lock:
+            self.ready = True
+
+    def _run(self):
+        while True:
+            with self._lock:
+                self._again = False
+            try:
+                report = self.warm()
+                # The pool may have moved on while the queries ran.
+                moved = report['generation'] != get_pool(self.db_path, configure_queryparser).generation
+                with self._lock:
+                    self.report = report
+                    self.generation = report['generation']
+                    self.error = None
+                    self.ready = True
+                    self._again = self._again or moved
+            except Exception as e:
+                log.exception('warmup of %s failed', self.db_path)
+                with self._lock:
+                    self.error = str(e)
+                    self.failed_at = time.monotonic()
+            with self._lock:
+                if not self._again or self.error is not None:
+                    self.warming = False
+                    return
+
+    def warm(self):
+        """Run the warmup in this thread and return a report of what was
+           done and how long each stage took in seconds."""
+        start = last = time.perf_counter()
+        stages = {}
+        def mark(stage):
+            nonlocal last
+            now = time.perf_counter()
+            stages[stage] = round(now - last, 4)
+            last = now
+        pool = get_pool(self.db_path, configure_queryparser)
+        pool.add_listener(self._new_generation)
+        # The generation that the pool serves, which suggest.json and
+        # hierarchy.json are also loaded from.
+        generation = pool.refresh_generation()
+        # Hold several handles at once so that the pool keeps them all open.
+        with ExitStack() as stack:
+            for _ in range(self.handles):
+                stack.enter_context(pool.handle())
+        mark('open')
+        if self.workload_file:
+            workload = workload_from_file(self.workload_file)
+        else:
+            workload = workload_from_index(generation, self.funders)
+        mark('workload')
+        errors = 0
+        queries = lookups = 0
+        # NULL_TIMER keeps the warmup out of the metrics of real requests.
+        for query in workload:
+            if query['kind'] == 'lookup':
+                res = lookup(self.db_path, query['ids'], timer=NULL_TIMER)
+                lookups += 1
+            else:
+                res = search(self.db_path, 0, query.get('limit', WARMUP_LIMIT),
+                             textq=query.get('textq'), locationq=query.get('locationq'),
+                             timer=NULL_TIMER)
+                queries += 1
+            if 'error' in res:
+                errors += 1
+        mark('queries')
+        # Indexes built before suggest.json or hierarchy.json lack them.
+        try:
+            get_suggester(self.db_path)
+        except OSError:
+            pass
+        mark('suggest')
+        try:
+            get_hierarchy(self.db_path)
+        except OSError:
+            pass
+        mark('hierarchy')
+        report = {'generation': generation,
+                  'handles': self.handles,
+                  'queries': queries,
+                  'lookups': lookups,
+                  'errors': errors,
+                  'stages': stages,
+                  'seconds': round(last - start, 4)}
+        log.info('warmed up %s in %.3fs: %s', generation, report['seconds'], report)
+        return report
+
+    def check(self):
+        """Start a warmup if the index has moved to a new generation that
+           the pool has not noticed yet, or if the last one failed a while
+           ago, and return status()."""
+        with self._lock:
+            stale = (self.generation is not None and
+                     resolve_generation(self.db_path) != self.generation)
+            retry = (self.error is not None and
+                     time.monotonic() - self.failed_at >= RETRY_INTERVAL)
+        if stale or retry:
+            self.start()
+        return self.status()
+
+    def status(self):
+        with self._lock:
+            return {'ready': self.ready,
+                    'warming': self.warming,
+                    'generation': self.generation,
+                    'warmup': self.report,
+                    'error': self.error}
+
+    def lines(self, prefix):
+        """Return the lines of the Prometheus text format for the warmup."""
+        with self._lock:
+            lines = ['# TYPE {}_ready gauge'.format(prefix),
+                     '{}_ready {}'.format(prefix, int(self.ready)),
+                     '# TYPE {}_warmup_seconds gauge'.format(prefix)]
+            if self.report:
+                for stage, seconds in sorted(self.report['stages'].items()):
+                    lines.append('{}_warmup_seconds{{stage="{}"}} {}'.format(prefix, stage, seconds))
+                lines.append('{}_warmup_seconds{{stage="total"}} {}'.format(prefix, self.report['seconds']))
+        return lines
+
+if __name__ == '__main__':
+    arguments = argparse.ArgumentParser()
+    arguments.add_argument('--dbpath',
+                           default='./xapian.db',
+                           help='Path to database directory.')
+    arguments.add_argument('--workload',
+                           help='Queries from bench_query.py --save_workload')
+    arguments.add_argument('--funders',
+                           type=int,
+                           default=WARMUP_FUNDERS,
+                           help='Number of funders from suggest.json used as queries')
+    args = arguments.parse_args()
+    # Without this the second run would be answered from the result cache.
+    configure_result_cache(0, 0)
+    # The second run shows what is left once the caches are warm.
+    for run in ['cold', 'warm']:
+        report = Warmer(args.dbpath, args.workload, args.funders).warm()
+        print(run, json.dumps(report, indent=2))